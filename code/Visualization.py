@@ -1,25 +1,40 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# ### Display coronal view of tibia and femur segmentation.
-
-# In[ ]:
-
+"""
+Visualization.py
+Interactive (plt.show) coronal views of the segmentation, expanded and randomized
+masks. Importing this module only defines the functions; the demo at the bottom
+runs when the file is executed. For headless figures use qa_render.py or
+`python cli.py render`.
+"""
 
 import numpy as np
 import matplotlib.pyplot as plt
 import SimpleITK as sitk
+from slice_io import read_coronal_slice
+
+# Paths to the five tibia masks
+TIBIA_MASK_PATHS = [
+    "results/mask_tibia.nii.gz",
+    "results/mask_tibia_expanded_2mm.nii.gz",
+    "results/mask_tibia_expanded_4mm.nii.gz",
+    "results/mask_tibia_random_1.nii.gz",
+    "results/mask_tibia_random_2.nii.gz",
+]
+TIBIA_MASK_TITLES = ["Original", "Expanded 2 mm", "Expanded 4 mm", "Random 1", "Random 2"]
+
+
+# ### Display coronal view of tibia and femur segmentation.
 
 def show_bone_overlay(ct, labeled_img):
     """
     Show coronal mid-slice with overlay for tibia (red) and femur (green).
+    `ct` and `labeled_img` may be images, Volumes or file paths; only the
+    mid-slice is read.
     """
-    ct_arr = sitk.GetArrayFromImage(ct)
-    label_arr = sitk.GetArrayFromImage(labeled_img)
-
-    y_mid = ct_arr.shape[1] // 2
-    slice_img = ct_arr[:, y_mid, :]
-    slice_label = label_arr[:, y_mid, :]
+    slice_img = read_coronal_slice(ct)
+    slice_label = read_coronal_slice(labeled_img)
 
     rgb = np.stack([slice_img]*3, axis=-1)
     rgb = (rgb - rgb.min()) / (rgb.max() - rgb.min())
@@ -38,42 +53,20 @@ def show_bone_overlay(ct, labeled_img):
     plt.show()
 
 
-# In[ ]:
-
-
-# Run from code folder or main script
-from segmentation import segment_bones
-from visualize import show_bone_overlay
-
-labeled_img, ct = segment_bones("3702_left_knee.nii.gz")
-show_bone_overlay(ct, labeled_img)
-
-
 # ### Displays a coronal slice with the expanded mask overlaid on CT.
 
-# In[ ]:
-
-
-import SimpleITK as sitk
-import numpy as np
-import matplotlib.pyplot as plt
-
 def show_coronal_overlay(ct_image: sitk.Image, mask: sitk.Image, overlay_color='spring', title='Coronal Overlay'):
     """
     Displays the coronal mid-slice of CT with a colored mask overlay.
 
     Args:
-        ct_image (sitk.Image): CT volume.
-        mask (sitk.Image): Expanded or original mask.
+        ct_image (sitk.Image): CT volume (or Volume / file path).
+        mask (sitk.Image): Expanded or original mask (or Volume / file path).
         overlay_color (str): Matplotlib colormap for the overlay.
         title (str): Plot title.
     """
-    ct_array = sitk.GetArrayFromImage(ct_image)
-    mask_array = sitk.GetArrayFromImage(mask)
-
-    y_mid = ct_array.shape[1] // 2
-    ct_slice = ct_array[:, y_mid, :]
-    mask_slice = mask_array[:, y_mid, :]
+    ct_slice = read_coronal_slice(ct_image)
+    mask_slice = read_coronal_slice(mask)
 
     plt.figure(figsize=(6, 6))
     plt.imshow(ct_slice, cmap='gray')
@@ -87,47 +80,18 @@ def show_coronal_overlay(ct_image: sitk.Image, mask: sitk.Image, overlay_color='
     plt.show()
 
 
-# In[ ]:
-
-
-from expansion import expand_and_save
-from visualize_expansion import show_coronal_overlay
-import SimpleITK as sitk
-
-# Load input
-ct = sitk.ReadImage("3702_left_knee.nii.gz")
-mask = sitk.ReadImage("results/bone_segmented.nii.gz")
-
-# Expand and save
-expanded_mask = expand_and_save(mask, expansion_mm=2.0, save_path="results/mask_bone_expanded_2mm.nii.gz")
-
-# Display
-show_coronal_overlay(ct_image=ct, mask=expanded_mask, title="bone Mask Expanded by 2mm")
-
-
 # ### Visualizes coronal view of randomized tibia and femur masks
 
-# In[ ]:
-
-
-import numpy as np
-import matplotlib.pyplot as plt
-import SimpleITK as sitk
-
 def show_randomized_overlay(ct_image: sitk.Image, labeled_mask: sitk.Image):
     """
     Displays the randomized tibia (blue) and femur (green) overlay in coronal view.
 
     Args:
-        ct_image (sitk.Image): CT volume.
-        labeled_mask (sitk.Image): Labeled mask with 1=tibia, 2=femur.
+        ct_image (sitk.Image): CT volume (or Volume / file path).
+        labeled_mask (sitk.Image): Labeled mask with 1=tibia, 2=femur (or Volume / file path).
     """
-    ct_arr = sitk.GetArrayFromImage(ct_image)
-    mask_arr = sitk.GetArrayFromImage(labeled_mask)
-
-    y_mid = ct_arr.shape[1] // 2
-    ct_slice = ct_arr[:, y_mid, :]
-    mask_slice = mask_arr[:, y_mid, :]
+    ct_slice = read_coronal_slice(ct_image)
+    mask_slice = read_coronal_slice(labeled_mask)
 
     rgb = np.stack([ct_slice]*3, axis=-1)
     rgb = (rgb - rgb.min()) / (rgb.max() - rgb.min())
@@ -146,77 +110,62 @@ def show_randomized_overlay(ct_image: sitk.Image, labeled_mask: sitk.Image):
     plt.show()
 
 
-# In[ ]:
-
-
-from randomization import randomize_mask_distance_based, combine_and_save_masks
-import SimpleITK as sitk
-
-# Load inputs
-ct = sitk.ReadImage("3702_left_knee.nii.gz")
-labeled_mask = sitk.ReadImage("results/bone_segmented.nii.gz")
-
-# Split tibia and femur masks
-labeled_arr = sitk.GetArrayFromImage(labeled_mask)
-tibia_arr = (labeled_arr == 1).astype(np.uint8)
-femur_arr = (labeled_arr == 2).astype(np.uint8)
+# ### Display Coronal Mid-Slice of Tibia Masks
 
-tibia_mask = sitk.GetImageFromArray(tibia_arr)
-femur_mask = sitk.GetImageFromArray(femur_arr)
-tibia_mask.CopyInformation(labeled_mask)
-femur_mask.CopyInformation(labeled_mask)
+def load_coronal_slice(mask_path):
+    """
+    Load the coronal mid-slice of a binary mask without decoding the full volume.
+    Returns a 2D NumPy array of shape [Z, X].
+    """
+    return read_coronal_slice(mask_path)
 
-# Randomize masks
-rand_tibia = randomize_mask_distance_based(tibia_mask, ct, max_mm=2.0, seed=42)
-rand_femur = randomize_mask_distance_based(femur_mask, ct, max_mm=2.0, seed=7)
 
-# Combine and save
-output_path = "results/bone_segmented_randomized.nii.gz"
-combined_mask = combine_and_save_masks(ct, rand_tibia, rand_femur, output_path)
+def show_tibia_masks(mask_paths=TIBIA_MASK_PATHS, titles=TIBIA_MASK_TITLES):
+    """
+    Coronal mid-slices of the tibia mask variants side by side.
+    """
+    fig, axes = plt.subplots(1, len(mask_paths), figsize=(3 * len(mask_paths), 4))
+    for ax, path, title in zip(axes, mask_paths, titles):
+        slice_2d = load_coronal_slice(path)
+        ax.imshow(slice_2d, cmap='gray')
+        ax.set_title(title)
+        ax.axis('off')
+
+    plt.suptitle("Coronal Mid-Slice of Tibia Masks")
+    plt.tight_layout()
+    plt.show()
 
-# Visualize
-show_randomized_overlay(ct, combined_mask)
 
+def main(ct_path="3702_left_knee.nii.gz", result_dir="results"):
+    """
+    Segment, expand and randomize one CT and show each step.
+    """
+    import os
 
-# ### Display Coronal Mid-Slice of Tibia Masks
+    from expansion import expand_and_save
+    from randomization import randomize_labels_distance_based
+    from segmentation import segment_bones
 
-# In[ ]:
+    labeled_img, ct = segment_bones(ct_path, output_dir=result_dir)
+    show_bone_overlay(ct, labeled_img)
 
+    # Expand and save
+    expanded_mask = expand_and_save(labeled_img, expansion_mm=2.0,
+                                    save_path=os.path.join(result_dir, "mask_bone_expanded_2mm.nii.gz"))
+    show_coronal_overlay(ct_image=ct, mask=expanded_mask, title="bone Mask Expanded by 2mm")
 
-import SimpleITK as sitk
-import numpy as np
-import matplotlib.pyplot as plt
-import os
+    # Randomize tibia and femur in one pass (each label gets its own random draw)
+    combined_mask = randomize_labels_distance_based(labeled_img, max_mm=2.0, seed=42)
+    output_path = os.path.join(result_dir, "bone_segmented_randomized.nii.gz")
+    sitk.WriteImage(combined_mask, output_path)
+    print(f"✅ Combined randomized mask saved at: {output_path}")
+    show_randomized_overlay(ct, combined_mask)
 
-# Paths to the five tibia masks
-mask_paths = [
-    "results/mask_tibia.nii.gz",
-    "results/mask_tibia_expanded_2mm.nii.gz",
-    "results/mask_tibia_expanded_4mm.nii.gz",
-    "results/mask_tibia_random_1.nii.gz",
-    "results/mask_tibia_random_2.nii.gz",
-]
-titles = ["Original", "Expanded 2 mm", "Expanded 4 mm", "Random 1", "Random 2"]
+    # Tibia mask variants written by run_landmark_pipeline.py / main.py
+    paths = [p.replace("results", result_dir, 1) for p in TIBIA_MASK_PATHS]
+    if all(os.path.exists(p) for p in paths):
+        show_tibia_masks(paths)
 
-def load_coronal_slice(mask_path):
-    """
-    Load the coronal mid-slice of a binary mask.
-    Returns a 2D NumPy array of shape [Z, X].
-    """
-    img = sitk.ReadImage(mask_path)
-    arr = sitk.GetArrayFromImage(img)  # [Z, Y, X]
-    y_mid = arr.shape[1] // 2
-    return arr[:, y_mid, :]
-
-# Prepare the figure: 1 row × 5 columns
-fig, axes = plt.subplots(1, 5, figsize=(15, 4))
-for ax, path, title in zip(axes, mask_paths, titles):
-    slice_2d = load_coronal_slice(path)
-    ax.imshow(slice_2d, cmap='gray')
-    ax.set_title(title)
-    ax.axis('off')
-
-plt.suptitle("Coronal Mid-Slice of Tibia Masks")
-plt.tight_layout()
-plt.show()
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+batch.py
+Runs segmentation → expansion → randomization → tibial landmarks over a cohort of CT
+scans in a process pool. Each case gets its own output directory; a manifest records
+finished cases so a restarted run skips them; per-case landmark rows are merged into
+a cohort SQLite landmark store (exported as a TSV table).
+
+With --prefetch K the cases instead run in one process as a pipeline: the next K
+CTs are decoded ahead while the current one is computed and outputs are compressed
+behind it, with bounded queues on both sides.
+
+With --profile (or KNEE_PROFILE=1) every case writes a stage report (see
+instrumentation.py), and the reports are merged into cohort_stage_report.json/.csv.
+
+Usage:
+    python batch.py <ct_dir_or_manifest.txt> <output_dir> [--workers N | --prefetch K] [--cache-dir DIR]
+                    [--profile]
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from instrumentation import PROFILE
+from landmark_store import LANDMARK_DB_NAME, LANDMARK_TSV_NAME, LandmarkStore
+
+MANIFEST_NAME = "cohort_manifest.json"
+COHORT_TABLE_NAME = "cohort_landmarks.txt"
+COHORT_DB_NAME = "cohort_landmarks.sqlite"
+NIFTI_SUFFIXES = (".nii.gz", ".nii")
+
+
+def case_id_from_path(ct_path: str) -> str:
+    """
+    Case identifier: CT file name without its NIfTI suffix.
+    """
+    name = os.path.basename(ct_path)
+    for suffix in NIFTI_SUFFIXES:
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def list_cases(source: str):
+    """
+    Collect CT paths from a directory of NIfTI files or a manifest text file
+    (one path per line, '#' comments, paths relative to the manifest's folder).
+
+    Returns:
+        dict: case_id -> CT path, in sorted order.
+    """
+    if os.path.isdir(source):
+        paths = [
+            os.path.join(source, f) for f in os.listdir(source)
+            if f.endswith(NIFTI_SUFFIXES)
+        ]
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        paths = []
+        with open(source) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    paths.append(line if os.path.isabs(line) else os.path.join(base, line))
+
+    cases = {}
+    for path in sorted(paths):
+        case_id = case_id_from_path(path)
+        if case_id in cases:
+            raise ValueError(f"Duplicate case id '{case_id}' for {path} and {cases[case_id]}")
+        cases[case_id] = path
+    return cases
+
+
+def load_manifest(output_dir: str) -> dict:
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir: str, manifest: dict):
+    """
+    Write the manifest atomically so an interrupted run never leaves it half written.
+    """
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def process_case(case_id: str, ct_path: str, case_dir: str, cache_dir: str = None, profile: bool = None):
+    """
+    Full single-case chain. Runs inside a worker process. With `cache_dir` the
+    segmentation and distance map come from the stage cache there when possible.
+    With `profile` (default: KNEE_PROFILE) the case's stage report is written to
+    case_dir.
+
+    Returns:
+        tuple: (path to the case's tibial_landmarks.txt, landmark records).
+    """
+    # Imported here so the parent process does not pay for SimpleITK/SciPy
+    from instrumentation import StageProfiler
+    from segmentation import segment_bones
+    from run_landmark_pipeline import run_landmark_detection
+
+    bones = {}
+    cache = None
+    os.makedirs(case_dir, exist_ok=True)
+    profiler = StageProfiler(profile)
+    with profiler.activate():
+        if cache_dir:
+            from stage_cache import StageCache, cached_segment_bones
+
+            cache = StageCache(cache_dir)
+            cached_segment_bones(ct_path, case_dir, cache, bones=bones)
+        else:
+            segment_bones(ct_path, output_dir=case_dir, bones=bones)
+        records = run_landmark_detection(
+            orig_path=os.path.join(case_dir, "mask_tibia.nii.gz"),
+            ct_path=ct_path,
+            output_dir=case_dir,
+            case_id=case_id,
+            box=bones["tibia"]["box"],
+            cache=cache,
+        )
+    profiler.write(case_dir, case_id)
+    return os.path.join(case_dir, LANDMARK_TSV_NAME), records
+
+
+def process_loaded_case(case_id: str, ct, case_dir: str, writer, cache_dir: str = None, ct_path: str = None,
+                        profile: bool = None):
+    """
+    Single-case chain on an already decoded CT, with every output queued on
+    `writer` (a mask_io.MaskWriter) instead of written in line. The tibia mask is
+    taken from the in-memory segmentation (inside its bone box) rather than read
+    back from disk. With `cache_dir` (and the CT's `ct_path`, which keys the
+    cache) the segmentation and distance map come from the stage cache; cached
+    segmentations are written in line, since the cache stores the written files.
+    With `profile` the stage report is written when the compute is done, so it
+    leaves out the time and bytes of the writes still queued on `writer`.
+
+    Returns:
+        tuple: (path to the case's tibial_landmarks.txt, landmark records).
+    """
+    from bone_separation import bone_mask
+    from instrumentation import StageProfiler
+    from segmentation import segment_bones
+    from run_landmark_pipeline import run_landmark_detection
+    from volume import as_volume
+
+    bones = {}
+    cache = None
+    os.makedirs(case_dir, exist_ok=True)
+    profiler = StageProfiler(profile)
+    with profiler.activate():
+        if cache_dir:
+            from stage_cache import StageCache, cached_segment_bones
+
+            cache = StageCache(cache_dir)
+            labeled = cached_segment_bones(ct_path, case_dir, cache, bones=bones, ct=ct)
+        else:
+            labeled, _ = segment_bones(ct, output_dir=case_dir, writer=writer, bones=bones)
+        tibia = bone_mask(as_volume(labeled), bones["tibia"])
+        records = run_landmark_detection(tibia, None, case_dir, case_id=case_id, writer=writer,
+                                         box=bones["tibia"]["box"], cache=cache)
+    profiler.write(case_dir, case_id)
+    return os.path.join(case_dir, LANDMARK_TSV_NAME), records
+
+
+def merge_landmarks(output_dir: str, manifest: dict, store: LandmarkStore = None) -> str:
+    """
+    Export the cohort landmark store as one table with a Case column. Finished
+    cases missing from the store (e.g. from an older run) are loaded from their
+    per-case landmarks.sqlite first.
+    """
+    own_store = store is None
+    store = store or LandmarkStore(os.path.join(output_dir, COHORT_DB_NAME))
+    try:
+        known = set(store.cases())
+        for case_id in sorted(manifest):
+            if manifest[case_id].get("status") != "done" or case_id in known:
+                continue
+            case_db = os.path.join(output_dir, case_id, LANDMARK_DB_NAME)
+            if os.path.exists(case_db):
+                with LandmarkStore(case_db) as case_store:
+                    store.extend(case_store.query(case_id=case_id))
+        return store.export_tsv(os.path.join(output_dir, COHORT_TABLE_NAME), with_case=True)
+    finally:
+        if own_store:
+            store.close()
+
+
+def merge_stage_reports(output_dir: str, manifest: dict):
+    """
+    Merge the stage reports of finished cases into cohort_stage_report.json/.csv.
+
+    Returns:
+        str: Path to the cohort report, or None if no case has a stage report.
+    """
+    from instrumentation import STAGE_REPORT_NAME, write_cohort_report
+
+    reports = []
+    for case_id in sorted(manifest):
+        path = os.path.join(output_dir, case_id, STAGE_REPORT_NAME)
+        if manifest[case_id].get("status") == "done" and os.path.exists(path):
+            with open(path) as f:
+                reports.append(json.load(f))
+    return write_cohort_report(output_dir, reports) if reports else None
+
+
+def run_cohort(source: str, output_dir: str, workers: int = None, prefetch: int = 0,
+               max_pending_writes: int = 8, cache_dir: str = None, profile: bool = None) -> str:
+    """
+    Process every case from `source` that is not yet marked done in the manifest.
+
+    Args:
+        source (str): Directory of CT NIfTI files, or a manifest text file.
+        output_dir (str): Cohort output root; cases go to <output_dir>/<case_id>/.
+        workers (int): Process pool size (default: os.cpu_count()).
+        prefetch (int): If > 0, run the cases in this process as a pipeline instead:
+            the next `prefetch` CTs are decoded ahead, and outputs are compressed
+            and written behind (at most `max_pending_writes` queued), so reading,
+            computing and writing overlap (see _run_pipelined).
+        cache_dir (str): Stage cache directory (see stage_cache.py). Reruns with
+            other parameters then reuse each case's segmentation and distance map.
+        profile (bool): Write per-case stage reports and merge them into
+            <output_dir>/cohort_stage_report.json (default: KNEE_PROFILE).
+
+    Returns:
+        str: Path to the merged cohort landmark table (the queryable store is
+            <output_dir>/cohort_landmarks.sqlite).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    cases = list_cases(source)
+    manifest = load_manifest(output_dir)
+
+    pending = {
+        cid: path for cid, path in cases.items()
+        if manifest.get(cid, {}).get("status") != "done"
+        or not os.path.exists(manifest[cid].get("landmarks", ""))
+    }
+    print(f"📋 {len(cases)} cases, {len(cases) - len(pending)} already done, {len(pending)} to run")
+
+    store = LandmarkStore(os.path.join(output_dir, COHORT_DB_NAME))
+
+    def finish(cid, result=None, exc=None):
+        if exc is None:
+            landmarks, records = result
+            store.extend(records)
+            store.flush()
+            manifest[cid] = {"status": "done", "ct": cases[cid], "landmarks": landmarks}
+            print(f"✅ {cid} done")
+        else:
+            manifest[cid] = {"status": "failed", "ct": cases[cid], "error": repr(exc)}
+            print(f"❌ {cid} failed: {exc!r}")
+        save_manifest(output_dir, manifest)
+
+    with store:
+        if prefetch > 0:
+            _run_pipelined(pending, output_dir, finish, prefetch, max_pending_writes, cache_dir, profile)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(process_case, cid, path, os.path.join(output_dir, cid), cache_dir, profile): cid
+                    for cid, path in pending.items()
+                }
+                for future in as_completed(futures):
+                    try:
+                        finish(futures[future], result=future.result())
+                    except Exception as exc:
+                        finish(futures[future], exc=exc)
+
+        table_path = merge_landmarks(output_dir, manifest, store)
+    print(f"✅ Cohort landmark table saved to: {table_path}")
+    if PROFILE if profile is None else profile:
+        report = merge_stage_reports(output_dir, manifest)
+        if report:
+            print(f"✅ Cohort stage report saved to: {report}")
+    return table_path
+
+
+def _run_pipelined(pending: dict, output_dir: str, finish, prefetch: int, max_pending_writes: int,
+                   cache_dir: str = None, profile: bool = None):
+    """
+    Read → compute → write pipeline in one process. A Prefetcher thread decodes
+    the next CTs, the calling thread segments and measures, and a bounded
+    MaskWriter compresses the outputs. Both queues block when full, which caps
+    memory at roughly (prefetch + 2) CTs plus max_pending_writes masks. A case is
+    reported done (manifest, cohort store) only once all its files are written.
+    """
+    from collections import deque
+
+    from mask_io import MaskWriter
+    from prefetch import Prefetcher
+
+    writing = deque()  # (case id, its writer, result) in submission order
+
+    def settle(block: bool):
+        while writing and (block or writing[0][1].done()):
+            cid, case_writer, result = writing.popleft()
+            try:
+                case_writer.wait()
+                finish(cid, result=result)
+            except Exception as exc:
+                finish(cid, exc=exc)
+
+    with MaskWriter(max_pending=max_pending_writes) as writer, Prefetcher(pending, depth=prefetch) as reader:
+        for cid, ct in reader:
+            if isinstance(ct, Exception):
+                finish(cid, exc=ct)
+                continue
+            case_writer = writer.fork()
+            try:
+                result = process_loaded_case(cid, ct, os.path.join(output_dir, cid), case_writer,
+                                             cache_dir=cache_dir, ct_path=pending[cid], profile=profile)
+            except Exception as exc:
+                try:
+                    case_writer.wait()
+                except Exception:
+                    pass  # the compute error is the one reported
+                finish(cid, exc=exc)
+                continue
+            del ct
+            writing.append((cid, case_writer, result))
+            settle(block=False)
+        settle(block=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the tibial landmark pipeline over a CT cohort.")
+    parser.add_argument("source", help="Directory of CT .nii/.nii.gz files or a text manifest of paths")
+    parser.add_argument("output_dir", help="Cohort output directory")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="Run as a single-process read/compute/write pipeline, decoding this many CTs ahead")
+    parser.add_argument("--max-pending-writes", type=int, default=8,
+                        help="Output files allowed to wait for compression in pipeline mode")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Reuse segmentations and distance maps from this stage cache")
+    parser.add_argument("--profile", action="store_true", default=None,
+                        help="Write per-case and cohort stage reports (also: KNEE_PROFILE=1)")
+    args = parser.parse_args()
+    run_cohort(args.source, args.output_dir, workers=args.workers, prefetch=args.prefetch,
+               max_pending_writes=args.max_pending_writes, cache_dir=args.cache_dir, profile=args.profile)
@@ -0,0 +1,4 @@
+"""
+Benchmarks for the knee segmentation pipeline on synthetic CT phantoms.
+Run from the code/ directory: python -m benchmarks.run_benchmarks --help
+"""
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+phantom.py
+Synthetic knee-like CT phantoms: a femur (upper) and tibia (lower) bone body above
+260 HU with a denser cortical shell, inside a soft-tissue cylinder surrounded by air.
+Built one axial slice at a time so large (up to 1024³) volumes never need float
+temporaries of the full size.
+"""
+
+import os
+
+import numpy as np
+
+AIR_HU = -1000
+SOFT_TISSUE_HU = 40
+CANCELLOUS_HU = 450
+CORTICAL_HU = 1200
+
+
+def knee_phantom_array(shape=(128, 128, 128), spacing=(0.8, 0.8, 1.5), shape_kind="ellipsoid",
+                       gap_mm=6.0, cortex_mm=1.5, noise_hu=20.0, seed=0) -> np.ndarray:
+    """
+    Int16 CT array [Z, Y, X] of a two-bone knee phantom.
+
+    Args:
+        shape: Volume size (z, y, x) in voxels.
+        spacing: Voxel spacing (x, y, z) in mm, SimpleITK order.
+        shape_kind (str): "ellipsoid" or "cylinder" bones.
+        gap_mm (float): Joint gap between femur and tibia in mm.
+        cortex_mm (float): Cortical shell thickness in mm.
+        noise_hu (float): Standard deviation of Gaussian noise in HU.
+        seed (int): Noise seed.
+
+    Returns:
+        np.ndarray: int16 HU values. The femur occupies low z, the tibia high z,
+            matching segment_bones' split.
+    """
+    nz, ny, nx = shape
+    sx, sy, sz = spacing
+    rng = np.random.default_rng(seed)
+
+    ext_z, ext_y, ext_x = nz * sz, ny * sy, nx * sx
+    y = (np.arange(ny) + 0.5) * sy - ext_y / 2
+    x = (np.arange(nx) + 0.5) * sx - ext_x / 2
+    yy, xx = np.meshgrid(y, x, indexing="ij")
+
+    body_r = 0.45 * min(ext_y, ext_x)
+    bone_ry, bone_rx = 0.22 * ext_y, 0.28 * ext_x
+    body = (yy / body_r) ** 2 + (xx / body_r) ** 2 <= 1.0
+    radial = np.sqrt((yy / bone_ry) ** 2 + (xx / bone_rx) ** 2)
+
+    # Each bone spans from its volume end to the joint gap around the middle
+    z_mid = ext_z / 2
+    half_len = max(z_mid - gap_mm / 2, 1e-3)
+    femur_center, tibia_center = z_mid - gap_mm / 2 - half_len, z_mid + gap_mm / 2 + half_len
+    cortex = cortex_mm / min(bone_ry, bone_rx)
+
+    out = np.empty(shape, dtype=np.int16)
+    for k in range(nz):
+        zc = (k + 0.5) * sz
+        center = femur_center if zc < z_mid else tibia_center
+        if shape_kind == "ellipsoid":
+            r = np.sqrt(radial ** 2 + ((zc - center) / half_len) ** 2)
+        elif shape_kind == "cylinder":
+            r = np.where(abs(zc - center) <= half_len, radial, np.inf)
+        else:
+            raise ValueError(f"Unknown phantom shape '{shape_kind}'")
+
+        sl = np.where(body, SOFT_TISSUE_HU, AIR_HU).astype(np.float32)
+        sl[r <= 1.0] = CORTICAL_HU
+        sl[r <= 1.0 - cortex] = CANCELLOUS_HU
+        if noise_hu:
+            sl += rng.normal(0.0, noise_hu, size=sl.shape).astype(np.float32)
+        out[k] = np.clip(sl, -32768, 32767).astype(np.int16)
+    return out
+
+
+def knee_phantom(shape=(128, 128, 128), spacing=(0.8, 0.8, 1.5), origin=(0.0, 0.0, 0.0), **kwargs):
+    """
+    Knee phantom as a SimpleITK image (see knee_phantom_array for arguments).
+    """
+    import SimpleITK as sitk
+
+    img = sitk.GetImageFromArray(knee_phantom_array(shape, spacing, **kwargs))
+    img.SetSpacing(tuple(float(s) for s in spacing))
+    img.SetOrigin(tuple(float(o) for o in origin))
+    return img
+
+
+def write_knee_phantom(path: str, shape=(128, 128, 128), spacing=(0.8, 0.8, 1.5), **kwargs) -> str:
+    """
+    Write a phantom CT to `path` (e.g. .nii.gz) and return the path.
+    """
+    import SimpleITK as sitk
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    sitk.WriteImage(knee_phantom(shape, spacing, **kwargs), path)
+    return path
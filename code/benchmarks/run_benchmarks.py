@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+run_benchmarks.py
+Repeatable timing and peak-memory benchmarks of the pipeline stages on synthetic
+knee phantoms. Every (stage, size) pair runs in a fresh process so peak RSS is
+attributable to that stage. Results are saved as JSON, and a previous JSON can be
+given with --compare to flag regressions between commits.
+
+Usage (from the code/ directory):
+    python -m benchmarks.run_benchmarks --sizes 64 128 256 --out bench.json
+    python -m benchmarks.run_benchmarks --sizes 128 --compare bench.json
+    KNEE_EDT_BACKEND=sitk KNEE_EDT_WORKERS=4 python -m benchmarks.run_benchmarks --only distance_transform
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.phantom import write_knee_phantom
+
+DEFAULT_SIZES = (64, 128, 256)
+DEFAULT_SPACING = (0.8, 0.8, 1.5)
+
+
+def _load(path):
+    import SimpleITK as sitk
+
+    return sitk.ReadImage(path)
+
+
+def _bench_segment_bones(inputs, out_dir):
+    from segmentation import segment_bones
+
+    return lambda: segment_bones(inputs["ct"], output_dir=out_dir)
+
+
+def _bench_expand_mask_by_mm(inputs, out_dir):
+    from distance_map import clear_cache
+    from expansion import expand_mask_by_mm
+
+    mask = _load(inputs["tibia"])
+
+    def run():
+        clear_cache()
+        expand_mask_by_mm(mask, 2.0)
+    return run
+
+
+def _bench_randomize_randomization(inputs, out_dir):
+    from distance_map import clear_cache
+    from randomization import randomize_mask_distance_based
+
+    mask = _load(inputs["tibia"])
+
+    def run():
+        clear_cache()
+        randomize_mask_distance_based(mask, mask, max_mm=2.0, seed=1)
+    return run
+
+
+def _bench_randomize_landmark_utils(inputs, out_dir):
+    from distance_map import clear_cache
+    from landmark_utils import randomize_mask_distance_based
+
+    mask = _load(inputs["tibia"])
+
+    def run():
+        clear_cache()
+        randomize_mask_distance_based(mask, 2.0, seed=1)
+    return run
+
+
+def _bench_distance_transform(inputs, out_dir):
+    import SimpleITK as sitk
+    from distance_map import EDT_BACKEND
+    from edt import distance_transform
+
+    mask = _load(inputs["tibia"])
+    background = sitk.GetArrayFromImage(mask) == 0
+    spacing = mask.GetSpacing()[::-1]
+    return lambda: distance_transform(background, spacing, backend=EDT_BACKEND)
+
+
+def _bench_combine_and_save_masks(inputs, out_dir):
+    from randomization import combine_and_save_masks
+
+    tibia, femur = _load(inputs["tibia"]), _load(inputs["femur"])
+    path = os.path.join(out_dir, "combined.nii.gz")
+    return lambda: combine_and_save_masks(tibia, tibia, femur, path)
+
+
+def _bench_find_medial_lateral_lowest(inputs, out_dir):
+    from landmark_utils import find_medial_lateral_lowest
+
+    mask = _load(inputs["tibia"])
+    return lambda: find_medial_lateral_lowest(mask)
+
+
+BENCHMARKS = {
+    "segment_bones": _bench_segment_bones,
+    "expand_mask_by_mm": _bench_expand_mask_by_mm,
+    "distance_transform": _bench_distance_transform,
+    "randomization.randomize_mask_distance_based": _bench_randomize_randomization,
+    "landmark_utils.randomize_mask_distance_based": _bench_randomize_landmark_utils,
+    "combine_and_save_masks": _bench_combine_and_save_masks,
+    "find_medial_lateral_lowest": _bench_find_medial_lateral_lowest,
+}
+
+
+# Whole `python cli.py ...` invocations (interpreter start, imports and work), timed
+# from outside; "{name}" fields are filled from the phantom inputs and a scratch dir
+STARTUP_COMMANDS = {
+    "cli --help": ["--help"],
+    "cli landmarks": ["landmarks", "{tibia}", "-o", "{out}/landmarks"],
+    "cli segment (cache hit)": ["segment", "{ct}", "-o", "{out}/segment", "--cache", "--cache-dir", "{out}/cache"],
+    "cli expand": ["expand", "{tibia}", "--mm", "2", "-o", "{out}/expand"],
+}
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def _run_one(name, inputs, repeats, queue):
+    """
+    Child process body: set up the stage, then time `repeats` runs.
+    """
+    # Pipeline progress lines go to a scratch buffer instead of the terminal
+    with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryDirectory() as out_dir:
+        run = BENCHMARKS[name](inputs, out_dir)
+        rss_before = _peak_rss_mb()
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - t0)
+        queue.put({"times": times, "peak_rss_delta_mb": _peak_rss_mb() - rss_before,
+                   "peak_rss_mb": _peak_rss_mb()})
+
+
+def prepare_inputs(size: int, spacing, work_dir: str) -> dict:
+    """
+    Write the phantom CT and its segmentation for one cubic size.
+    """
+    from segmentation import segment_bones
+
+    case_dir = os.path.join(work_dir, f"phantom_{size}")
+    ct = write_knee_phantom(os.path.join(case_dir, "ct.nii.gz"), shape=(size,) * 3, spacing=spacing)
+    with contextlib.redirect_stdout(io.StringIO()):
+        segment_bones(ct, output_dir=case_dir)
+    return {
+        "ct": ct,
+        "tibia": os.path.join(case_dir, "mask_tibia.nii.gz"),
+        "femur": os.path.join(case_dir, "mask_femur.nii.gz"),
+    }
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, spacing=DEFAULT_SPACING, repeats=3, names=None, work_dir=None,
+                   startup: bool = False) -> dict:
+    names = list(BENCHMARKS) if names is None else names
+    ctx = mp.get_context("spawn")
+    results = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        for size in sizes:
+            inputs = prepare_inputs(size, spacing, tmp)
+            for name in names:
+                queue = ctx.Queue()
+                proc = ctx.Process(target=_run_one, args=(name, inputs, repeats, queue))
+                proc.start()
+                proc.join()
+                if proc.exitcode != 0:
+                    print(f"❌ {name} @ {size}³ failed (exit code {proc.exitcode})")
+                    continue
+                res = queue.get()
+                times = res.pop("times")
+                voxels = size ** 3
+                row = {
+                    "benchmark": name, "size": size, "voxels": voxels, "spacing": list(spacing),
+                    "repeats": repeats, "times_s": times, "best_s": min(times),
+                    "median_s": float(np.median(times)), "voxels_per_s": voxels / min(times), **res,
+                }
+                results.append(row)
+                print(f"⏱ {name:48s} {size:5d}³  best {row['best_s']:8.3f} s  "
+                      f"peak Δ {row['peak_rss_delta_mb']:8.1f} MB")
+            if startup:
+                results.extend(run_startup(inputs, size, repeats))
+    return {"meta": _meta(), "results": results}
+
+
+def run_startup(inputs: dict, size: int, repeats: int = 3) -> list:
+    """
+    Best wall time of each STARTUP_COMMANDS invocation in a fresh interpreter.
+    One untimed run first fills the stage cache for the cache-hit command.
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as out:
+        fields = dict(inputs, out=out)
+        for name, argv in STARTUP_COMMANDS.items():
+            cmd = [sys.executable, os.path.join(CODE_DIR, "cli.py")] + [a.format(**fields) for a in argv]
+            subprocess.run(cmd, cwd=CODE_DIR, capture_output=True, check=True)
+            times = []
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                subprocess.run(cmd, cwd=CODE_DIR, capture_output=True, check=True)
+                times.append(time.perf_counter() - t0)
+            rows.append({
+                "benchmark": f"startup: {name}", "size": size, "voxels": size ** 3, "repeats": repeats,
+                "times_s": times, "best_s": min(times), "median_s": float(np.median(times)),
+            })
+            print(f"⏱ {'startup: ' + name:48s} {size:5d}³  best {min(times):8.3f} s")
+    return rows
+
+
+def _meta() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        commit = ""
+    import scipy
+    import SimpleITK as sitk
+    from distance_map import EDT_BACKEND
+    from edt import EDT_WORKERS
+
+    return {
+        "commit": commit, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(), "platform": platform.platform(),
+        "cpu_count": os.cpu_count(), "numpy": np.__version__, "scipy": scipy.__version__,
+        "simpleitk": sitk.Version_VersionString(),
+        "edt_backend": EDT_BACKEND, "edt_workers": EDT_WORKERS,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float = 1.2) -> bool:
+    """
+    Print best-time ratios against a baseline run.
+
+    Returns:
+        bool: True if any stage is slower than `threshold` × baseline.
+    """
+    base = {(r["benchmark"], r["size"]): r for r in baseline["results"]}
+    regressed = False
+    for row in current["results"]:
+        ref = base.get((row["benchmark"], row["size"]))
+        if ref is None:
+            continue
+        ratio = row["best_s"] / ref["best_s"]
+        flag = "⚠️ REGRESSION" if ratio > threshold else ""
+        regressed |= ratio > threshold
+        print(f"{row['benchmark']:48s} {row['size']:5d}³  {ratio:6.2f}× baseline {flag}")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic knee phantoms.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Cubic phantom sizes in voxels (up to 1024)")
+    parser.add_argument("--spacing", type=float, nargs=3, default=list(DEFAULT_SPACING),
+                        help="Voxel spacing x y z in mm")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Run a subset of stages")
+    parser.add_argument("--out", default="benchmark_results.json", help="JSON output path")
+    parser.add_argument("--compare", help="Baseline JSON from an earlier commit")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Regression ratio for --compare")
+    parser.add_argument("--work-dir", help="Where to put phantom files (default: system temp)")
+    parser.add_argument("--startup", action="store_true",
+                        help="Also time whole cli.py invocations (start-up plus work)")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, tuple(args.spacing), args.repeats, args.only, args.work_dir,
+                            startup=args.startup)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Benchmark results saved to: {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            sys.exit(1 if compare(report, json.load(f), args.threshold) else 0)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+bone_separation.py
+Femur/tibia separation of the closed bone mask by connected components. One
+labeling pass (SimpleITK ConnectedComponent) is followed by one shape-statistics
+pass that gives every component's size, bounding box and centroid together. The
+two largest components are the femur (superior: lower z) and the tibia; smaller
+pieces (patella, fibula, fragments) go to the bone on their side of the joint gap.
+
+Per-bone statistics (label, voxel count, volume, bounding box, centroid) are
+aggregated from the component table, so later stages get each bone's ROI without
+scanning the label array again (see bone_mask). If the closing has fused the
+bones into one component, they are split at the narrowest slice (smallest bone
+cross-section, i.e. the joint) within SPLIT_WINDOW_MM of the fixed plane used
+before.
+"""
+
+import SimpleITK as sitk
+import numpy as np
+
+from roi import paste_volume
+from volume import as_volume, mask_dtype, match_input
+
+TIBIA_LABEL = 1
+FEMUR_LABEL = 2
+BONE_LABELS = {"tibia": TIBIA_LABEL, "femur": FEMUR_LABEL}
+# The second-largest component must reach this fraction of the largest to be a
+# bone; otherwise femur and tibia are taken to be fused
+MIN_BONE_FRACTION = 0.2
+# Search range (mm) around split_plane for the joint of fused bones
+SPLIT_WINDOW_MM = 20.0
+# Changes whenever the label assignment changes, so cached segmentations are not reused
+SEPARATION_VERSION = "components-v1"
+
+
+def split_plane(shape) -> int:
+    """
+    Fixed femur/tibia split slice on the full grid (femur at z < plane): the
+    center of the joint search for fused bones.
+    """
+    return shape[0] // 2 - 5
+
+
+def joint_slice(closed: np.ndarray, offset=(0, 0, 0), shape=None, spacing=(1.0, 1.0, 1.0)) -> int:
+    """
+    Full-grid slice at which to split fused bones: the middle of the run of
+    slices with the fewest bone voxels within SPLIT_WINDOW_MM of split_plane.
+    """
+    shape = shape or closed.shape
+    plane = split_plane(shape) - offset[0]
+    window = int(round(SPLIT_WINDOW_MM / spacing[2]))
+    lo, hi = max(plane - window, 0), min(plane + window + 1, closed.shape[0])
+    if lo >= hi:
+        return split_plane(shape)
+    counts = np.count_nonzero(closed[lo:hi], axis=(1, 2))
+    narrowest = np.flatnonzero(counts == counts.min())
+    return offset[0] + lo + int(narrowest[len(narrowest) // 2])
+
+
+def _shape_stats(labels: np.ndarray, offset) -> list:
+    """
+    Size, bounding box and centroid of every nonzero label in one pass.
+    """
+    image = labels if isinstance(labels, sitk.Image) else sitk.GetImageFromArray(labels)
+    shape = sitk.LabelShapeStatisticsImageFilter()
+    shape.ComputePerimeterOff()
+    shape.Execute(image)
+    oz, oy, ox = offset
+    stats = []
+    for label in shape.GetLabels():
+        x, y, z, sx, sy, sz = shape.GetBoundingBox(label)
+        # Unit spacing and zero origin, so the centroid is in voxel indices
+        cx, cy, cz = shape.GetCentroid(label)
+        stats.append({
+            "id": int(label),
+            "voxels": int(shape.GetNumberOfPixels(label)),
+            "box": (slice(oz + z, oz + z + sz), slice(oy + y, oy + y + sy), slice(ox + x, ox + x + sx)),
+            "centroid": (ox + cx, oy + cy, oz + cz),
+        })
+    return stats
+
+
+def component_stats(closed: np.ndarray, offset=(0, 0, 0)):
+    """
+    Connected components (face connectivity) of a binary [Z, Y, X] array.
+
+    Args:
+        closed (np.ndarray): Binary mask, possibly an ROI crop.
+        offset: (z, y, x) position of the crop in the full grid.
+
+    Returns:
+        (components, stats): uint32 component ids shaped like `closed`, and one dict
+            per component ("id", "voxels", "box" as (z, y, x) slices and "centroid"
+            as an (x, y, z) voxel index, both on the full grid), largest first.
+    """
+    cc = sitk.ConnectedComponent(sitk.GetImageFromArray(closed.astype(np.uint8, copy=False)))
+    stats = _shape_stats(cc, offset)
+    stats.sort(key=lambda c: (-c["voxels"], c["id"]))
+    return sitk.GetArrayFromImage(cc), stats
+
+
+def _bone(label: int, parts: list, voxel_mm3: float) -> dict:
+    voxels = sum(c["voxels"] for c in parts)
+    if not voxels:
+        return {"label": label, "voxels": 0, "volume_mm3": 0.0, "box": None, "centroid": None, "components": 0}
+    box = tuple(slice(min(c["box"][a].start for c in parts), max(c["box"][a].stop for c in parts))
+                for a in range(3))
+    weights = np.array([c["voxels"] for c in parts], dtype=float)
+    centroid = np.array([c["centroid"] for c in parts]).T @ weights / voxels
+    return {"label": label, "voxels": voxels, "volume_mm3": voxels * voxel_mm3, "box": box,
+            "centroid": tuple(float(v) for v in centroid), "components": len(parts)}
+
+
+def separate_bones(closed: np.ndarray, offset=(0, 0, 0), shape=None, spacing=(1.0, 1.0, 1.0)):
+    """
+    Label a closed bone mask 1=tibia, 2=femur.
+
+    Args:
+        closed (np.ndarray): Binary closed bone mask, possibly an ROI crop.
+        offset: (z, y, x) position of the crop in the full grid.
+        shape: Full grid shape (for the fallback split plane; default closed.shape).
+        spacing: Voxel spacing (x, y, z) in mm, for the bone volumes.
+
+    Returns:
+        (labeled, bones): uint8 label array shaped like `closed`, and a dict with
+            "tibia" and "femur" statistics ("label", "voxels", "volume_mm3", "box",
+            "centroid", "components"; full-grid coordinates) plus "method"
+            ("components", or "joint_slice" for fused bones) and "split_z" (the
+            split slice, for fused bones only).
+    """
+    shape = shape or closed.shape
+    voxel_mm3 = float(np.prod(spacing))
+    components, stats = component_stats(closed, offset)
+
+    if len(stats) >= 2 and stats[1]["voxels"] >= MIN_BONE_FRACTION * stats[0]["voxels"]:
+        femur, tibia = sorted(stats[:2], key=lambda c: c["centroid"][2])
+        # Smaller pieces go to the bone on their side of the middle of the joint gap
+        gap = (femur["box"][0].stop + tibia["box"][0].start) / 2
+        parts = {TIBIA_LABEL: [], FEMUR_LABEL: []}
+        lut = np.zeros(len(stats) + 1, dtype=np.uint8)
+        for c in stats:
+            if c is femur or c is tibia:
+                label = FEMUR_LABEL if c is femur else TIBIA_LABEL
+            else:
+                label = FEMUR_LABEL if c["centroid"][2] < gap else TIBIA_LABEL
+            lut[c["id"]] = label
+            parts[label].append(c)
+        labeled = lut[components]
+        extra = {"method": "components"}
+    else:
+        # Fused (or missing) bones: split at the joint, statistics from the two labels
+        split_z = joint_slice(closed, offset, shape, spacing)
+        labeled = (closed > 0).astype(np.uint8)
+        labeled[:min(max(split_z - offset[0], 0), labeled.shape[0])] *= 2
+        parts = {TIBIA_LABEL: [], FEMUR_LABEL: []}
+        for c in _shape_stats(labeled, offset):
+            parts[c["id"]].append(c)
+        extra = {"method": "joint_slice", "split_z": split_z}
+
+    bones = {name: _bone(label, parts[label], voxel_mm3) for name, label in BONE_LABELS.items()}
+    bones.update(extra)
+    return labeled, bones
+
+
+def bones_to_json(bones: dict) -> dict:
+    """
+    JSON-serializable copy of segment_bones' `bones` (boxes as [start, stop] pairs).
+    """
+    out = dict(bones)
+    for name in BONE_LABELS:
+        bone = dict(bones[name])
+        if bone["box"] is not None:
+            bone["box"] = [[sl.start, sl.stop] for sl in bone["box"]]
+        out[name] = bone
+    return out
+
+
+def bones_from_json(obj: dict) -> dict:
+    """
+    Inverse of bones_to_json.
+    """
+    bones = dict(obj)
+    for name in BONE_LABELS:
+        bone = dict(obj[name])
+        if bone["box"] is not None:
+            bone["box"] = tuple(slice(a, b) for a, b in bone["box"])
+        if bone["centroid"] is not None:
+            bone["centroid"] = tuple(bone["centroid"])
+        bones[name] = bone
+    return bones
+
+
+def bone_mask(labeled, bone: dict):
+    """
+    Binary mask of one bone from a labeled mask, reading only the bone's box.
+
+    Args:
+        labeled: Labeled mask (sitk.Image or Volume), e.g. from segment_bones.
+        bone (dict): Its entry in segment_bones' `bones` (e.g. bones["tibia"]).
+
+    Returns:
+        Mask of the same type as `labeled`.
+    """
+    vol = as_volume(labeled)
+    if bone["box"] is None:
+        return match_input(labeled, vol.like(np.zeros(vol.shape, dtype=mask_dtype())))
+    sub = (vol.array[bone["box"]] == bone["label"]).astype(mask_dtype())
+    return match_input(labeled, paste_volume(vol, bone["box"], sub))
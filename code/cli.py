@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+cli.py
+Single command-line entry point for the pipeline stages. Only argparse is loaded to
+parse the command line; each subcommand imports what it needs when it runs, so
+SciPy is only loaded by the stages that compute distance maps and matplotlib only
+by `render`. Landmark-only and cache-hit runs therefore skip most of the import cost.
+
+Usage (from the code/ directory):
+    python cli.py segment <ct> [-o results] [--cache | --streaming]
+    python cli.py expand <mask> --mm 2 4 [-o results] [--cache]
+    python cli.py randomize <mask> --max-mm 2 --seeds 1 2 [--case-id ID] [-o results] [--cache]
+    python cli.py landmarks <mask> [<mask> ...] [-o results] [--variants] [--cache]
+    python cli.py metrics <original_mask> <variant> [<variant> ...] [-o results]
+    python cli.py render <ct> <mask> -o overlay.png | render --cohort <cohort_dir>
+    python cli.py batch <ct_dir_or_manifest> <output_dir> [--workers N | --prefetch K] [--cache]
+
+--cache keys every stage on its input content and parameters in --cache-dir
+(default .stage_cache), so sweeps over radii, seeds or thresholds reuse the
+segmentation and distance maps of earlier runs.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+
+def _stem(path: str) -> str:
+    name = os.path.basename(path)
+    for suffix in (".mask.npz", ".nii.gz", ".nii"):
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def _read_mask(path: str):
+    from mask_io import read_mask
+
+    return read_mask(path)
+
+
+def _cache(args):
+    if not args.cache:
+        return None
+    from stage_cache import StageCache
+
+    return StageCache(args.cache_dir)
+
+
+def _write_masks(masks: dict, output_dir: str, fmt: str, compresslevel: int):
+    from mask_io import MaskWriter, mask_filename
+
+    os.makedirs(output_dir, exist_ok=True)
+    with MaskWriter(compresslevel=compresslevel) as writer:
+        for stem, mask in masks.items():
+            path = os.path.join(output_dir, mask_filename(stem, fmt))
+            writer.submit(mask, path)
+            print(f"✅ Saved {path}")
+
+
+def cmd_segment(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.cache:
+        from stage_cache import cached_segment_bones
+
+        cached_segment_bones(args.ct, args.output_dir, _cache(args),
+                             lower_threshold=args.lower, upper_threshold=args.upper)
+    elif args.streaming:
+        from segmentation import segment_bones_streaming
+
+        segment_bones_streaming(args.ct, args.output_dir, lower_threshold=args.lower, upper_threshold=args.upper)
+    else:
+        from segmentation import segment_bones
+
+        segment_bones(args.ct, args.output_dir, lower_threshold=args.lower, upper_threshold=args.upper)
+
+
+def cmd_expand(args):
+    mask = _read_mask(args.mask)
+    stem = _stem(args.mask)
+    cache = _cache(args)
+    if cache is not None:
+        from stage_cache import cached_expand_mask_by_mm
+
+        masks = {f"{stem}_expanded_{mm:g}mm": cached_expand_mask_by_mm(mask, mm, cache) for mm in args.mm}
+    else:
+        from distance_map import get_distance_map
+
+        dmap = get_distance_map(mask, max_mm=max(args.mm))
+        masks = {f"{stem}_expanded_{mm:g}mm": dmap.expand(mm) for mm in args.mm}
+    _write_masks(masks, args.output_dir, args.format, args.compresslevel)
+
+
+def cmd_randomize(args):
+    mask = _read_mask(args.mask)
+    stem = _stem(args.mask)
+    # With a case id every (case, mask, seed) draws from its own stream
+    key = (args.case_id, stem) if args.case_id else None
+    cache = _cache(args)
+    if cache is not None and not args.labels:
+        from stage_cache import cached_randomize_mask_distance_based
+
+        def randomize(seed):
+            return cached_randomize_mask_distance_based(mask, args.max_mm, seed, cache, key=key)
+    else:
+        if args.labels:
+            from distance_map import get_label_distance_map
+
+            dmap = get_label_distance_map(mask, max_mm=args.max_mm)
+        else:
+            from distance_map import get_distance_map
+
+            dmap = get_distance_map(mask, max_mm=args.max_mm)
+
+        def randomize(seed):
+            return dmap.randomize(args.max_mm, seed=seed, key=key)
+    masks = {f"{stem}_random_{seed}": randomize(seed) for seed in args.seeds}
+    _write_masks(masks, args.output_dir, args.format, args.compresslevel)
+
+
+def cmd_landmarks(args):
+    if args.variants:
+        from run_landmark_pipeline import run_landmark_detection
+
+        if len(args.masks) != 1:
+            sys.exit("--variants takes exactly one tibia mask")
+        run_landmark_detection(args.masks[0], None, args.output_dir, mask_format=args.format,
+                               case_id=args.case_id, cache=_cache(args))
+        return
+
+    from landmark_store import LANDMARK_DB_NAME, LANDMARK_TSV_NAME, LandmarkStore, write_landmarks_tsv
+
+    case_id = args.case_id or os.path.basename(os.path.abspath(args.output_dir))
+    masks = {_stem(path): _read_mask(path) for path in args.masks}
+    cache = _cache(args)
+    if cache is not None:
+        from landmark_store import landmark_record
+        from landmark_utils import voxel_to_phys
+        from stage_cache import cached_find_medial_lateral_lowest
+
+        records = []
+        for name, mask in masks.items():
+            medial, lateral = cached_find_medial_lateral_lowest(mask, cache)
+            records.append(landmark_record(case_id, name, medial, lateral,
+                                           voxel_to_phys(mask, medial), voxel_to_phys(mask, lateral)))
+    else:
+        from landmark_utils import measure_landmarks
+
+        records = measure_landmarks(case_id, masks)
+    os.makedirs(args.output_dir, exist_ok=True)
+    with LandmarkStore(os.path.join(args.output_dir, LANDMARK_DB_NAME)) as store:
+        store.extend(records)
+    path = write_landmarks_tsv(os.path.join(args.output_dir, LANDMARK_TSV_NAME), records)
+    print(f"✅ Landmark coordinates saved to: {path}")
+
+
+def cmd_metrics(args):
+    from mask_metrics import METRICS_TSV_NAME, metric_records, write_metrics_tsv
+
+    case_id = args.case_id or os.path.basename(os.path.abspath(args.output_dir))
+    variants = {_stem(path): _read_mask(path) for path in args.variants}
+    records = metric_records(case_id, _read_mask(args.original), variants)
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = write_metrics_tsv(os.path.join(args.output_dir, METRICS_TSV_NAME), records)
+    print(f"✅ Mask metrics saved to: {path}")
+
+
+def cmd_render(args):
+    if args.cohort:
+        from qa_render import render_cohort
+
+        render_cohort(args.cohort, workers=args.workers, sheet_plane=args.plane)
+        return
+    if not (args.ct and args.mask and args.output):
+        sys.exit("render needs <ct> <mask> -o <png>, or --cohort <dir>")
+    from qa_render import LABEL_COLORS, render_overlay
+
+    colors = LABEL_COLORS if args.labels else None
+    print(f"✅ Saved {render_overlay(args.ct, args.mask, args.output, plane=args.plane, colors=colors)}")
+
+
+def cmd_batch(args):
+    from batch import run_cohort
+
+    run_cohort(args.source, args.output_dir, workers=args.workers, prefetch=args.prefetch,
+               cache_dir=args.cache_dir if args.cache else None, profile=args.profile)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cli.py", description="Knee CT segmentation and landmark pipeline.")
+    parser.add_argument("--timing", action="store_true", help="Print the command's wall time to stderr")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    cache_opts = argparse.ArgumentParser(add_help=False)
+    cache_opts.add_argument("--cache", action="store_true", help="Reuse results from the stage cache")
+    cache_opts.add_argument("--cache-dir", default=".stage_cache")
+
+    p = sub.add_parser("segment", parents=[cache_opts], help="Segment tibia and femur from a CT")
+    p.add_argument("ct", help="CT NIfTI file")
+    p.add_argument("-o", "--output-dir", default="results")
+    p.add_argument("--lower", type=float, default=260, help="Lower bone threshold (HU)")
+    p.add_argument("--upper", type=float, default=3000, help="Upper bone threshold (HU)")
+    p.add_argument("--streaming", action="store_true",
+                   help="Process the CT in z-slabs (bounded memory; not cached, so not with --cache)")
+    p.set_defaults(func=cmd_segment)
+
+    mask_output = argparse.ArgumentParser(add_help=False)
+    mask_output.add_argument("-o", "--output-dir", default="results")
+    mask_output.add_argument("--format", default="nii.gz", choices=("nii.gz", "nii", "compact"))
+    mask_output.add_argument("--compresslevel", type=int, default=6, help="gzip level for .nii.gz")
+
+    p = sub.add_parser("expand", parents=[mask_output, cache_opts], help="Grow a binary mask by fixed radii")
+    p.add_argument("mask")
+    p.add_argument("--mm", type=float, nargs="+", required=True, help="Radii in mm")
+    p.set_defaults(func=cmd_expand)
+
+    p = sub.add_parser("randomize", parents=[mask_output, cache_opts], help="Grow a mask by random radii up to --max-mm")
+    p.add_argument("mask")
+    p.add_argument("--max-mm", type=float, required=True)
+    p.add_argument("--seeds", type=int, nargs="+", default=[1])
+    p.add_argument("--labels", action="store_true",
+                   help="Randomize each label of a labeled mask separately (not cached)")
+    p.add_argument("--case-id", default=None,
+                   help="Draw from the keyed stream (seed, case id, mask) instead of the legacy per-seed draw")
+    p.set_defaults(func=cmd_randomize)
+
+    p = sub.add_parser("landmarks", parents=[cache_opts], help="Medial/lateral tibial landmarks of masks")
+    p.add_argument("masks", nargs="+", help="Tibia mask file(s); the Mask column is the file name")
+    p.add_argument("-o", "--output-dir", default="results")
+    p.add_argument("--case-id", default=None, help="Case id in the landmark store (default: output dir name)")
+    p.add_argument("--variants", action="store_true",
+                   help="Also build the expanded/randomized variants of the mask (run_landmark_pipeline)")
+    p.add_argument("--format", default="nii.gz", choices=("nii.gz", "nii", "compact"),
+                   help="Variant mask format with --variants")
+    p.set_defaults(func=cmd_landmarks)
+
+    p = sub.add_parser("metrics", help="Dice, volume change and surface distances of variants vs. a mask")
+    p.add_argument("original", help="Reference mask")
+    p.add_argument("variants", nargs="+", help="Masks on the same grid; the Mask column is the file name")
+    p.add_argument("-o", "--output-dir", default="results")
+    p.add_argument("--case-id", default=None)
+    p.set_defaults(func=cmd_metrics)
+
+    p = sub.add_parser("render", help="Overlay PNG of a mask on a CT, or QA figures for a cohort")
+    p.add_argument("ct", nargs="?")
+    p.add_argument("mask", nargs="?")
+    p.add_argument("-o", "--output", help="PNG path")
+    p.add_argument("--plane", default="coronal", choices=("coronal", "sagittal", "axial"))
+    p.add_argument("--labels", action="store_true", help="Color tibia/femur labels")
+    p.add_argument("--cohort", help="batch.py output directory to render instead")
+    p.add_argument("--workers", type=int, default=None)
+    p.set_defaults(func=cmd_render)
+
+    p = sub.add_parser("batch", parents=[cache_opts], help="Run the pipeline over a CT cohort")
+    p.add_argument("source", help="Directory of CT files or a text manifest of paths")
+    p.add_argument("output_dir")
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--prefetch", type=int, default=0,
+                   help="Single-process read/compute/write pipeline decoding this many CTs ahead")
+    p.add_argument("--profile", action="store_true", default=None,
+                   help="Write per-case and cohort stage reports (also: KNEE_PROFILE=1)")
+    p.set_defaults(func=cmd_batch)
+    return parser
+
+
+def main(argv=None):
+    t0 = time.perf_counter()
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "segment" and args.cache and args.streaming:
+        parser.error("segment: --streaming cannot be combined with --cache")
+    args.func(args)
+    if args.timing:
+        print(f"⏱ {args.command}: {time.perf_counter() - t0:.3f} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
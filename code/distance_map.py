@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+distance_map.py
+Shared Euclidean distance map for a binary mask. One transform per mask answers
+"mask grown by r mm" for any number of radii and random seeds by thresholding.
+The transform is restricted to the mask bounding box plus the largest radius.
+Distances can be held as float64, float32 or uint16 in units of 0.01 mm.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import scipy.ndimage as ndi
+
+from edt import distance_transform
+from rng_streams import uniform
+from roi import bounding_box, bounding_box_within, box_shape, margin_voxels, pad_box, paste_array, paste_volume
+import volume
+from volume import array_view, as_volume, mask_digest, mask_dtype, match_input
+
+# Distance transform backend for binary masks: "scipy" or "sitk" (see edt.py)
+EDT_BACKEND = os.environ.get("KNEE_EDT_BACKEND", "scipy")
+
+# Storage dtype of distance maps: "float64", "float32" or "uint16" (multiples of
+# MM_QUANTUM). Unset: float32 in compact mode, else float64.
+DISTANCE_DTYPES = ("float64", "float32", "uint16")
+DISTANCE_DTYPE = os.environ.get("KNEE_DISTANCE_DTYPE")
+MM_QUANTUM = 0.01
+_QUANTA_PER_MM = 100
+_UINT16_MAX = np.iinfo(np.uint16).max
+
+
+def default_distance_dtype() -> str:
+    return DISTANCE_DTYPE or ("float32" if volume.COMPACT else "float64")
+
+
+def narrow_distance(distance: np.ndarray, dtype: str) -> np.ndarray:
+    """
+    Convert a float64 distance map (mm) to the storage dtype, rounding up so a
+    narrowed map never places a voxel closer than it is. uint16 holds
+    ceil(d / 0.01 mm), saturating at 65535 (655.35 mm and unreachable voxels).
+    """
+    if dtype not in DISTANCE_DTYPES:
+        raise ValueError(f"Unknown distance dtype '{dtype}', expected one of {DISTANCE_DTYPES}")
+    if dtype == "float64":
+        return distance
+    if dtype == "float32":
+        narrow = distance.astype(np.float32)
+        low = narrow < distance
+        narrow[low] = np.nextafter(narrow[low], np.float32(np.inf))
+        return narrow
+    q = np.ceil(distance * _QUANTA_PER_MM)
+    np.minimum(q, _UINT16_MAX, out=q)
+    return q.astype(np.uint16)
+
+
+def distance_limit(distance: np.ndarray, mm):
+    """
+    Threshold(s) `mm` in the units of `distance`, so that `distance <= limit`
+    selects voxels within `mm` millimeters. Accepts scalars and arrays.
+
+    With rounded-up storage this never selects a voxel farther than `mm`; it can
+    miss voxels within one float32 ulp (float32) or 0.01 mm (uint16) of `mm`.
+    """
+    if distance.dtype != np.uint16:
+        # float64 so a float32 map is not compared against a rounded radius
+        return np.asarray(mm, dtype=np.float64)
+    q = np.floor(np.asarray(mm, dtype=np.float64) * _QUANTA_PER_MM)
+    # Saturated voxels (>= 655.35 mm) are never inside
+    return np.clip(q, 0, _UINT16_MAX - 1).astype(np.uint16)
+
+
+def distance_mm(distance: np.ndarray) -> np.ndarray:
+    """
+    Stored distances (any storage dtype) as float64 millimeters.
+    """
+    if distance.dtype == np.uint16:
+        return distance / float(_QUANTA_PER_MM)
+    return distance.astype(np.float64, copy=False)
+
+
+class DistanceMap:
+    """
+    Distance (in mm) from every background voxel to the nearest foreground voxel
+    of a binary mask. Foreground voxels have distance 0.
+
+    The transform only covers the mask bounding box padded by the largest radius
+    requested so far; asking for a larger radius rebuilds it with a wider margin.
+    Voxels outside that box are farther than the margin, so thresholds are exact.
+
+    Accepts a sitk.Image or a Volume; derived masks are returned as the same type.
+    `backend` selects the distance transform (default: EDT_BACKEND) and `dtype`
+    how distances are stored (default: default_distance_dtype()). In compact
+    mode the mask crop is kept bit-packed. A `box` known to contain the mask
+    (e.g. a bone box from segment_bones) limits the bounding-box search to it.
+
+    A map can be shared between threads: the ROI (box, distance, max_mm) is
+    replaced as one tuple under a lock, only ever widened, and its arrays are
+    never written to. Methods work on the snapshot returned by ensure().
+    """
+
+    def __init__(self, mask, max_mm: float = None, backend: str = None, dtype: str = None, box=None):
+        self.reference = mask
+        self.backend = backend or EDT_BACKEND
+        self.dtype = dtype or default_distance_dtype()
+        self.shape = mask.GetSize()[::-1]
+        # SimpleITK spacing is (x, y, z); NumPy arrays are indexed [z, y, x]
+        self.spacing = mask.GetSpacing()
+        arr = array_view(mask)
+        self.mask_box = bounding_box(arr) if box is None else bounding_box_within(arr, box)
+        self._store_core(arr[self.mask_box] > 0 if self.mask_box is not None else None)
+        self._lock = threading.Lock()
+        self._roi = (None, None, None)
+        if max_mm is not None:
+            self.ensure(max_mm)
+
+    @property
+    def box(self):
+        return self._roi[0]
+
+    @property
+    def distance(self) -> np.ndarray:
+        return self._roi[1]
+
+    @property
+    def max_mm(self) -> float:
+        return self._roi[2]
+
+    def _store_core(self, core: np.ndarray):
+        self._core_shape = core.shape if core is not None else None
+        self._core = np.packbits(core) if core is not None and volume.COMPACT else core
+
+    def core(self) -> np.ndarray:
+        """
+        Mask contents inside mask_box (unpacked if held bit-packed).
+        """
+        if self._core is None or self._core.shape == self._core_shape:
+            return self._core
+        n = int(np.prod(self._core_shape))
+        return np.unpackbits(self._core, count=n).reshape(self._core_shape).view(bool)
+
+    def ensure(self, mm: float):
+        """
+        Make sure the transform covers a growth of `mm` millimeters.
+
+        Returns:
+            tuple: The ROI (box, distance, max_mm) covering `mm`; it stays valid
+                when another thread widens the map afterwards.
+        """
+        roi = self._roi
+        if self.mask_box is None or (roi[2] is not None and mm <= roi[2]):
+            return roi
+        with self._lock:
+            roi = self._roi
+            if roi[2] is None or mm > roi[2]:
+                roi = self._roi = self._transform(mm)
+        return roi
+
+    def _transform(self, mm: float) -> tuple:
+        box = pad_box(self.mask_box, self.shape, margin_voxels(self.spacing, mm))
+        sub = np.zeros(box_shape(box), dtype=bool)
+        inner = tuple(slice(m.start - b.start, m.stop - b.start) for m, b in zip(self.mask_box, box))
+        sub[inner] = self.core()
+        distance = distance_transform(~sub, self.spacing[::-1], backend=self.backend)
+        return box, narrow_distance(distance, self.dtype), mm
+
+    def within(self, mm) -> np.ndarray:
+        """
+        Boolean ROI crop of voxels within `mm` millimeters of the mask.
+        """
+        distance = self.ensure(mm)[1]
+        return distance <= distance_limit(distance, mm)
+
+    def restore(self, box, distance: np.ndarray, max_mm: float):
+        """
+        Reinstate a previously computed ROI transform (e.g. from an on-disk cache).
+        """
+        with self._lock:
+            self._roi = (box, distance, max_mm)
+
+    def grown_crop(self, mm: float):
+        """
+        Mask grown by `mm` millimeters, restricted to the ROI.
+
+        Returns:
+            (box, np.ndarray): ROI box in the full grid and the boolean crop.
+        """
+        if self.mask_box is None:
+            return None, None
+        box, distance, _ = self.ensure(mm)
+        return box, distance <= distance_limit(distance, mm)
+
+    def grown_array(self, mm: float) -> np.ndarray:
+        """
+        Full-size boolean array of the mask grown by `mm` millimeters.
+        """
+        box, sub = self.grown_crop(mm)
+        if box is None:
+            return np.zeros(self.shape, dtype=bool)
+        return paste_array(self.shape, box, sub)
+
+    def expand(self, mm: float, reference=None):
+        """
+        Mask grown by `mm` millimeters (true physical distance), of the type of
+        `reference` (default: the mask the map was built from; any image with the
+        same grid, e.g. the caller's copy of a cached mask).
+        """
+        reference = self.reference if reference is None else reference
+        box, sub = self.grown_crop(mm)
+        if box is None:
+            return self._output(np.zeros(self.shape, dtype=mask_dtype()), reference)
+        return match_input(reference, paste_volume(reference, box, sub.astype(mask_dtype(), copy=False)))
+
+    def randomize(self, max_mm: float, seed=None, key=None, reference=None):
+        """
+        Mask grown by a random distance drawn uniformly from [0, max_mm].
+        With `key` (e.g. (case_id, variant)) the draw comes from the independent
+        stream (seed, key) of rng_streams; without it, from RandomState(seed).
+        """
+        r_mm = float(uniform(seed, key, max_mm))
+        self.ensure(max_mm)
+        return self.expand(r_mm, reference=reference)
+
+    def _output(self, arr: np.ndarray, reference=None):
+        reference = self.reference if reference is None else reference
+        return match_input(reference, as_volume(reference).like(arr))
+
+
+class LabelDistanceMap(DistanceMap):
+    """
+    Distance map of a labeled image carrying, for every voxel, the label of the
+    nearest foreground voxel. One transform serves all labels: each label can be
+    grown by its own radius, and where growing bones meet, each voxel goes to the
+    nearest bone among those whose radius reaches it (ties broken
+    deterministically by the transform's index choice).
+
+    With equal radii the shared transform answers everything. With per-label
+    radii, a voxel that its nearest bone does not reach may still be reached by a
+    bone with a larger radius; only such voxels are resolved again, one transform
+    per larger radius level, restricted to a box around them.
+    """
+
+    def __init__(self, labeled, max_mm: float = None, dtype: str = None):
+        self.reference = labeled
+        self.dtype = dtype or default_distance_dtype()
+        self.shape = labeled.GetSize()[::-1]
+        self.spacing = labeled.GetSpacing()
+        arr = array_view(labeled)
+        self.mask_box = bounding_box(arr)
+        # Labels need more than one bit, so the crop is never packed
+        self._core = arr[self.mask_box].copy() if self.mask_box is not None else None
+        self._core_shape = self._core.shape if self._core is not None else None
+        self.labels = np.unique(self._core[self._core > 0]) if self._core is not None else np.array([], arr.dtype)
+        self._lock = threading.Lock()
+        # (box, distance, max_mm, nearest_label), see DistanceMap
+        self._roi = (None, None, None, None)
+        if max_mm is not None:
+            self.ensure(max_mm)
+
+    @property
+    def nearest_label(self) -> np.ndarray:
+        return self._roi[3]
+
+    def _transform(self, mm: float) -> tuple:
+        box = pad_box(self.mask_box, self.shape, margin_voxels(self.spacing, mm))
+        distance, nearest_label = self._nearest(self._labels_in(box))
+        return box, narrow_distance(distance, self.dtype), mm, nearest_label
+
+    def _labels_in(self, box) -> np.ndarray:
+        """
+        Labeled crop of a box on the full grid (zero outside mask_box).
+        """
+        sub = np.zeros(box_shape(box), dtype=self._core.dtype)
+        src = tuple(slice(max(b.start, m.start), min(b.stop, m.stop)) for b, m in zip(box, self.mask_box))
+        if all(s.start < s.stop for s in src):
+            sub[tuple(slice(s.start - b.start, s.stop - b.start) for s, b in zip(src, box))] = \
+                self._core[tuple(slice(s.start - m.start, s.stop - m.start) for s, m in zip(src, self.mask_box))]
+        return sub
+
+    def _nearest(self, sub: np.ndarray):
+        """
+        Distance (mm, float64) to and label of the nearest labeled voxel of `sub`.
+        """
+        # Needs nearest-feature indices, which only SciPy's transform returns
+        distance, indices = ndi.distance_transform_edt(sub == 0, sampling=self.spacing[::-1], return_indices=True)
+        return distance, sub[tuple(indices)]
+
+    def restore(self, box, distance: np.ndarray, max_mm: float, nearest_label: np.ndarray = None):
+        with self._lock:
+            self._roi = (box, distance, max_mm, nearest_label)
+
+    def _radius_lut(self, radii) -> np.ndarray:
+        """
+        Per-label radius lookup table from a scalar or a {label: mm} dict.
+        Labels missing from the dict are not grown.
+        """
+        lut = np.zeros(int(self.labels.max()) + 1 if len(self.labels) else 1, dtype=float)
+        if isinstance(radii, dict):
+            for label, mm in radii.items():
+                if label < len(lut):
+                    lut[int(label)] = mm
+        else:
+            lut[self.labels] = radii
+        return lut
+
+    def grown_crop(self, radii):
+        """
+        Labeled crop with every label grown by its radius.
+
+        Args:
+            radii: Radius in mm for all labels, or {label: mm}.
+
+        Returns:
+            (box, np.ndarray): ROI box and the labeled crop.
+        """
+        if self.mask_box is None:
+            return None, None
+        lut = self._radius_lut(radii)
+        box, distance, _, nearest_label = self.ensure(float(lut.max()))
+        limits = distance_limit(distance, lut)
+        grown = distance <= limits[nearest_label]
+        out = np.where(grown, nearest_label, 0).astype(self._core.dtype)
+        # Voxels the nearest bone does not reach but a bone with a larger radius might
+        pending = ~grown & (distance <= limits.max())
+        if pending.any():
+            self._resolve(box, out, pending, lut)
+        return box, out
+
+    def _resolve(self, box, out: np.ndarray, pending: np.ndarray, lut: np.ndarray):
+        """
+        Assign `pending` voxels of the ROI crop `out` to the nearest label whose
+        radius reaches them. Level by level over the distinct radii, the nearest
+        label among those with at least that radius either reaches a voxel (and is
+        then the nearest that does) or leaves it to the next level.
+        """
+        levels = np.unique(lut[self.labels])
+        for rho in levels[1:]:
+            zyx = np.nonzero(pending)
+            if not len(zyx[0]):
+                return
+            # Labels farther than the largest radius cannot reach a pending voxel
+            local = tuple(slice(int(c.min()), int(c.max()) + 1) for c in zyx)
+            local = pad_box(local, pending.shape, margin_voxels(self.spacing, float(lut.max())))
+            full = tuple(slice(b.start + s.start, b.start + s.stop) for b, s in zip(box, local))
+            sub = self._labels_in(full)
+            sub[lut[sub] < rho] = 0
+            distance, nearest = self._nearest(sub)
+            distance = narrow_distance(distance, self.dtype)
+            limits = distance_limit(distance, lut)
+            todo = pending[local]
+            reached = todo & (distance <= limits[nearest])
+            out[local][reached] = nearest[reached]
+            # Still pending: not reached by its nearest label at this level, but in range of a larger one
+            pending[local] = todo & ~reached & (distance <= limits.max())
+
+    def grown_array(self, radii) -> np.ndarray:
+        box, sub = self.grown_crop(radii)
+        if box is None:
+            return np.zeros(self.shape, dtype=self.labels.dtype)
+        return paste_array(self.shape, box, sub)
+
+    def expand(self, radii, reference=None):
+        """
+        Labeled image with each label grown by `radii` (mm, scalar or {label: mm}),
+        of the type of `reference` (see DistanceMap.expand).
+        """
+        return self._output(self.grown_array(radii), reference)
+
+    def randomize(self, max_mm, seed=None, key=None, reference=None):
+        """
+        Labeled image with each label grown by its own random distance in
+        [0, max_mm] (scalar or {label: mm}). Without `key` the draws are taken in
+        ascending label order from RandomState(seed); with it, each label draws from
+        its own stream (seed, key + (label,)), independent of the other labels.
+        """
+        lut = self._radius_lut(max_mm)
+        if key is None:
+            draws = uniform(seed, size=len(self.labels))
+        else:
+            draws = [uniform(seed, tuple(key) + (int(label),)) for label in self.labels]
+        radii = {int(label): float(u * lut[label]) for label, u in zip(self.labels, draws)}
+        self.ensure(float(lut.max()))
+        return self.expand(radii, reference=reference)
+
+
+_CACHE = OrderedDict()
+_CACHE_SIZE = 4
+_CACHE_LOCK = threading.Lock()
+
+
+def get_distance_map(mask, max_mm: float = None, box=None) -> DistanceMap:
+    """
+    Return the DistanceMap for `mask`, computing it only on first use.
+    Maps are cached by mask content, so the same mask read twice shares one map;
+    pass the mask as `reference=` to expand()/randomize() to get outputs of its
+    type rather than that of the mask the map was first built from.
+
+    Args:
+        mask (sitk.Image or Volume): Binary mask.
+        max_mm (float): Largest growth that will be requested, if known. Passing it
+            up front avoids rebuilding the ROI transform for a later, larger radius.
+        box: Optional box known to contain the mask (see DistanceMap).
+    """
+    return _cached(mask_digest(mask), DistanceMap, mask, max_mm, box=box)
+
+
+def get_label_distance_map(labeled, max_mm: float = None) -> LabelDistanceMap:
+    """
+    Return the cached LabelDistanceMap for a labeled image (see get_distance_map).
+    """
+    return _cached("labels:" + mask_digest(labeled), LabelDistanceMap, labeled, max_mm)
+
+
+def _cached(key, cls, image, max_mm, **kwargs):
+    with _CACHE_LOCK:
+        dmap = _CACHE.get(key)
+        if dmap is not None:
+            _CACHE.move_to_end(key)
+    if dmap is None:
+        # Built outside the lock; if another thread got there first, use its map
+        built = cls(image, **kwargs)
+        with _CACHE_LOCK:
+            dmap = _CACHE.setdefault(key, built)
+            _CACHE.move_to_end(key)
+            if len(_CACHE) > _CACHE_SIZE:
+                _CACHE.popitem(last=False)
+    if max_mm is not None:
+        dmap.ensure(max_mm)
+    return dmap
+
+
+def clear_cache():
+    """
+    Drop all cached distance maps.
+    """
+    with _CACHE_LOCK:
+        _CACHE.clear()
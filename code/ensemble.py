@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+ensemble.py
+Monte Carlo randomization ensemble. Draws N random expansion radii for one mask,
+finds the medial/lateral lowest tibial points of every randomized mask in a single
+vectorized pass over the shared distance map (no mask is materialized or written),
+and summarizes landmark uncertainty in voxels and millimeters.
+"""
+
+import SimpleITK as sitk
+import numpy as np
+
+from distance_map import distance_limit, get_distance_map
+from landmark_utils import voxel_to_phys_array
+from rng_streams import uniform
+
+
+def ensemble_landmarks(dmap, radii: np.ndarray):
+    """
+    Lowest medial/lateral points of the mask grown by each radius.
+
+    Reproduces find_medial_lateral_lowest on `dmap.expand(r)` for every r: the lowest
+    occupied slice, the extreme x on that slice, and the first y at that x.
+
+    Args:
+        dmap (DistanceMap): Distance map covering max(radii).
+        radii (np.ndarray): Growth radii in mm, shape (N,).
+
+    Returns:
+        (medial, lateral): integer arrays of shape (N, 3) with (x, y, z) indices.
+    """
+    radii = np.asarray(radii, dtype=float)
+    box, d, _ = dmap.ensure(float(radii.max()))
+    z0, y0, x0 = (sl.start for sl in box)
+    # Radii in the distance map's units (mm, or 0.01 mm steps for uint16 maps)
+    lim = distance_limit(d, radii)
+
+    # Per-slice and per-(z, x) column minima answer "is anything within r" for all r at once
+    slice_min = d.min(axis=(1, 2))                  # (Z,)
+    col_min = d.min(axis=1)                         # (Z, X)
+
+    occupied = slice_min[None, :] <= lim[:, None]  # (N, Z)
+    nz = occupied.shape[1]
+    z_low = nz - 1 - np.argmax(occupied[:, ::-1], axis=1)
+
+    cols = col_min[z_low] <= lim[:, None]          # (N, X)
+    nx = cols.shape[1]
+    x_lat = np.argmax(cols, axis=1)
+    x_med = nx - 1 - np.argmax(cols[:, ::-1], axis=1)
+
+    y_lat = np.argmax(d[z_low, :, x_lat] <= lim[:, None], axis=1)
+    y_med = np.argmax(d[z_low, :, x_med] <= lim[:, None], axis=1)
+
+    medial = np.stack([x_med + x0, y_med + y0, z_low + z0], axis=1)
+    lateral = np.stack([x_lat + x0, y_lat + y0, z_low + z0], axis=1)
+    return medial, lateral
+
+
+def _summary(points: np.ndarray, percentiles) -> dict:
+    return {
+        "mean": points.mean(axis=0).tolist(),
+        "std": points.std(axis=0).tolist(),
+        "percentiles": {
+            str(p): v.tolist() for p, v in zip(percentiles, np.percentile(points, percentiles, axis=0))
+        },
+    }
+
+
+def randomization_ensemble(mask: sitk.Image, max_mm: float, n: int, seed=None,
+                           percentiles=(5, 50, 95), return_samples=False, key=None) -> dict:
+    """
+    Landmark statistics over N random expansions of `mask` by r ~ U(0, max_mm).
+
+    Args:
+        mask (sitk.Image): Binary tibia mask.
+        max_mm (float): Maximum random expansion in mm.
+        n (int): Number of randomized masks.
+        seed (int): Optional seed for reproducibility.
+        key (tuple): Optional stream key (e.g. (case_id,)); sample i then draws from
+            the stream (seed, key + (i,)), so any subset of samples can be generated
+            separately (in other threads or processes) with the same radii.
+        percentiles: Percentiles to report per coordinate.
+        return_samples (bool): Also return radii and per-sample landmarks.
+
+    Returns:
+        dict: {"n", "max_mm", "medial": {"voxel": stats, "mm": stats}, "lateral": ...}
+        where stats holds per-axis mean, std and percentiles.
+    """
+    dmap = get_distance_map(mask, max_mm=max_mm)
+    if dmap.mask_box is None:
+        raise RuntimeError("Mask is empty.")
+    if key is None:
+        radii = uniform(seed, high=max_mm, size=n)
+    else:
+        radii = np.array([uniform(seed, tuple(key) + (i,), max_mm) for i in range(n)])
+    medial, lateral = ensemble_landmarks(dmap, radii)
+
+    result = {"n": int(n), "max_mm": float(max_mm)}
+    samples = {"radii": radii}
+    for name, vox in (("medial", medial), ("lateral", lateral)):
+        mm = voxel_to_phys_array(mask, vox)
+        result[name] = {"voxel": _summary(vox, percentiles), "mm": _summary(mm, percentiles)}
+        samples[name] = {"voxel": vox, "mm": mm}
+    if return_samples:
+        result["samples"] = samples
+    return result
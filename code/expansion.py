@@ -10,12 +10,14 @@ Provides a function to expand a binary mask and save it to a file.
 """
 
 import SimpleITK as sitk
-import numpy as np
-import os
+
+from distance_map import get_distance_map, get_label_distance_map
+from volume import as_volume
 
 def expand_mask_by_mm(mask: sitk.Image, expansion_mm: float) -> sitk.Image:
     """
     Expand a binary mask by a specified number of millimeters.
+    Thresholds the mask's cached distance map, so further radii are cheap.
 
     Args:
         mask (sitk.Image): Binary input mask.
@@ -24,10 +26,21 @@ def expand_mask_by_mm(mask: sitk.Image, expansion_mm: float) -> sitk.Image:
     Returns:
         sitk.Image: Expanded binary mask.
     """
-    spacing = np.array(mask.GetSpacing())  # Voxel spacing in (x, y, z)
-    radius_voxels = [int(np.ceil(expansion_mm / s)) for s in spacing]
-    expanded = sitk.BinaryDilate(mask, radius_voxels)
-    return expanded
+    return get_distance_map(mask).expand(expansion_mm, reference=mask)
+
+def expand_labels_by_mm(labeled_mask: sitk.Image, expansion_mm) -> sitk.Image:
+    """
+    Expand every label of a labeled mask in one pass.
+
+    Args:
+        labeled_mask (sitk.Image): Label image (e.g. 1=tibia, 2=femur).
+        expansion_mm (float or dict): Expansion in mm for all labels, or {label: mm}.
+
+    Returns:
+        sitk.Image: Expanded label image; where bones grow into each other,
+            voxels go to the nearest original bone whose radius reaches them.
+    """
+    return get_label_distance_map(labeled_mask).expand(expansion_mm, reference=labeled_mask)
 
 def expand_and_save(mask: sitk.Image, expansion_mm: float, save_path: str):
     """
@@ -39,8 +52,7 @@ def expand_and_save(mask: sitk.Image, expansion_mm: float, save_path: str):
         save_path (str): File path to save the expanded mask.
     """
     expanded = expand_mask_by_mm(mask, expansion_mm)
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-    sitk.WriteImage(expanded, save_path)
+    as_volume(expanded).write(save_path)
     print(f"✅ Expanded mask ({expansion_mm}mm) saved to: {save_path}")
     return expanded
 
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+instrumentation.py
+Opt-in per-stage profiling of the pipeline entry points. Stages are marked with
+
+    with stage("closing", voxels=n):
+        ...
+
+which does nothing unless a StageProfiler is active, so stage modules can be
+instrumented without passing a profiler around. main.py, run_landmark_detection
+and batch.py activate one when profiling is on (profile=True, --profile, or
+KNEE_PROFILE=1) and write stage_report.json and stage_report.csv next to
+tibial_landmarks.txt. batch.run_cohort merges the per-case reports into
+cohort_stage_report.json / .csv.
+
+Each stage records wall and CPU time (all threads of the process), how far it
+raised the process's peak RSS (0 if it stayed below an earlier peak), voxels
+per second (if the stage reports how many voxels it handled), and bytes read and
+written. Bytes come from the process I/O counters (/proc/self/io, Linux only;
+None elsewhere), so background mask writes count towards the stage that is
+running while they happen; a stage that knows its output sizes reports those
+instead. Stages do not nest.
+"""
+
+import csv
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+PROFILE = os.environ.get("KNEE_PROFILE", "") not in ("", "0")
+STAGE_REPORT_NAME = "stage_report.json"
+STAGE_CSV_NAME = "stage_report.csv"
+COHORT_STAGE_REPORT_NAME = "cohort_stage_report.json"
+COHORT_STAGE_CSV_NAME = "cohort_stage_report.csv"
+STAGE_COLUMNS = ("stage", "wall_s", "cpu_s", "peak_rss_delta_mb", "voxels", "voxels_per_s",
+                 "bytes_read", "bytes_written")
+
+_ACTIVE = ContextVar("stage_profiler", default=None)
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def _io_bytes():
+    """
+    (bytes read, bytes written) by the process so far, including page-cache hits,
+    or (None, None) where /proc/self/io is not available.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _sample() -> dict:
+    read, written = _io_bytes()
+    return {"wall": time.perf_counter(), "cpu": time.process_time(), "rss": _peak_rss_mb(),
+            "read": read, "written": written}
+
+
+def _delta(a, b):
+    return None if a is None or b is None else b - a
+
+
+def _rate(voxels, seconds):
+    return voxels / seconds if voxels and seconds > 0 else None
+
+
+class StageProfiler:
+    """
+    Collects stage records for one run (one case).
+
+    Args:
+        enabled (bool): Record stages (default: PROFILE, i.e. KNEE_PROFILE).
+    """
+
+    def __init__(self, enabled: bool = None):
+        self.enabled = PROFILE if enabled is None else bool(enabled)
+        self.stages = []
+        self._start = _sample() if self.enabled else None
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this profiler the one module-level stage() records into.
+        """
+        if not self.enabled:
+            yield self
+            return
+        token = _ACTIVE.set(self)
+        try:
+            yield self
+        finally:
+            _ACTIVE.reset(token)
+
+    @contextmanager
+    def stage(self, name: str, voxels: int = None):
+        """
+        Time the block as stage `name`. The yielded dict may be updated inside
+        the block with "voxels" and, where the stage knows them better than the
+        process counters, "bytes_read" / "bytes_written".
+        """
+        record = {"stage": name, "voxels": voxels}
+        if not self.enabled:
+            yield record
+            return
+        before = _sample()
+        try:
+            yield record
+        finally:
+            after = _sample()
+            wall = after["wall"] - before["wall"]
+            record.update({
+                "wall_s": wall,
+                "cpu_s": after["cpu"] - before["cpu"],
+                "peak_rss_delta_mb": after["rss"] - before["rss"],
+                "voxels_per_s": _rate(record["voxels"], wall),
+            })
+            record.setdefault("bytes_read", _delta(before["read"], after["read"]))
+            record.setdefault("bytes_written", _delta(before["written"], after["written"]))
+            self.stages.append({c: record.get(c) for c in STAGE_COLUMNS})
+
+    def report(self, case_id: str = None) -> dict:
+        """
+        Stage records plus a "total" row from the profiler's creation until now
+        (including time spent outside any stage).
+        """
+        now = _sample()
+        total = {
+            "stage": "total",
+            "wall_s": now["wall"] - self._start["wall"],
+            "cpu_s": now["cpu"] - self._start["cpu"],
+            "peak_rss_delta_mb": now["rss"] - self._start["rss"],
+            "voxels": None,
+            "voxels_per_s": None,
+            "bytes_read": _delta(self._start["read"], now["read"]),
+            "bytes_written": _delta(self._start["written"], now["written"]),
+        }
+        return {"case_id": case_id, "peak_rss_mb": now["rss"], "stages": list(self.stages), "total": total}
+
+    def write(self, output_dir: str, case_id: str = None):
+        """
+        Write stage_report.json and stage_report.csv to `output_dir`.
+
+        Returns:
+            str: Path to the JSON report, or None if profiling is off.
+        """
+        if not self.enabled:
+            return None
+        report = self.report(case_id)
+        path = os.path.join(output_dir, STAGE_REPORT_NAME)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        _write_csv(os.path.join(output_dir, STAGE_CSV_NAME), report["stages"] + [report["total"]])
+        return path
+
+
+def active_profiler():
+    """
+    The StageProfiler stage() currently records into, or None.
+    """
+    return _ACTIVE.get()
+
+
+@contextmanager
+def stage(name: str, voxels: int = None):
+    """
+    StageProfiler.stage on the active profiler; a no-op (yielding a scratch
+    dict) when none is active.
+    """
+    profiler = _ACTIVE.get()
+    if profiler is None:
+        yield {"stage": name, "voxels": voxels}
+        return
+    with profiler.stage(name, voxels) as record:
+        yield record
+
+
+def _write_csv(path: str, rows, with_case: bool = False):
+    columns = (("case_id",) if with_case else ()) + STAGE_COLUMNS
+    with open(path, "w", newline="") as f:
+        out = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        out.writeheader()
+        out.writerows(rows)
+
+
+def merge_stage_reports(reports: list) -> dict:
+    """
+    Aggregate per-case reports (as written by StageProfiler.write) by stage.
+
+    Returns:
+        dict: {"cases": n, "stages": [...]} with, per stage, the number of cases,
+            summed wall/CPU time, bytes and voxels, mean and max wall time, the
+            largest peak RSS delta, and voxels per second over the summed time.
+            The "total" rows are aggregated as a stage named "total".
+    """
+    by_stage = {}
+    for report in reports:
+        for row in report["stages"] + [report["total"]]:
+            by_stage.setdefault(row["stage"], []).append(row)
+
+    def total(rows, column):
+        values = [r[column] for r in rows if r.get(column) is not None]
+        return sum(values) if values else None
+
+    stages = []
+    for name, rows in by_stage.items():
+        wall = total(rows, "wall_s")
+        voxels = total(rows, "voxels")
+        stages.append({
+            "stage": name,
+            "cases": len(rows),
+            "wall_s": wall,
+            "wall_s_mean": wall / len(rows),
+            "wall_s_max": max(r["wall_s"] for r in rows),
+            "cpu_s": total(rows, "cpu_s"),
+            "peak_rss_delta_mb": max(r["peak_rss_delta_mb"] for r in rows),
+            "voxels": voxels,
+            "voxels_per_s": _rate(voxels, wall),
+            "bytes_read": total(rows, "bytes_read"),
+            "bytes_written": total(rows, "bytes_written"),
+        })
+    return {"cases": len(reports), "stages": stages}
+
+
+def write_cohort_report(output_dir: str, reports: list) -> str:
+    """
+    Write the merged report (cohort_stage_report.json) and every case's stage
+    rows with a case_id column (cohort_stage_report.csv).
+
+    Returns:
+        str: Path to the JSON report.
+    """
+    path = os.path.join(output_dir, COHORT_STAGE_REPORT_NAME)
+    with open(path, "w") as f:
+        json.dump(merge_stage_reports(reports), f, indent=2)
+    rows = [dict(row, case_id=r["case_id"]) for r in reports for row in r["stages"] + [r["total"]]]
+    _write_csv(os.path.join(output_dir, COHORT_STAGE_CSV_NAME), rows, with_case=True)
+    return path
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+landmark_store.py
+SQLite-backed landmark table shared by the single-case pipeline, main.py and the
+cohort batch runner. Records are appended in batches and indexed on case and mask
+variant, so a cohort can be queried by case, variant, seed or parameters without
+parsing text files. tibial_landmarks.txt is still produced as an export.
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+LANDMARK_DB_NAME = "landmarks.sqlite"
+LANDMARK_TSV_NAME = "tibial_landmarks.txt"
+
+# Coordinate columns in TSV order: voxel indices are integers, mm are floats
+COORD_COLUMNS = (
+    "med_x", "med_y", "med_z", "med_mm_x", "med_mm_y", "med_mm_z",
+    "lat_x", "lat_y", "lat_z", "lat_mm_x", "lat_mm_y", "lat_mm_z",
+)
+COLUMNS = ("case_id", "variant", "seed", "params") + COORD_COLUMNS
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS landmarks (
+    id INTEGER PRIMARY KEY,
+    case_id TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    seed INTEGER,
+    params TEXT NOT NULL,
+    {", ".join(f"{c} {'REAL' if '_mm_' in c else 'INTEGER'} NOT NULL" for c in COORD_COLUMNS)},
+    created REAL NOT NULL,
+    UNIQUE (case_id, variant, params)
+);
+CREATE INDEX IF NOT EXISTS landmarks_case_variant ON landmarks (case_id, variant);
+CREATE INDEX IF NOT EXISTS landmarks_variant ON landmarks (variant, seed);
+"""
+
+
+def landmark_record(case_id: str, variant: str, medial_vox, lateral_vox, medial_mm, lateral_mm,
+                    seed: int = None, params: dict = None) -> dict:
+    """
+    One landmark row. `params` describes how the mask variant was made
+    (e.g. {"mm": 2.0} or {"max_mm": 2.0, "seed": 1}).
+    """
+    rec = {"case_id": case_id, "variant": variant, "seed": seed,
+           "params": json.dumps(params or {}, sort_keys=True)}
+    values = [*medial_vox, *medial_mm, *lateral_vox, *lateral_mm]
+    for col, value in zip(COORD_COLUMNS, values):
+        rec[col] = float(value) if "_mm_" in col else int(value)
+    return rec
+
+
+class LandmarkStore:
+    """
+    Landmark table in a SQLite file. add() buffers rows, flush() (or leaving the
+    context manager) writes them in one transaction. Re-adding a row with the same
+    case, variant and parameters replaces it, so reruns do not duplicate rows.
+    """
+
+    def __init__(self, path: str, batch_size: int = 1000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._pending = []
+
+    def add(self, record: dict):
+        self._pending.append(record)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def flush(self):
+        if not self._pending:
+            return
+        rows = [tuple(r[c] for c in COLUMNS) + (time.time(),) for r in self._pending]
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO landmarks ({', '.join(COLUMNS)}, created) "
+                f"VALUES ({', '.join('?' * (len(COLUMNS) + 1))})",
+                rows,
+            )
+        self._pending = []
+
+    def _where(self, case_id=None, variant=None, seed=None, params: dict = None):
+        clauses, args = [], []
+        for col, value in (("case_id", case_id), ("variant", variant), ("seed", seed)):
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set)):
+                clauses.append(f"{col} IN ({', '.join('?' * len(value))})")
+                args.extend(value)
+            else:
+                clauses.append(f"{col} = ?")
+                args.append(value)
+        for key, value in (params or {}).items():
+            clauses.append("json_extract(params, ?) = ?")
+            args.extend([f"$.{key}", value])
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), args
+
+    def query(self, case_id=None, variant=None, seed=None, params: dict = None) -> list:
+        """
+        Rows matching all given filters, as dicts ordered by case and insertion.
+        Each filter may be a single value or a list of values; `params` matches
+        individual parameter values (e.g. {"max_mm": 2.0}).
+        """
+        self.flush()
+        where, args = self._where(case_id, variant, seed, params)
+        cur = self._conn.execute(f"SELECT {', '.join(COLUMNS)} FROM landmarks{where} ORDER BY case_id, id", args)
+        return [dict(zip(COLUMNS, row)) for row in cur]
+
+    def columns(self, case_id=None, variant=None, seed=None, params: dict = None) -> dict:
+        """
+        Same as query(), but column-wise: coordinate columns as NumPy arrays and
+        the text columns as lists.
+        """
+        rows = self.query(case_id, variant, seed, params)
+        out = {c: [r[c] for r in rows] for c in COLUMNS[:4]}
+        for c in COORD_COLUMNS:
+            out[c] = np.array([r[c] for r in rows], dtype=float if "_mm_" in c else np.int64)
+        return out
+
+    def cases(self) -> list:
+        self.flush()
+        return [row[0] for row in self._conn.execute("SELECT DISTINCT case_id FROM landmarks ORDER BY case_id")]
+
+    def __len__(self):
+        self.flush()
+        return self._conn.execute("SELECT COUNT(*) FROM landmarks").fetchone()[0]
+
+    def export_tsv(self, path: str, case_id=None, variant=None, with_case: bool = None) -> str:
+        """
+        Write rows in the tibial_landmarks.txt layout (Mask column = variant).
+        A leading Case column is added when `with_case` is True, or by default when
+        the export spans more than one case.
+        """
+        rows = self.query(case_id=case_id, variant=variant)
+        if with_case is None:
+            with_case = len({r["case_id"] for r in rows}) > 1
+        return write_landmarks_tsv(path, rows, with_case=with_case)
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def write_landmarks_tsv(path: str, records, with_case: bool = False) -> str:
+    """
+    Write landmark records as the tab-separated table used since the first
+    pipeline version (voxel indices, then mm with two decimals).
+    """
+    header = ["Mask", *COORD_COLUMNS]
+    if with_case:
+        header.insert(0, "Case")
+    with open(path, "w") as f:
+        f.write("\t".join(header) + "\n")
+        for r in records:
+            cells = [r["variant"]] + [
+                f"{r[c]:.2f}" if "_mm_" in c else str(r[c]) for c in COORD_COLUMNS
+            ]
+            if with_case:
+                cells.insert(0, r["case_id"])
+            f.write("\t".join(cells) + "\n")
+    return path
@@ -12,39 +12,73 @@ Helper functions for tibial mask expansion, randomization, and landmark extracti
 import SimpleITK as sitk
 import numpy as np
 
+from landmark_store import landmark_record
+from volume import array_view
+
 
 def expand_mask_by_mm(mask: sitk.Image, mm: float) -> sitk.Image:
-    spacing = np.array(mask.GetSpacing())
-    radii = [int(np.ceil(mm / s)) for s in spacing]
-    return sitk.BinaryDilate(mask, radii)
+    # distance_map (SciPy) is imported on use so landmark-only runs start quickly
+    from distance_map import get_distance_map
+
+    return get_distance_map(mask).expand(mm, reference=mask)
 
 
-def randomize_mask_distance_based(orig_mask: sitk.Image, max_mm: float, seed=None) -> sitk.Image:
-    np.random.seed(seed)
-    r = float(np.random.uniform(0.0, max_mm))
+def randomize_mask_distance_based(orig_mask: sitk.Image, max_mm: float, seed=None, key=None) -> sitk.Image:
+    from distance_map import get_distance_map
 
-    dist_map = sitk.SignedMaurerDistanceMap(
-        sitk.Cast(orig_mask, sitk.sitkUInt8),
-        insideIsPositive=False,
-        useImageSpacing=True
-    )
-    expanded = sitk.LessEqual(dist_map, r)
-    randomized = sitk.Or(orig_mask, expanded)
-    return sitk.Cast(randomized, sitk.sitkUInt8)
+    return get_distance_map(orig_mask).randomize(max_mm, seed=seed, key=key, reference=orig_mask)
 
 
-def find_medial_lateral_lowest(mask: sitk.Image):
-    arr = sitk.GetArrayFromImage(mask)
-    zs = np.where(np.any(arr > 0, axis=(1, 2)))[0]
+def find_medial_lateral_lowest(mask: sitk.Image, box=None):
+    # `mask` may be a sitk.Image or Volume; `box` (z, y, x slices, see roi.py)
+    # restricts the search to a known ROI
+    arr = array_view(mask)
+    z0, y0, x0 = 0, 0, 0
+    if box is not None:
+        arr = arr[box]
+        z0, y0, x0 = (sl.start for sl in box)
+    zs = np.flatnonzero(arr.any(axis=(1, 2)))
     if len(zs) == 0:
         raise RuntimeError("Mask is empty.")
     z_low = int(zs.max())
     ys, xs = np.where(arr[z_low] > 0)
-    lateral = (int(xs.min()), int(ys[xs.argmin()]), z_low)
-    medial = (int(xs.max()), int(ys[xs.argmax()]), z_low)
+    lateral = (int(xs.min()) + x0, int(ys[xs.argmin()]) + y0, z_low + z0)
+    medial = (int(xs.max()) + x0, int(ys[xs.argmax()]) + y0, z_low + z0)
     return medial, lateral
 
 
 def voxel_to_phys(mask: sitk.Image, idx):
     return mask.TransformIndexToPhysicalPoint(idx)
 
+
+def voxel_to_phys_array(mask: sitk.Image, idx: np.ndarray) -> np.ndarray:
+    # Vectorized TransformIndexToPhysicalPoint for an (N, 3) array of (x, y, z) indices
+    direction = np.array(mask.GetDirection()).reshape(3, 3)
+    spacing = np.array(mask.GetSpacing())
+    origin = np.array(mask.GetOrigin())
+    return origin + (np.asarray(idx, dtype=float) * spacing) @ direction.T
+
+
+
+def measure_landmarks(case_id: str, masks: dict, box=None, params: dict = None, indices: dict = None) -> list:
+    # One landmark_store record per named mask; `params` maps mask name to the
+    # parameters that produced it (a "seed" entry also fills the seed column).
+    # Landmarks come from each mask's SurfaceIndex, returned in `indices` (if
+    # given) so further landmark types can be queried without rescanning.
+    from surface_index import SurfaceIndex
+
+    params = params or {}
+    records = []
+    for name, mask in masks.items():
+        index = SurfaceIndex(mask, box=box)
+        if indices is not None:
+            indices[name] = index
+        points = index.landmark("medial_lateral_lowest")
+        medial_vox, lateral_vox = points["medial"], points["lateral"]
+        p = params.get(name, {})
+        records.append(landmark_record(
+            case_id, name, medial_vox, lateral_vox,
+            voxel_to_phys(mask, medial_vox), voxel_to_phys(mask, lateral_vox),
+            seed=p.get("seed"), params=p,
+        ))
+    return records
@@ -1,135 +1,117 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[ ]:
+"""
+main.py
+End-to-end run on one CT: segmentation → expanded/randomized tibia masks →
+tibial landmarks → overlay figures, plus the whole-bone expanded and randomized
+masks. Nothing runs on import; stage modules are loaded inside the steps that use
+them, and matplotlib only when figures are requested. For single stages use cli.py.
 
+With --profile (or KNEE_PROFILE=1) every stage's wall/CPU time, peak RSS delta,
+voxel rate and I/O bytes are written to stage_report.json/.csv in the results.
 
-import os
-import SimpleITK as sitk
-
-# ==== Import your custom modules ====
-from segmentation import segment_bones
-from expansion import expand_mask_by_mm
-from randomization import randomize_mask_distance_based
-from landmark_utils import find_medial_lateral_lowest, voxel_to_phys
-from visualize import visualize_labeled_mask, visualize_mask_only
-
-# ==== Paths ====
-DATA_PATH = "3702_left_knee.nii.gz"
-RESULT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../results'))
-FIGURE_DIR = os.path.join(RESULT_DIR, "figures")
-os.makedirs(FIGURE_DIR, exist_ok=True)
-
-# ==== Step 1: Segment Femur and Tibia ====
-print("🔍 Segmenting bones...")
-labeled_mask, tibia_mask, femur_mask, ct_image = segment_bones(DATA_PATH)
-
-# ==== Step 2: Save Expanded Masks ====
-print("📏 Expanding tibia mask...")
-tibia_2mm = expand_mask_by_mm(tibia_mask, 2.0)
-tibia_4mm = expand_mask_by_mm(tibia_mask, 4.0)
-sitk.WriteImage(tibia_2mm, os.path.join(RESULT_DIR, "mask_tibia_expanded_2mm.nii.gz"))
-sitk.WriteImage(tibia_4mm, os.path.join(RESULT_DIR, "mask_tibia_expanded_4mm.nii.gz"))
-
-# ==== Step 3: Generate Randomized Masks ====
-print("🎲 Generating randomized masks...")
-rand_tibia_1 = randomize_mask_distance_based(tibia_mask, ct_image, max_mm=2.0, seed=1)
-rand_tibia_2 = randomize_mask_distance_based(tibia_mask, ct_image, max_mm=2.0, seed=2)
-sitk.WriteImage(rand_tibia_1, os.path.join(RESULT_DIR, "mask_tibia_random_1.nii.gz"))
-sitk.WriteImage(rand_tibia_2, os.path.join(RESULT_DIR, "mask_tibia_random_2.nii.gz"))
-
-# ==== Step 4: Landmark Extraction ====
-print("📌 Extracting tibial landmarks...")
-masks = {
-    "Original": tibia_mask,
-    "Expanded_2mm": tibia_2mm,
-    "Expanded_4mm": tibia_4mm,
-    "Random_1": rand_tibia_1,
-    "Random_2": rand_tibia_2
-}
-
-landmark_file = os.path.join(RESULT_DIR, "tibial_landmarks.txt")
-with open(landmark_file, "w") as f:
-    f.write("Mask\tmed_x\tmed_y\tmed_z\tmed_mm_x\tmed_mm_y\tmed_mm_z\t"
-            "lat_x\tlat_y\tlat_z\tlat_mm_x\tlat_mm_y\tlat_mm_z\n")
-    for name, mask in masks.items():
-        medial_vox, lateral_vox = find_medial_lateral_lowest(mask)
-        medial_mm = voxel_to_phys(mask, medial_vox)
-        lateral_mm = voxel_to_phys(mask, lateral_vox)
-        f.write(f"{name}\t"
-                f"{medial_vox[0]}\t{medial_vox[1]}\t{medial_vox[2]}\t"
-                f"{medial_mm[0]:.2f}\t{medial_mm[1]:.2f}\t{medial_mm[2]:.2f}\t"
-                f"{lateral_vox[0]}\t{lateral_vox[1]}\t{lateral_vox[2]}\t"
-                f"{lateral_mm[0]:.2f}\t{lateral_mm[1]:.2f}\t{lateral_mm[2]:.2f}\n")
-print(f"✅ Landmarks saved to: {landmark_file}")
-
-# ==== Step 5: Save visualizations ====
-print("🖼 Saving visualizations...")
-visualize_labeled_mask(ct_image, labeled_mask, os.path.join(FIGURE_DIR, "bone_segmented_overlay.png"))
-visualize_mask_only(tibia_2mm, os.path.join(FIGURE_DIR, "tibia_expanded_2mm.png"))
-visualize_mask_only(rand_tibia_1, os.path.join(FIGURE_DIR, "tibia_random_1.png"))
-visualize_mask_only(rand_tibia_2, os.path.join(FIGURE_DIR, "tibia_random_2.png"))
-
-print("✅ Pipeline completed successfully!")
-
-
-# In[ ]:
-
+Usage:
+    python main.py [ct.nii.gz] [--results DIR] [--no-figures] [--cache [--cache-dir DIR]] [--profile]
+"""
 
+import argparse
 import os
-import SimpleITK as sitk
-
-# ==== Import your custom modules ====
-from segmentation import segment_bones
-from expansion import expand_mask_by_mm
-from randomization import randomize_mask_distance_based
-from landmark_utils import find_medial_lateral_lowest, voxel_to_phys
-from run_landmark_pipeline import run_landmark_extraction  # Optional helper wrapper
 
 # ==== Paths ====
 DATA_PATH = "3702_left_knee.nii.gz"
 RESULT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../results'))
-os.makedirs(RESULT_DIR, exist_ok=True)
-
-# ==== Step 1: Segment Femur and Tibia ====
-print("🔍 Segmenting bones...")
-bone_segmented, tibia_mask, femur_mask, ct_image = segment_bones(DATA_PATH)
-
-# ==== Step 2: Save Expanded Masks ====
-print("📏 Expanding bone mask...")
-mask_expanded_2mm = expand_mask_by_mm(bone_segmented, 2.0)
-sitk.WriteImage(mask_expanded_2mm, os.path.join(RESULT_DIR, "mask_bone_expanded_2mm.nii.nii.gz"))
-
-
-# ==== Step 3: Generate Randomized Masks ====
-print("🎲 Generating randomized masks...")
-rand_bone= randomize_mask_distance_based(bone_segmented, ct_image, max_mm=2.0, seed=1)
-sitk.WriteImage(rand_tibia_1, os.path.join(RESULT_DIR, "bone_segmented_randomized.nii.gz"))
-
-# ==== Step 4: Landmark Extraction (from masks) ====
-print("📌 Extracting tibial landmarks...")
-masks = {
-    "Original": tibia_mask,
-    "Expanded_2mm": tibia_2mm,
-    "Expanded_4mm": tibia_4mm,
-    "Random_1": rand_tibia_1,
-    "Random_2": rand_tibia_2
-}
-
-landmark_file = os.path.join(RESULT_DIR, "tibial_landmarks.txt")
-with open(landmark_file, "w") as f:
-    f.write("Mask\tmed_x\tmed_y\tmed_z\tmed_mm_x\tmed_mm_y\tmed_mm_z\t"
-            "lat_x\tlat_y\tlat_z\tlat_mm_x\tlat_mm_y\tlat_mm_z\n")
-    for name, mask in masks.items():
-        medial_vox, lateral_vox = find_medial_lateral_lowest(mask)
-        medial_mm = voxel_to_phys(mask, medial_vox)
-        lateral_mm = voxel_to_phys(mask, lateral_vox)
-        f.write(f"{name}\t"
-                f"{medial_vox[0]}\t{medial_vox[1]}\t{medial_vox[2]}\t"
-                f"{medial_mm[0]:.2f}\t{medial_mm[1]:.2f}\t{medial_mm[2]:.2f}\t"
-                f"{lateral_vox[0]}\t{lateral_vox[1]}\t{lateral_vox[2]}\t"
-                f"{lateral_mm[0]:.2f}\t{lateral_mm[1]:.2f}\t{lateral_mm[2]:.2f}\n")
-
-print(f"✅ Landmarks saved to: {landmark_file}")
-print("✅ Pipeline completed successfully.")
 
+
+def save_bone_variants(labeled_mask, result_dir: str, mm: float = 2.0, seed: int = 1):
+    """
+    Whole-bone masks: the labeled mask expanded by `mm` and a per-label
+    randomized expansion (tibia and femur drawn independently).
+    """
+    from expansion import expand_mask_by_mm
+    from mask_io import write_mask
+    from randomization import randomize_labels_distance_based
+
+    print("📏 Expanding bone mask...")
+    write_mask(expand_mask_by_mm(labeled_mask, mm), os.path.join(result_dir, f"mask_bone_expanded_{mm:g}mm.nii.gz"))
+    print("🎲 Generating randomized bone mask...")
+    write_mask(randomize_labels_distance_based(labeled_mask, max_mm=mm, seed=seed),
+               os.path.join(result_dir, "bone_segmented_randomized.nii.gz"))
+
+
+def save_figures(ct_image, labeled_mask, result_dir: str):
+    from qa_render import LABEL_COLORS, render_overlay
+
+    figure_dir = os.path.join(result_dir, "figures")
+    render_overlay(ct_image, labeled_mask, os.path.join(figure_dir, "bone_segmented_overlay.png"), colors=LABEL_COLORS)
+    for name in ("expanded_2mm", "random_1", "random_2"):
+        render_overlay(ct_image, os.path.join(result_dir, f"mask_tibia_{name}.nii.gz"),
+                       os.path.join(figure_dir, f"tibia_{name}.png"))
+
+
+def main(data_path: str = DATA_PATH, result_dir: str = RESULT_DIR, figures: bool = True, cache=None,
+         profile: bool = None):
+    # `cache` (a stage_cache.StageCache) reuses the segmentation and the tibia
+    # distance map of earlier runs on the same CT and thresholds. `profile`
+    # (default: KNEE_PROFILE) writes a per-stage report (see instrumentation.py).
+    from batch import case_id_from_path
+    from instrumentation import StageProfiler
+
+    os.makedirs(result_dir, exist_ok=True)
+    profiler = StageProfiler(profile)
+    with profiler.activate():
+        _run(data_path, result_dir, figures, cache)
+    report = profiler.write(result_dir, case_id_from_path(data_path))
+    if report:
+        print(f"✅ Stage report saved to: {report}")
+    print("✅ Pipeline completed successfully!")
+
+
+def _run(data_path: str, result_dir: str, figures: bool, cache):
+    from batch import case_id_from_path
+    from instrumentation import stage
+    from run_landmark_pipeline import run_landmark_detection
+    from segmentation import segment_bones
+    from stage_cache import cached_segment_bones
+
+    # ==== Step 1: Segment Femur and Tibia ====
+    print("🔍 Segmenting bones...")
+    bones = {}
+    if cache is not None:
+        labeled_mask = cached_segment_bones(data_path, result_dir, cache, bones=bones)
+        ct_image = data_path  # read by the figures only if they are requested
+    else:
+        labeled_mask, ct_image = segment_bones(data_path, output_dir=result_dir, bones=bones)
+
+    # ==== Steps 2-4: Expanded and randomized tibia masks, landmark extraction ====
+    print("📌 Building tibia mask variants and extracting tibial landmarks...")
+    run_landmark_detection(os.path.join(result_dir, "mask_tibia.nii.gz"), data_path, result_dir,
+                           case_id=case_id_from_path(data_path), box=bones["tibia"]["box"], cache=cache)
+
+    # ==== Whole-bone variants ====
+    with stage("bone_variants", voxels=2 * labeled_mask.GetNumberOfPixels()):
+        save_bone_variants(labeled_mask, result_dir)
+
+    # ==== Step 5: Save visualizations ====
+    if figures:
+        print("🖼 Saving visualizations...")
+        with stage("figures"):
+            save_figures(ct_image, labeled_mask, result_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the full knee CT pipeline on one scan.")
+    parser.add_argument("ct", nargs="?", default=DATA_PATH, help="CT NIfTI file")
+    parser.add_argument("--results", default=RESULT_DIR, help="Output directory")
+    parser.add_argument("--no-figures", action="store_true", help="Skip the overlay PNGs (no matplotlib)")
+    parser.add_argument("--cache", action="store_true", help="Reuse segmentation and distance map from the stage cache")
+    parser.add_argument("--cache-dir", default=".stage_cache")
+    parser.add_argument("--profile", action="store_true", default=None,
+                        help="Write per-stage timings to stage_report.json/.csv (also: KNEE_PROFILE=1)")
+    args = parser.parse_args()
+    cache = None
+    if args.cache:
+        from stage_cache import StageCache
+
+        cache = StageCache(args.cache_dir)
+    main(args.ct, args.results, figures=not args.no_figures, cache=cache, profile=args.profile)
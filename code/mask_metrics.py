@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+mask_metrics.py
+Agreement between an original mask and its variants: Dice, volume and volume
+change in mm³, and symmetric surface distances (Hausdorff, 95th percentile
+Hausdorff, mean surface distance). All variants of a case are compared in one
+call against one distance map of the original (the cached one the variants were
+made from), restricted to its ROI box:
+
+- overlap is the number of variant voxels at distance 0, so the original is
+  never re-read or decoded again per variant;
+- a variant surface voxel outside the original is exactly its stored distance
+  away from the original surface; only variant surface voxels lying inside the
+  original, and the original surface in the other direction, go through a
+  KD-tree of surface points (surface_index.py).
+
+Results are written as mask_metrics.txt next to tibial_landmarks.txt.
+"""
+
+import numpy as np
+
+from roi import bounding_box
+from volume import array_view
+
+METRICS_TSV_NAME = "mask_metrics.txt"
+METRIC_COLUMNS = ("dice", "volume_mm3", "volume_delta_mm3", "hausdorff_mm", "hausdorff95_mm", "mean_surface_mm")
+
+
+def _cover(dmap, box):
+    """
+    Grow the distance map's ROI until it contains `box`; returns its ROI
+    (box, distance, max_mm) snapshot.
+    """
+    max_mm = dmap.max_mm
+    roi = dmap.ensure(max_mm) if max_mm is not None else (None, None, None)
+    if roi[0] is not None and all(b.start <= s.start and s.stop <= b.stop for s, b in zip(box, roi[0])):
+        return roi
+    overhang = [max(m.start - s.start, s.stop - m.stop, 0) * sp
+                for s, m, sp in zip(box, dmap.mask_box, dmap.spacing[::-1])]
+    return dmap.ensure(max(max(overhang), roi[2] or 0.0))
+
+
+def _compare(dmap, ref, n_ref: int, voxel_mm3: float, mask, surface=None) -> dict:
+    from distance_map import distance_mm
+    from landmark_utils import voxel_to_phys_array
+    from surface_index import SurfaceIndex
+
+    arr = array_view(mask)
+    if arr.shape != dmap.shape:
+        raise ValueError(f"Variant grid {arr.shape[::-1]} does not match the original {dmap.shape[::-1]}")
+    box = bounding_box(arr)
+    if box is None:
+        nan = float("nan")
+        return {"dice": 0.0, "volume_mm3": 0.0, "volume_delta_mm3": -n_ref * voxel_mm3,
+                "hausdorff_mm": nan, "hausdorff95_mm": nan, "mean_surface_mm": nan}
+    roi_box, d, _ = _cover(dmap, box)
+    inside = arr[roi_box] > 0
+    n = int(np.count_nonzero(inside))
+    overlap = int(np.count_nonzero(d[inside] == 0))
+
+    # Variant surface -> original surface: the distance map outside the original,
+    # the KD-tree for the (usually few) surface voxels inside it
+    surface = surface or SurfaceIndex(mask, box=box)
+    offset = np.array([sl.start for sl in roi_box], dtype=np.int64)
+    to_ref = distance_mm(d[tuple((surface.zyx - offset).T)]).copy()
+    covered = to_ref == 0
+    if covered.any():
+        to_ref[covered] = ref.tree.query(voxel_to_phys_array(mask, surface.zyx[covered][:, ::-1]))[0]
+    # Original surface -> variant surface
+    from_ref = surface.tree.query(ref.points_mm)[0]
+
+    both = np.concatenate([to_ref, from_ref])
+    return {
+        "dice": 2.0 * overlap / (n_ref + n),
+        "volume_mm3": n * voxel_mm3,
+        "volume_delta_mm3": (n - n_ref) * voxel_mm3,
+        "hausdorff_mm": float(both.max()),
+        "hausdorff95_mm": float(np.percentile(both, 95)),
+        "mean_surface_mm": float(both.mean()),
+    }
+
+
+def compare_masks(original, variants: dict, dmap=None, surfaces: dict = None) -> dict:
+    """
+    Metrics of every variant against the original mask.
+
+    Args:
+        original: Binary mask (sitk.Image or Volume).
+        variants (dict): Name -> mask on the same grid.
+        dmap (DistanceMap): Distance map of `original` to reuse (default: the
+            cached one from distance_map.get_distance_map). Its ROI is widened if a
+            variant reaches beyond it.
+        surfaces (dict): Optional name -> SurfaceIndex already built for the
+            variants (e.g. by landmark_utils.measure_landmarks); an "Original"
+            entry is used for the original mask.
+
+    Returns:
+        dict: name -> {column: value} for METRIC_COLUMNS. Distances are in mm;
+        they are NaN for an empty variant.
+    """
+    from distance_map import get_distance_map
+    from surface_index import SurfaceIndex
+
+    dmap = dmap or get_distance_map(original)
+    if dmap.mask_box is None:
+        raise RuntimeError("Mask is empty.")
+    surfaces = surfaces or {}
+    ref = surfaces.get("Original") or SurfaceIndex(original, box=dmap.mask_box)
+    n_ref = int(np.count_nonzero(dmap.core()))
+    voxel_mm3 = float(np.prod(dmap.spacing))
+    return {name: _compare(dmap, ref, n_ref, voxel_mm3, mask, surfaces.get(name))
+            for name, mask in variants.items()}
+
+
+def metric_records(case_id: str, original, variants: dict, dmap=None, surfaces: dict = None) -> list:
+    """
+    compare_masks() as a list of rows with case_id and variant columns.
+    """
+    metrics = compare_masks(original, variants, dmap=dmap, surfaces=surfaces)
+    return [{"case_id": case_id, "variant": name, **values} for name, values in metrics.items()]
+
+
+def write_metrics_tsv(path: str, records, with_case: bool = False) -> str:
+    """
+    Write metric rows as a tab-separated table (Mask column = variant), in the
+    layout of tibial_landmarks.txt.
+    """
+    header = ["Mask", *METRIC_COLUMNS]
+    if with_case:
+        header.insert(0, "Case")
+    with open(path, "w") as f:
+        f.write("\t".join(header) + "\n")
+        for r in records:
+            cells = [r["variant"]] + [f"{r[c]:.4f}" if c == "dice" else f"{r[c]:.2f}" for c in METRIC_COLUMNS]
+            if with_case:
+                cells.insert(0, r["case_id"])
+            f.write("\t".join(cells) + "\n")
+    return path
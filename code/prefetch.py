@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+prefetch.py
+Read-ahead for multi-case runs. A background thread reads and decodes the next
+CTs into a bounded queue while the caller processes the current one; when the
+queue is full the reader waits, so at most `depth` decoded CTs (plus the one being
+read) are held besides the one in use. Paired with a bounded mask_io.MaskWriter
+for the outputs, reading, computing and writing overlap instead of running in
+sequence.
+"""
+
+import queue
+import threading
+
+_DONE = object()
+
+
+def read_ct(path: str):
+    import SimpleITK as sitk
+
+    return sitk.ReadImage(path)
+
+
+class Prefetcher:
+    """
+    Iterate over (key, image) for `items` (key -> path, or an iterable of
+    (key, path) pairs) in order, reading up to `depth` items ahead. A failed read
+    yields (key, exception) instead of stopping the iteration.
+
+    Args:
+        items: Mapping or iterable of (key, path).
+        depth (int): Decoded items allowed to wait in the queue.
+        reader: Function path -> image (default: sitk.ReadImage).
+    """
+
+    def __init__(self, items, depth: int = 2, reader=read_ct):
+        self._items = list(items.items() if hasattr(items, "items") else items)
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._reader = reader
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ct-prefetch", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        for key, path in self._items:
+            try:
+                item = (key, self._reader(path))
+            except Exception as exc:
+                item = (key, exc)
+            if not self._put(item):
+                return
+        self._put(_DONE)
+
+    def _put(self, item) -> bool:
+        # Wait for room, but give up if the consumer has stopped
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            yield item
+
+    def close(self):
+        """
+        Stop reading ahead and drop queued items.
+        """
+        self._stop.set()
+        self._thread.join()
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
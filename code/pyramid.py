@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+pyramid.py
+Coarse-to-fine segmentation and expansion. The mask is summarized on a coarse grid
+(cells of factor³ voxels) as "any voxel set" / "all voxels set". Coarse morphology
+(closing influence, or a coarse distance transform with error bounds) decides every
+block of the volume that provably cannot change at full resolution; only the blocks
+around the bone surface are recomputed at native resolution, and the result matches
+the full-resolution path voxel for voxel. This pays off when the surface blocks are
+a small part of the ROI (large, finely sampled scans); on compact phantoms the ROI
+path is as fast. With refine=False the undecided band takes the coarse answer
+instead, and the disagreement report shows what that approximation costs.
+"""
+
+import os
+import tempfile
+import time
+
+import SimpleITK as sitk
+import numpy as np
+import scipy.ndimage as ndi
+
+from bone_separation import separate_bones
+from edt import distance_transform
+from roi import bounding_box, margin_voxels, pad_box
+from segmentation import CLOSING_RADIUS, segment_bones
+from slab_io import write_box_nifti
+from volume import array_view, as_volume, mask_dtype, match_input
+
+DEFAULT_FACTOR = 4
+DEFAULT_BLOCK = 32
+
+
+def cell_summary(mask: np.ndarray, factor: int):
+    """
+    Coarse (any, all) boolean grids of a fine mask; cells are factor³ voxels and
+    partial cells at the far edges count as not all-set.
+    """
+    cells = _cells(mask, factor)
+    return cells.any(axis=(1, 3, 5)), cells.all(axis=(1, 3, 5))
+
+
+def _cells(mask: np.ndarray, factor: int) -> np.ndarray:
+    pads = [(0, (-n) % factor) for n in mask.shape]
+    if any(p for _, p in pads):
+        mask = np.pad(mask, pads)
+    cz, cy, cx = (n // factor for n in mask.shape)
+    return mask.reshape(cz, factor, cy, factor, cx, factor)
+
+
+def cell_mean(mask: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Fraction of set voxels per coarse cell (partial cells padded with zeros).
+    """
+    return _cells(mask, factor).mean(axis=(1, 3, 5))
+
+
+def upsample(coarse: np.ndarray, factor: int, shape) -> np.ndarray:
+    """
+    Nearest-neighbor upsampling of a coarse grid, cropped to the fine `shape`.
+    """
+    up = coarse.repeat(factor, 0).repeat(factor, 1).repeat(factor, 2)
+    return up[:shape[0], :shape[1], :shape[2]]
+
+
+def _block_flags(cell_flags: np.ndarray, cells_per_block: int) -> np.ndarray:
+    return cell_summary(cell_flags, cells_per_block)[0]
+
+
+def _block_slices(index, block: int, shape):
+    return tuple(slice(i * block, min((i + 1) * block, n)) for i, n in zip(index, shape))
+
+
+def _block_runs(flags: np.ndarray, block: int, shape):
+    """
+    Voxel boxes covering the flagged blocks, with consecutive blocks along x merged
+    so each crop pays its halo once.
+    """
+    for bz, by in np.argwhere(flags.any(axis=2)):
+        row = np.concatenate(([False], flags[bz, by], [False]))
+        edges = np.flatnonzero(row[1:] != row[:-1])
+        for x0, x1 in zip(edges[::2], edges[1::2]):
+            z, y = _block_slices((bz, by), block, shape[:2])
+            yield z, y, slice(x0 * block, min(x1 * block, shape[2]))
+
+
+def disagreement(a: np.ndarray, b: np.ndarray) -> dict:
+    """
+    Voxel disagreement between two masks of the same shape.
+    """
+    differ = int(np.count_nonzero(a != b))
+    return {"voxels": differ, "fraction": differ / a.size}
+
+
+def closed_bone_pyramid(bone: np.ndarray, factor: int = DEFAULT_FACTOR, block: int = DEFAULT_BLOCK,
+                        radius: int = CLOSING_RADIUS, refine: bool = True):
+    """
+    Binary closing of a thresholded bone mask, recomputed only where the result
+    is not decided by the coarse grid.
+
+    A closed voxel depends on input within 2 × radius: if that neighborhood is all
+    bone the result is bone, if it is empty the result is empty. Blocks whose
+    neighborhood (rounded out to coarse cells, and never touching the image edge)
+    is uniform are filled directly; mixed blocks are closed at full resolution
+    with a 2 × radius halo, or, with refine=False, take a coarse closing upsampled.
+
+    Returns:
+        (np.ndarray, dict): uint8 closed mask and {"blocks", "refined_blocks"}.
+    """
+    if block % factor:
+        raise ValueError(f"Block size {block} must be a multiple of the factor {factor}")
+    shape = bone.shape
+    any_c, all_c = cell_summary(bone, factor)
+    halo_cells = -(-2 * radius // factor)
+    size = 2 * halo_cells + 1
+    near_any = ndi.maximum_filter(any_c, size=size, mode="constant", cval=False)
+    near_all = ndi.minimum_filter(all_c, size=size, mode="constant", cval=False)
+
+    cells_per_block = block // factor
+    full_b = ~cell_summary(~near_all, cells_per_block)[0]
+    mixed_b = _block_flags(near_any & ~near_all, cells_per_block)
+
+    closed = np.zeros(shape, dtype=np.uint8)
+    for idx in np.argwhere(full_b & ~mixed_b):
+        closed[_block_slices(idx, block, shape)] = 1
+
+    closing = sitk.BinaryMorphologicalClosingImageFilter()
+    closing.SetForegroundValue(1)
+    if refine:
+        closing.SetKernelRadius(radius)
+        halo = 2 * radius
+        for blk in _block_runs(mixed_b, block, shape):
+            outer = pad_box(blk, shape, halo)
+            result = sitk.GetArrayFromImage(closing.Execute(sitk.GetImageFromArray(bone[outer].astype(np.uint8))))
+            closed[blk] = result[tuple(slice(b.start - o.start, b.stop - o.start) for b, o in zip(blk, outer))]
+    else:
+        # Coarse path: majority-vote cells, closed with the radius in cells
+        closing.SetKernelRadius(max(1, int(round(radius / factor))))
+        majority = (cell_mean(bone, factor) >= 0.5).astype(np.uint8)
+        coarse = sitk.GetArrayFromImage(closing.Execute(sitk.GetImageFromArray(majority)))
+        up = upsample(coarse, factor, shape)
+        for blk in _block_runs(mixed_b, block, shape):
+            closed[blk] = up[blk]
+    return closed, {"blocks": int(mixed_b.size), "refined_blocks": int(mixed_b.sum())}
+
+
+def segment_bones_pyramid(image_path, output_dir="results", lower_threshold=260, upper_threshold=3000,
+                          factor: int = DEFAULT_FACTOR, block: int = DEFAULT_BLOCK, refine: bool = True,
+                          compare: bool = False, bones=None):
+    """
+    segment_bones with the closing done coarse-to-fine (see closed_bone_pyramid).
+    Writes the same three files and fills `bones` as segment_bones does.
+
+    Args:
+        compare (bool): Also run segment_bones (into a temporary directory) and
+            report the voxel disagreement of the labeled masks.
+
+    Returns:
+        (labeled, ct, report): labeled mask and CT as in segment_bones, and a dict
+            with block counts, timings and (if compare) the disagreement.
+    """
+    t0 = time.perf_counter()
+    ct = sitk.ReadImage(image_path) if isinstance(image_path, str) else image_path
+    ct_arr = array_view(ct)
+    shape = ct_arr.shape
+    bone = np.empty(shape, dtype=bool)
+    for z0 in range(0, shape[0], 16):
+        slab = ct_arr[z0:z0 + 16]
+        np.logical_and(slab >= lower_threshold, slab <= upper_threshold, out=bone[z0:z0 + 16])
+
+    closed, report = closed_bone_pyramid(bone, factor=factor, block=block, refine=refine)
+    del bone
+
+    box = bounding_box(closed) or tuple(slice(0, n) for n in shape)
+    labeled_arr, stats = separate_bones(closed[box], offset=[sl.start for sl in box], shape=shape,
+                                        spacing=ct.GetSpacing())
+    closed[box] = labeled_arr
+    if bones is not None:
+        bones.update(stats)
+    write_box_nifti(os.path.join(output_dir, "bone_segmented.nii.gz"), ct, box, labeled_arr)
+    write_box_nifti(os.path.join(output_dir, "mask_tibia.nii.gz"), ct, box, labeled_arr == 1)
+    write_box_nifti(os.path.join(output_dir, "mask_femur.nii.gz"), ct, box, labeled_arr == 2)
+    labeled_vol = as_volume(ct).like(closed)
+    report["seconds"] = time.perf_counter() - t0
+    print(f"✅ Saved bone_segmented.nii.gz, mask_tibia.nii.gz, and mask_femur.nii.gz "
+          f"(pyramid, {report['refined_blocks']}/{report['blocks']} blocks refined)")
+
+    if compare:
+        with tempfile.TemporaryDirectory() as tmp:
+            t1 = time.perf_counter()
+            reference, _ = segment_bones(ct, output_dir=tmp, lower_threshold=lower_threshold,
+                                         upper_threshold=upper_threshold)
+            report["full_seconds"] = time.perf_counter() - t1
+        report["disagreement"] = disagreement(closed, array_view(reference))
+    return match_input(ct, labeled_vol), ct, report
+
+
+def expand_mask_pyramid(mask, mm: float, factor: int = 2, block: int = DEFAULT_BLOCK, refine: bool = True,
+                        compare: bool = False):
+    """
+    expand_mask_by_mm computed coarse-to-fine.
+
+    Coarse distance transforms of the any/all cell grids bound each voxel's true
+    distance within ±2h (h: largest offset of a voxel center from its cell center,
+    in mm): cells with d_all + 2h <= mm are inside, cells with d_any - 2h > mm are
+    outside. Blocks containing undecided cells get an exact distance transform of
+    the block padded by `mm` (every feature within `mm` lies in that crop), or,
+    with refine=False, the coarse decision d_any <= mm.
+
+    Returns:
+        (expanded, report): mask of the same type as `mask`, and a dict with block
+            counts, timings and (if compare) the disagreement with expand_mask_by_mm.
+    """
+    t0 = time.perf_counter()
+    arr = array_view(mask) > 0
+    shape = arr.shape
+    spacing = np.array(mask.GetSpacing()[::-1], dtype=float)  # (z, y, x)
+    out = np.zeros(shape, dtype=mask_dtype())
+    report = {"blocks": 0, "refined_blocks": 0}
+
+    box = bounding_box(arr)
+    if box is not None:
+        box = pad_box(box, shape, margin_voxels(mask.GetSpacing(), mm))
+        sub = arr[box]
+        any_c, all_c = cell_summary(sub, factor)
+        coarse_spacing = spacing * factor
+        h = float(np.linalg.norm((factor - 1) / 2 * spacing))
+        d_any = distance_transform(~any_c, coarse_spacing)
+        d_all = distance_transform(~all_c, coarse_spacing) if all_c.any() else np.full(all_c.shape, np.inf)
+        inside_c = d_all + 2 * h <= mm
+        outside_c = d_any - 2 * h > mm
+        undecided_c = ~inside_c & ~outside_c
+
+        cells_per_block = block // factor
+        undecided_b = _block_flags(undecided_c, cells_per_block)
+        result = upsample(inside_c, factor, sub.shape).copy()
+        coarse_up = None if refine else upsample(d_any <= mm, factor, sub.shape)
+        margin = margin_voxels(mask.GetSpacing(), mm)
+        for blk in _block_runs(undecided_b, block, sub.shape):
+            if not refine:
+                result[blk] = coarse_up[blk]
+                continue
+            outer = pad_box(blk, sub.shape, margin)
+            crop = sub[outer]
+            if crop.any():
+                inner = tuple(slice(b.start - o.start, b.stop - o.start) for b, o in zip(blk, outer))
+                result[blk] = distance_transform(~crop, spacing)[inner] <= mm
+            else:
+                result[blk] = False
+        out[box] = result
+        report = {"blocks": int(undecided_b.size), "refined_blocks": int(undecided_b.sum())}
+
+    report["seconds"] = time.perf_counter() - t0
+    expanded = match_input(mask, as_volume(mask).like(out))
+    if compare:
+        from distance_map import DistanceMap
+
+        t1 = time.perf_counter()
+        reference = DistanceMap(mask).grown_array(mm)
+        report["full_seconds"] = time.perf_counter() - t1
+        report["disagreement"] = disagreement(out.astype(bool), reference)
+    return expanded, report
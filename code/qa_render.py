@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+qa_render.py
+Headless (Agg) QA figures for many cases. For each case, draws coronal, sagittal
+and axial overlays of the labeled mask, the expanded tibia masks and the randomized
+tibia masks on the CT, using uint8 arithmetic only (no float RGB temporaries) and
+reading just the displayed planes. Cases are rendered in a process pool and a
+per-cohort contact sheet is assembled at the end.
+
+Usage:
+    python qa_render.py <cohort_dir> [--workers N] [--plane coronal]
+
+<cohort_dir> is an output directory of batch.py (its cohort_manifest.json gives
+each case's CT path).
+"""
+
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.image as mpimg
+import numpy as np
+
+from slab_io import read_info
+from slice_io import AXES, read_plane
+
+# CT display window (HU) mapped to 0..255
+WINDOW = (-200, 1500)
+ALPHA = 128  # overlay opacity out of 256
+
+LABEL_COLORS = {
+    1: (255, 128, 128),  # Tibia = light red
+    2: (128, 255, 128),  # Femur = light green
+}
+MASK_COLOR = (255, 64, 255)
+
+PLANES = ("coronal", "sagittal", "axial")
+QA_DIR_NAME = "qa"
+CONTACT_SHEET_NAME = "qa_contact_sheet.png"
+
+
+def window_uint8(plane: np.ndarray, window=WINDOW) -> np.ndarray:
+    """
+    Map a CT plane to uint8 gray levels. Integer CTs go through a lookup table,
+    so no floating-point copy of the plane is made.
+    """
+    lo, hi = window
+    if plane.dtype.kind in "iu" and plane.dtype.itemsize <= 2:
+        info = np.iinfo(plane.dtype)
+        values = np.arange(info.min, info.max + 1, dtype=np.int32)
+        lut = ((np.clip(values, lo, hi) - lo) * 255 // (hi - lo)).astype(np.uint8)
+        return lut[plane.astype(np.int32) - info.min]
+    scaled = (np.clip(plane, lo, hi).astype(np.float32) - lo) * np.float32(255.0 / (hi - lo))
+    return scaled.astype(np.uint8)
+
+
+def overlay_rgb(gray: np.ndarray, labels: np.ndarray, colors: dict, alpha: int = ALPHA) -> np.ndarray:
+    """
+    Blend label colors onto a uint8 gray plane with integer arithmetic.
+
+    Returns:
+        np.ndarray: uint8 RGB image of shape (H, W, 3).
+    """
+    rgb = np.repeat(gray[..., None], 3, axis=2)
+    for label, color in colors.items():
+        hit = labels == label
+        if not hit.any():
+            continue
+        base = rgb[hit].astype(np.uint16)
+        rgb[hit] = ((base * (256 - alpha) + np.array(color, np.uint16) * alpha) >> 8).astype(np.uint8)
+    return rgb
+
+
+def _square_pixels(img: np.ndarray, row_spacing: float, col_spacing: float) -> np.ndarray:
+    """
+    Nearest-neighbor resample so that rows and columns have the same physical size.
+    """
+    if np.isclose(row_spacing, col_spacing):
+        return img
+    if row_spacing > col_spacing:
+        n = int(round(img.shape[0] * row_spacing / col_spacing))
+        return img[(np.arange(n) * img.shape[0] // n)]
+    n = int(round(img.shape[1] * col_spacing / row_spacing))
+    return img[:, (np.arange(n) * img.shape[1] // n)]
+
+
+def _plane_spacing(spacing, plane: str):
+    # spacing is (x, y, z); plane rows/cols follow the remaining [Z, Y, X] axes
+    zyx = spacing[::-1]
+    rows, cols = [a for a in range(3) if a != AXES[plane]]
+    return zyx[rows], zyx[cols]
+
+
+def render_overlay(ct, mask, out_path: str, plane: str = "coronal", colors: dict = None, index: int = None) -> str:
+    """
+    Save one overlay PNG of `mask` on `ct` (paths, images or Volumes).
+    Binary masks are drawn in MASK_COLOR unless `colors` is given.
+    """
+    gray = window_uint8(read_plane(ct, plane, index))
+    labels = read_plane(mask, plane, index)
+    rgb = overlay_rgb(gray, labels, colors or {1: MASK_COLOR})
+    spacing = read_info(ct).GetSpacing() if isinstance(ct, str) else ct.GetSpacing()
+    rgb = _square_pixels(rgb, *_plane_spacing(spacing, plane))
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    mpimg.imsave(out_path, rgb, origin="upper")
+    return out_path
+
+
+def case_masks(case_dir: str) -> dict:
+    """
+    QA variants present in a case directory: name -> (mask path, colors).
+    """
+    masks = {}
+    labeled = os.path.join(case_dir, "bone_segmented.nii.gz")
+    if os.path.exists(labeled):
+        masks["labeled"] = (labeled, LABEL_COLORS)
+    for pattern in ("mask_tibia_expanded_*", "mask_tibia_random_*"):
+        for path in sorted(glob.glob(os.path.join(case_dir, pattern))):
+            if path.endswith((".nii.gz", ".nii")):
+                name = os.path.basename(path).split(".")[0].replace("mask_tibia_", "")
+                masks[name] = (path, None)
+    return masks
+
+
+def render_case(case_dir: str, ct_path: str, planes=PLANES) -> list:
+    """
+    Render every variant × plane of one case into <case_dir>/qa/.
+
+    Returns:
+        list: Paths of the written PNGs.
+    """
+    out_dir = os.path.join(case_dir, QA_DIR_NAME)
+    written = []
+    for name, (mask_path, colors) in case_masks(case_dir).items():
+        for plane in planes:
+            out_path = os.path.join(out_dir, f"{name}_{plane}.png")
+            written.append(render_overlay(ct_path, mask_path, out_path, plane=plane, colors=colors))
+    return written
+
+
+def contact_sheet(cohort_dir: str, case_ids, plane: str = "coronal", cols: int = 6) -> str:
+    """
+    Tile each case's labeled overlay into one cohort PNG with case ids as titles.
+    """
+    import matplotlib.pyplot as plt
+
+    thumbs = [
+        (cid, os.path.join(cohort_dir, cid, QA_DIR_NAME, f"labeled_{plane}.png")) for cid in case_ids
+    ]
+    thumbs = [(cid, p) for cid, p in thumbs if os.path.exists(p)]
+    rows = max(1, -(-len(thumbs) // cols))
+    fig, axes = plt.subplots(rows, cols, figsize=(2.5 * cols, 2.5 * rows), squeeze=False)
+    for ax in axes.ravel():
+        ax.axis("off")
+    for ax, (cid, path) in zip(axes.ravel(), thumbs):
+        ax.imshow(mpimg.imread(path))
+        ax.set_title(cid, fontsize=8)
+    fig.tight_layout()
+    out_path = os.path.join(cohort_dir, CONTACT_SHEET_NAME)
+    fig.savefig(out_path, dpi=100)
+    plt.close(fig)
+    return out_path
+
+
+def render_cohort(cohort_dir: str, workers: int = None, sheet_plane: str = "coronal") -> str:
+    """
+    Render QA figures for every finished case of a batch.py cohort directory.
+
+    Returns:
+        str: Path to the contact sheet.
+    """
+    from batch import load_manifest
+
+    manifest = load_manifest(cohort_dir)
+    cases = {cid: e["ct"] for cid, e in manifest.items() if e.get("status") == "done"}
+    print(f"🖼 Rendering QA figures for {len(cases)} cases")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(render_case, os.path.join(cohort_dir, cid), ct): cid for cid, ct in cases.items()
+        }
+        for future in as_completed(futures):
+            cid = futures[future]
+            try:
+                future.result()
+            except Exception as exc:
+                print(f"❌ QA rendering failed for {cid}: {exc!r}")
+
+    sheet = contact_sheet(cohort_dir, sorted(cases), plane=sheet_plane)
+    print(f"✅ Contact sheet saved to: {sheet}")
+    return sheet
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render headless QA overlays for a cohort.")
+    parser.add_argument("cohort_dir", help="Cohort output directory written by batch.py")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--plane", default="coronal", choices=PLANES, help="Plane for the contact sheet")
+    args = parser.parse_args()
+    render_cohort(args.cohort_dir, workers=args.workers, sheet_plane=args.plane)
@@ -10,36 +10,52 @@ Randomizes expansion of tibia and femur masks separately and saves combined mask
 
 import SimpleITK as sitk
 import numpy as np
-import os
-import scipy.ndimage as ndi
 
-def randomize_mask_distance_based(original_mask: sitk.Image, ct_image: sitk.Image, max_mm: float, seed=None) -> sitk.Image:
+from distance_map import get_distance_map, get_label_distance_map
+from volume import array_view, as_volume, match_input
+
+def randomize_mask_distance_based(original_mask: sitk.Image, ct_image: sitk.Image, max_mm: float, seed=None,
+                                  key=None) -> sitk.Image:
     """
     Randomly expands a binary mask by a distance ≤ max_mm (in mm), preserving original.
+    The distance map is cached per mask, so further seeds only cost a threshold.
 
     Args:
         original_mask (sitk.Image): Binary mask (0 or 1).
-        ct_image (sitk.Image): Corresponding CT image for spacing.
+        ct_image (sitk.Image): Corresponding CT image (kept for compatibility;
+            spacing is taken from the mask, which shares the CT geometry).
         max_mm (float): Maximum allowed random expansion in mm.
         seed (int): Optional seed for reproducibility.
+        key (tuple): Optional stream key, e.g. (case_id, variant); each (seed, key)
+            is an independent, reproducible stream (see rng_streams.py).
 
     Returns:
         sitk.Image: Randomly expanded binary mask.
     """
-    np.random.seed(seed)
-    mask_array = sitk.GetArrayFromImage(original_mask)
-    spacing = ct_image.GetSpacing()
-    dist_map = ndi.distance_transform_edt(mask_array == 0, sampling=spacing)
-    r_mm = np.random.uniform(0.0, max_mm)
-    new_arr = (mask_array == 1) | (dist_map <= r_mm)
+    return get_distance_map(original_mask).randomize(max_mm, seed=seed, key=key, reference=original_mask)
+
+def randomize_labels_distance_based(labeled_mask: sitk.Image, max_mm, seed=None, key=None) -> sitk.Image:
+    """
+    Randomly expands every label of a labeled mask by its own distance ≤ max_mm,
+    using a single distance transform that carries the nearest label.
 
-    new_mask = sitk.GetImageFromArray(new_arr.astype(np.uint8))
-    new_mask.CopyInformation(original_mask)
-    return new_mask
+    Args:
+        labeled_mask (sitk.Image): Label image (e.g. 1=tibia, 2=femur).
+        max_mm (float or dict): Maximum random expansion in mm, or {label: mm}.
+        seed (int): Optional seed for reproducibility.
+        key (tuple): Optional stream key, e.g. (case_id, variant); every label then
+            draws from its own stream (seed, key + (label,)).
+
+    Returns:
+        sitk.Image: Randomized label image; overlaps go to the nearest original bone
+            whose radius reaches them.
+    """
+    return get_label_distance_map(labeled_mask).randomize(max_mm, seed=seed, key=key, reference=labeled_mask)
 
 def combine_and_save_masks(ct_image: sitk.Image, tibia_mask: sitk.Image, femur_mask: sitk.Image, save_path: str) -> sitk.Image:
     """
     Combines tibia and femur masks with different labels and saves to NIfTI.
+    Inputs may be SimpleITK images or Volumes; they are read without copying.
 
     Args:
         ct_image (sitk.Image): CT scan to copy spatial info.
@@ -48,21 +64,19 @@ def combine_and_save_masks(ct_image: sitk.Image, tibia_mask: sitk.Image, femur_m
         save_path (str): Path to save the labeled mask.
     
     Returns:
-        sitk.Image: Combined label image (1=tibia, 2=femur).
+        sitk.Image: Combined label image (1=tibia, 2=femur); a Volume if ct_image is one.
     """
-    tibia_arr = sitk.GetArrayFromImage(tibia_mask)
-    femur_arr = sitk.GetArrayFromImage(femur_mask)
+    tibia_arr = array_view(tibia_mask)
+    femur_arr = array_view(femur_mask)
 
-    labeled_arr = np.zeros_like(tibia_arr)
+    # Labels need uint8 even when the inputs are bool masks (compact mode)
+    labeled_arr = np.zeros(tibia_arr.shape, dtype=np.uint8)
     labeled_arr[tibia_arr == 1] = 1
     labeled_arr[femur_arr == 1] = 2
 
-    labeled_img = sitk.GetImageFromArray(labeled_arr)
-    labeled_img.CopyInformation(ct_image)
-
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-    sitk.WriteImage(labeled_img, save_path)
+    labeled_vol = as_volume(ct_image).like(labeled_arr)
+    labeled_vol.write(save_path)
     print(f"✅ Combined randomized mask saved at: {save_path}")
 
-    return labeled_img
+    return match_input(ct_image, labeled_vol)
 
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+rng_streams.py
+Independent random streams for mask randomization. A stream is named by a root seed
+and a key of parts such as (case id, variant, label); NumPy's SeedSequence hashes
+both into a PCG64 state. The same (seed, key) gives the same draws in any thread or
+process and in any order, different keys give independent streams, and no global
+NumPy random state is touched.
+"""
+
+import hashlib
+
+import numpy as np
+
+
+def key_words(key) -> tuple:
+    """
+    SeedSequence spawn key for a tuple of key parts: non-negative integers are
+    used as they are, anything else (case ids, variant names) is hashed.
+    """
+    words = []
+    for part in key:
+        if isinstance(part, (int, np.integer)) and not isinstance(part, bool) and part >= 0:
+            words.append(int(part))
+        else:
+            digest = hashlib.blake2b(str(part).encode(), digest_size=8).digest()
+            words.append(int.from_bytes(digest, "little"))
+    return tuple(words)
+
+
+def stream(seed=None, key=()) -> np.random.Generator:
+    """
+    Generator for the stream (seed, key). seed=None takes fresh OS entropy, so
+    such a stream is not reproducible.
+    """
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=key_words(key))))
+
+
+def uniform(seed=None, key=None, high: float = 1.0, size=None):
+    """
+    Uniform draw(s) on [0, high). Without a key this is np.random.RandomState(seed),
+    so seeds used before keyed streams existed reproduce the same values; with a
+    key it comes from stream(seed, key).
+    """
+    rng = np.random.RandomState(seed) if key is None else stream(seed, key)
+    return rng.uniform(0.0, high, size=size)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+roi.py
+Bounding-box region-of-interest helpers. Find the label bounding box once, pad it
+by a safety margin, crop work to that box and paste results back into the full grid.
+
+Boxes are tuples of slices in NumPy order (z, y, x).
+"""
+
+import SimpleITK as sitk
+import numpy as np
+
+from volume import Volume
+
+
+def bounding_box(arr: np.ndarray):
+    """
+    Tight bounding box of the nonzero voxels of a [Z, Y, X] array.
+
+    Returns:
+        tuple of slice (z, y, x), or None if the array is empty.
+    """
+    zs = np.flatnonzero(arr.any(axis=(1, 2)))
+    if len(zs) == 0:
+        return None
+    z0, z1 = int(zs[0]), int(zs[-1]) + 1
+    slab = arr[z0:z1]
+    ys = np.flatnonzero(slab.any(axis=(0, 2)))
+    xs = np.flatnonzero(slab.any(axis=(0, 1)))
+    return (slice(z0, z1), slice(int(ys[0]), int(ys[-1]) + 1), slice(int(xs[0]), int(xs[-1]) + 1))
+
+
+def bounding_box_within(arr: np.ndarray, box):
+    """
+    bounding_box of `arr`, searching only inside a box known to contain every
+    nonzero voxel (e.g. a bone box from segment_bones). Returns full-grid slices.
+    """
+    sub = bounding_box(arr[box])
+    if sub is None:
+        return None
+    return tuple(slice(b.start + s.start, b.start + s.stop) for b, s in zip(box, sub))
+
+
+def margin_voxels(spacing, mm: float):
+    """
+    Per-axis margin in voxels covering `mm` millimeters, in (z, y, x) order.
+
+    Args:
+        spacing: SimpleITK spacing in (x, y, z) order.
+        mm (float): Margin in millimeters.
+    """
+    return tuple(int(np.ceil(mm / s)) + 1 for s in spacing[::-1])
+
+
+def pad_box(box, shape, margin):
+    """
+    Grow a box by `margin` voxels per axis (int or (z, y, x)), clipped to `shape`.
+    """
+    if np.isscalar(margin):
+        margin = (int(margin),) * 3
+    return tuple(
+        slice(max(sl.start - m, 0), min(sl.stop + m, n))
+        for sl, m, n in zip(box, margin, shape)
+    )
+
+
+def box_shape(box):
+    return tuple(sl.stop - sl.start for sl in box)
+
+
+def crop_image(img, box):
+    """
+    Crop a SimpleITK image or Volume to a box. Origin is shifted so that the crop
+    keeps its physical position; spacing and direction are unchanged.
+    """
+    if isinstance(img, Volume):
+        return img.crop(box)
+    index = [box[2].start, box[1].start, box[0].start]
+    size = [box[2].stop - box[2].start, box[1].stop - box[1].start, box[0].stop - box[0].start]
+    return sitk.RegionOfInterest(img, size=size, index=index)
+
+
+def paste_array(shape, box, sub: np.ndarray, dtype=None) -> np.ndarray:
+    """
+    Place a cropped array back into a zero-filled full-size array.
+    """
+    full = np.zeros(shape, dtype=dtype or sub.dtype)
+    full[box] = sub
+    return full
+
+
+def paste_volume(reference, box, sub: np.ndarray) -> Volume:
+    """
+    Place a cropped array back into a full-size Volume with the reference geometry
+    (reference may be a SimpleITK image or a Volume).
+    """
+    full = paste_array(reference.GetSize()[::-1], box, sub)
+    return Volume(full, reference.GetSpacing(), reference.GetOrigin(), reference.GetDirection())
+
+
+def paste_image(reference, box, sub: np.ndarray) -> sitk.Image:
+    """
+    Place a cropped array back into a full-size image with the reference geometry.
+    """
+    return paste_volume(reference, box, sub).to_image()
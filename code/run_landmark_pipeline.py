@@ -10,52 +10,122 @@ Generates expanded and randomized tibia masks and computes tibial landmarks.
 """
 
 import os
-import SimpleITK as sitk
-from landmark_utils import (
-    expand_mask_by_mm,
-    randomize_mask_distance_based,
-    find_medial_lateral_lowest,
-    voxel_to_phys
-)
+import numpy as np
+from distance_map import get_distance_map
+from instrumentation import PROFILE, StageProfiler, active_profiler, stage
+from landmark_store import LANDMARK_DB_NAME, LANDMARK_TSV_NAME, LandmarkStore, write_landmarks_tsv
+from landmark_utils import measure_landmarks
+from mask_metrics import METRICS_TSV_NAME, metric_records, write_metrics_tsv
+from mask_io import MaskWriter, mask_filename
+from roi import box_shape
+from stage_cache import cached_distance_map
+from volume import Volume
 
-def run_landmark_detection(orig_path, ct_path, output_dir):
+# How each variant is made from the original mask (stored with its landmarks).
+# Random variants draw from the stream (seed, (case_id, variant name)), so every case
+# gets its own radius and the result does not depend on which worker runs it.
+VARIANT_PARAMS = {
+    "Original":     {},
+    "Expanded_2mm": {"mm": 2.0},
+    "Expanded_4mm": {"mm": 4.0},
+    "Random_1":     {"max_mm": 2.0, "seed": 1},
+    "Random_2":     {"max_mm": 2.0, "seed": 2},
+}
+
+def run_landmark_detection(orig_path, ct_path, output_dir, mask_format="nii.gz", compresslevel=6,
+                           case_id=None, store_path=None, writer=None, metrics=True, box=None, cache=None,
+                           profile=None):
+    # ct_path is kept for call compatibility; the mask carries all geometry needed.
+    # mask_format: "nii.gz", "nii" or "compact" (see mask_io.py); masks are written
+    # in the background while landmarks are computed.
+    # Landmarks are appended to the SQLite store at store_path (default:
+    # <output_dir>/landmarks.sqlite) under case_id (default: output_dir's name) and
+    # exported to tibial_landmarks.txt. Returns the landmark records.
+    # orig_path may also be an already loaded mask (sitk.Image or Volume). With a
+    # shared `writer` (mask_io.MaskWriter) the mask writes are left queued on it.
+    # With `metrics`, Dice/volume/surface distances of every variant against the
+    # original are written to mask_metrics.txt (see mask_metrics.py).
+    # `box` is a region known to contain the mask (segment_bones' bones["tibia"]["box"]).
+    # With a stage_cache.StageCache as `cache`, the distance map is restored from
+    # (and stored in) the on-disk cache, so reruns with other seeds or radii reuse it.
+    # With `profile` (default: KNEE_PROFILE) and no profiler already active (main.py,
+    # batch.py), per-stage timings are written to stage_report.json/.csv in output_dir
+    # (see instrumentation.py).
     os.makedirs(output_dir, exist_ok=True)
-    ct = sitk.ReadImage(ct_path)
-    orig = sitk.ReadImage(orig_path)
+    case_id = case_id or os.path.basename(os.path.abspath(output_dir))
+    args = (orig_path, output_dir, mask_format, compresslevel, case_id, store_path, writer, metrics, box, cache)
+    if active_profiler() is not None or not (PROFILE if profile is None else profile):
+        return _run_landmark_detection(*args)
+    profiler = StageProfiler(enabled=True)
+    with profiler.activate():
+        records = _run_landmark_detection(*args)
+    print(f"✅ Stage report saved to: {profiler.write(output_dir, case_id)}")
+    return records
 
-    # Create variants of the original mask
-    masks = {
-        "Original":     orig,
-        "Expanded_2mm": expand_mask_by_mm(orig, 2.0),
-        "Expanded_4mm": expand_mask_by_mm(orig, 4.0),
-        "Random_1":     randomize_mask_distance_based(orig, 2.0, seed=1),
-        "Random_2":     randomize_mask_distance_based(orig, 2.0, seed=2),
-    }
 
-    # Save each mask
-    for name, img in masks.items():
-        save_path = os.path.join(output_dir, f"mask_tibia_{name.lower()}.nii.gz")
-        sitk.WriteImage(img, save_path)
-        print(f"✅ Saved {name} mask → {save_path}")
+def _run_landmark_detection(orig_path, output_dir, mask_format, compresslevel, case_id, store_path, writer,
+                            metrics, box, cache):
+    if isinstance(orig_path, str):
+        with stage("read_mask") as s:
+            orig = Volume.read(orig_path)
+            s["voxels"] = orig.array.size
+    else:
+        orig = orig_path
 
-    # Write landmark coordinates
-    landmark_txt = os.path.join(output_dir, "tibial_landmarks.txt")
-    with open(landmark_txt, "w") as f:
-        f.write("Mask\tmed_x\tmed_y\tmed_z\tmed_mm_x\tmed_mm_y\tmed_mm_z\t"
-                "lat_x\tlat_y\tlat_z\tlat_mm_x\tlat_mm_y\tlat_mm_z\n")
-        for name, img in masks.items():
-            medial_vox, lateral_vox = find_medial_lateral_lowest(img)
-            medial_mm = voxel_to_phys(img, medial_vox)
-            lateral_mm = voxel_to_phys(img, lateral_vox)
+    # Create variants of the original mask from a single distance map
+    with stage("distance_map") as s:
+        if cache is not None:
+            dmap = cached_distance_map(orig, 4.0, cache, box=box)
+        else:
+            dmap = get_distance_map(orig, max_mm=4.0, box=box)
+        roi_voxels = 0 if dmap.box is None else int(np.prod(box_shape(dmap.box)))
+        s["voxels"] = roi_voxels
+    masks = {}
+    with stage("variants", voxels=roi_voxels * (len(VARIANT_PARAMS) - 1)):
+        for name, p in VARIANT_PARAMS.items():
+            if "mm" in p:
+                masks[name] = dmap.expand(p["mm"], reference=orig)
+            elif "max_mm" in p:
+                masks[name] = dmap.randomize(p["max_mm"], seed=p["seed"], key=(case_id, name), reference=orig)
+            else:
+                masks[name] = orig
+
+    own_writer = writer is None
+    writer = writer or MaskWriter(compresslevel=compresslevel)
+    paths = []
+    for name, img in masks.items():
+        save_path = os.path.join(output_dir, mask_filename(f"mask_tibia_{name.lower()}", mask_format))
+        writer.submit(img, save_path)
+        paths.append(save_path)
 
-            f.write(
-                f"{name}\t"
-                f"{medial_vox[0]}\t{medial_vox[1]}\t{medial_vox[2]}\t"
-                f"{medial_mm[0]:.2f}\t{medial_mm[1]:.2f}\t{medial_mm[2]:.2f}\t"
-                f"{lateral_vox[0]}\t{lateral_vox[1]}\t{lateral_vox[2]}\t"
-                f"{lateral_mm[0]:.2f}\t{lateral_mm[1]:.2f}\t{lateral_mm[2]:.2f}\n"
-            )
+    # Store landmark coordinates and export the per-case table; metrics reuse the
+    # distance map and the surface indices built for the landmarks
+    indices = {}
+    metrics_txt = None
+    try:
+        with stage("landmarks", voxels=roi_voxels * len(masks)):
+            records = measure_landmarks(case_id, masks, box=dmap.box, params=VARIANT_PARAMS, indices=indices)
+        if metrics:
+            with stage("metrics", voxels=roi_voxels * (len(masks) - 1)):
+                variants = {name: img for name, img in masks.items() if name != "Original"}
+                metrics_txt = write_metrics_tsv(os.path.join(output_dir, METRICS_TSV_NAME),
+                                                metric_records(case_id, orig, variants, dmap=dmap,
+                                                               surfaces=indices))
+    finally:
+        if own_writer:
+            # Masks are compressed in the background from submission on; this is the wait for the rest
+            with stage("write_masks") as s:
+                writer.close()
+                s["bytes_written"] = sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+    with stage("store"):
+        with LandmarkStore(store_path or os.path.join(output_dir, LANDMARK_DB_NAME)) as store:
+            store.extend(records)
+        landmark_txt = write_landmarks_tsv(os.path.join(output_dir, LANDMARK_TSV_NAME), records)
+    print(f"✅ Saved {len(masks)} tibia mask variants ({mask_format}) in {output_dir}")
     print(f"✅ Landmark coordinates saved to: {landmark_txt}")
+    if metrics_txt:
+        print(f"✅ Mask metrics saved to: {metrics_txt}")
+    return records
 
 
 if __name__ == "__main__":
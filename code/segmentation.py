@@ -12,45 +12,136 @@ import SimpleITK as sitk
 import numpy as np
 import os
 
-def segment_bones(image_path, output_dir="results"):
+from bone_separation import separate_bones
+from instrumentation import stage
+from roi import bounding_box, box_shape, pad_box, paste_volume
+from slab_io import read_info, read_slab, write_box_nifti
+from volume import array_view, match_input
+
+CLOSING_RADIUS = 2
+
+def segment_bones(image_path, output_dir="results", lower_threshold=260, upper_threshold=3000, writer=None,
+                  bones=None):
     """
     Segments tibia and femur regions from a CT image.
-    Saves: labeled mask, tibia mask, femur mask.
-    Returns: labeled SimpleITK image.
+    Bone is thresholded to [lower_threshold, upper_threshold] HU.
+    Closing and labeling only run inside the bone bounding box (plus a margin for
+    the closing kernel); results are pasted back into the full CT grid.
+    Femur and tibia are separated by connected components (see bone_separation.py);
+    their statistics and bounding boxes are stored in `bones` (a dict), if given.
+    `image_path` may also be an already loaded sitk.Image or Volume.
+    Saves: labeled mask, tibia mask, femur mask (queued on `writer`, a
+    mask_io.MaskWriter, if given; otherwise written before returning).
+    Returns: labeled mask and CT (as Volumes if a Volume was passed, else SimpleITK images).
     """
-    ct = sitk.ReadImage(image_path)
-    bone_mask = sitk.BinaryThreshold(ct, lowerThreshold=260, upperThreshold=3000, insideValue=1, outsideValue=0)
+    with stage("read_ct") as s:
+        ct = sitk.ReadImage(image_path) if isinstance(image_path, str) else image_path
+        ct_arr = array_view(ct)
+        shape = ct_arr.shape
+        s["voxels"] = ct_arr.size
+    with stage("threshold", voxels=ct_arr.size):
+        # Thresholded in z-slabs so the comparisons never allocate full-size temporaries
+        bone = np.empty(shape, dtype=bool)
+        for z0 in range(0, shape[0], 16):
+            slab = ct_arr[z0:z0 + 16]
+            np.logical_and(slab >= lower_threshold, slab <= upper_threshold, out=bone[z0:z0 + 16])
+
+        box = bounding_box(bone)
+        if box is None:
+            box = tuple(slice(0, n) for n in shape)
+        box = pad_box(box, shape, 2 * CLOSING_RADIUS + 1)
+
+    with stage("closing", voxels=int(np.prod(box_shape(box)))):
+        closing = sitk.BinaryMorphologicalClosingImageFilter()
+        closing.SetKernelRadius(CLOSING_RADIUS)
+        closing.SetForegroundValue(1)
+        bone_roi = closing.Execute(sitk.GetImageFromArray(bone[box].astype(np.uint8)))
+        del bone
+
+    with stage("separation", voxels=int(np.prod(box_shape(box)))):
+        # One ROI label array (1=tibia, 2=femur); the binary masks are derived per write
+        labeled_arr, stats = separate_bones(sitk.GetArrayViewFromImage(bone_roi), offset=[sl.start for sl in box],
+                                            shape=shape, spacing=ct.GetSpacing())
+        del bone_roi
+    if bones is not None:
+        bones.update(stats)
+
+    with stage("write_segmentation", voxels=3 * ct_arr.size):
+        write = writer.call if writer is not None else (lambda fn, *args: fn(*args))
+        write(write_box_nifti, os.path.join(output_dir, "bone_segmented.nii.gz"), ct, box, labeled_arr)
+        write(write_box_nifti, os.path.join(output_dir, "mask_tibia.nii.gz"), ct, box, labeled_arr == 1)
+        write(write_box_nifti, os.path.join(output_dir, "mask_femur.nii.gz"), ct, box, labeled_arr == 2)
+    labeled_vol = paste_volume(ct, box, labeled_arr)
+
+    print("✅ Saved bone_segmented.nii.gz, mask_tibia.nii.gz, and mask_femur.nii.gz")
+
+    return match_input(ct, labeled_vol), ct
+
+def segment_bones_streaming(image_path, output_dir="results", slab_size=32, lower_threshold=260, upper_threshold=3000,
+                            bones=None):
+    """
+    Same segmentation as segment_bones, with the CT processed in z-slabs so peak
+    memory is bounded by the slab size instead of the scan size. Each slab is read
+    with a halo of 2 * CLOSING_RADIUS slices so the closing matches the in-memory
+    path voxel for voxel; the closed mask is kept bit-packed (1 bit per voxel).
+    Femur and tibia are then separated on the bone ROI by connected components
+    (bone_separation.separate_bones, as in segment_bones), which needs the ROI as
+    one uint8 array, and the outputs are written slab by slab.
+    Saves: labeled mask, tibia mask, femur mask. Per-bone statistics go to `bones`
+    (a dict), if given.
+    Returns: path to the labeled mask.
+    """
+    reader = read_info(image_path)
+    nx, ny, nz = reader.GetSize()
+    shape = (nz, ny, nx)
+    halo = 2 * CLOSING_RADIUS
 
     closing = sitk.BinaryMorphologicalClosingImageFilter()
-    closing.SetKernelRadius(2)
+    closing.SetKernelRadius(CLOSING_RADIUS)
     closing.SetForegroundValue(1)
-    bone_mask = closing.Execute(bone_mask)
 
-    bone_arr = sitk.GetArrayFromImage(bone_mask)
-    z_split = bone_arr.shape[0] // 2 - 5
-    tibia_arr = np.zeros_like(bone_arr)
-    femur_arr = np.zeros_like(bone_arr)
-    tibia_arr[z_split:] = bone_arr[z_split:]
-    femur_arr[:z_split] = bone_arr[:z_split]
+    # Closed slabs (packed) and the box of the thresholded bone, as segment_bones computes it
+    packed = []
+    starts, stops = [], []
+    for z0 in range(0, nz, slab_size):
+        z1 = min(z0 + slab_size, nz)
+        h0, h1 = max(z0 - halo, 0), min(z1 + halo, nz)
 
-    labeled_arr = np.zeros_like(bone_arr)
-    labeled_arr[tibia_arr == 1] = 1
-    labeled_arr[femur_arr == 1] = 2
+        ct_slab = read_slab(reader, h0, h1)
+        bone_mask = sitk.BinaryThreshold(ct_slab, lowerThreshold=lower_threshold, upperThreshold=upper_threshold, insideValue=1, outsideValue=0)
+        del ct_slab
+        slab_box = bounding_box(sitk.GetArrayFromImage(bone_mask)[z0 - h0:z1 - h0])
+        if slab_box is not None:
+            starts.append([z0 + slab_box[0].start, slab_box[1].start, slab_box[2].start])
+            stops.append([z0 + slab_box[0].stop, slab_box[1].stop, slab_box[2].stop])
+        bone_arr = sitk.GetArrayFromImage(closing.Execute(bone_mask))[z0 - h0:z1 - h0]
+        packed.append((z0, z1, np.packbits(bone_arr)))
 
-    labeled_img = sitk.GetImageFromArray(labeled_arr)
-    labeled_img.CopyInformation(ct)
+    if starts:
+        box = tuple(slice(a, b) for a, b in zip(np.min(starts, axis=0), np.max(stops, axis=0)))
+    else:
+        box = tuple(slice(0, n) for n in shape)
+    box = pad_box(box, shape, 2 * CLOSING_RADIUS + 1)
 
-    os.makedirs(output_dir, exist_ok=True)
-    sitk.WriteImage(labeled_img, os.path.join(output_dir, "bone_segmented.nii.gz"))
+    closed = np.zeros(box_shape(box), dtype=np.uint8)
+    for z0, z1, bits in packed:
+        a, b = max(z0, box[0].start), min(z1, box[0].stop)
+        if a < b:
+            slab = np.unpackbits(bits, count=(z1 - z0) * ny * nx).reshape(z1 - z0, ny, nx)
+            closed[a - box[0].start:b - box[0].start] = slab[a - z0:b - z0, box[1], box[2]]
+    del packed
 
-    tibia_img = sitk.GetImageFromArray(tibia_arr.astype(np.uint8))
-    femur_img = sitk.GetImageFromArray(femur_arr.astype(np.uint8))
-    tibia_img.CopyInformation(ct)
-    femur_img.CopyInformation(ct)
-    sitk.WriteImage(tibia_img, os.path.join(output_dir, "mask_tibia.nii.gz"))
-    sitk.WriteImage(femur_img, os.path.join(output_dir, "mask_femur.nii.gz"))
+    labeled_arr, stats = separate_bones(closed, offset=[sl.start for sl in box], shape=shape,
+                                        spacing=reader.GetSpacing())
+    del closed
+    if bones is not None:
+        bones.update(stats)
 
-    print("✅ Saved bone_segmented.nii.gz, mask_tibia.nii.gz, and mask_femur.nii.gz")
+    labeled_path = os.path.join(output_dir, "bone_segmented.nii.gz")
+    write_box_nifti(labeled_path, reader, box, labeled_arr, slab_size=slab_size)
+    write_box_nifti(os.path.join(output_dir, "mask_tibia.nii.gz"), reader, box, labeled_arr == 1, slab_size=slab_size)
+    write_box_nifti(os.path.join(output_dir, "mask_femur.nii.gz"), reader, box, labeled_arr == 2, slab_size=slab_size)
 
-    return labeled_img, ct
+    print("✅ Saved bone_segmented.nii.gz, mask_tibia.nii.gz, and mask_femur.nii.gz (streamed)")
 
+    return labeled_path
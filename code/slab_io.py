@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+slab_io.py
+Z-slab streaming helpers: read a region of a NIfTI volume without loading the rest,
+and write a NIfTI volume slab by slab so the full array never exists in memory.
+"""
+
+import gzip
+import os
+import struct
+import tempfile
+
+import SimpleITK as sitk
+import numpy as np
+
+NIFTI_DIM_OFFSET = 40
+NIFTI_VOX_OFFSET = 108
+
+
+def read_info(path: str) -> sitk.ImageFileReader:
+    """
+    Reader with header information loaded (size, spacing, origin, direction) but no pixels.
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader
+
+
+def read_slab(reader: sitk.ImageFileReader, z0: int, z1: int) -> sitk.Image:
+    """
+    Read slices [z0, z1) of the volume behind `reader`. The returned image keeps
+    its physical position (origin shifted to slice z0).
+    """
+    nx, ny, _ = reader.GetSize()
+    reader.SetExtractIndex([0, 0, z0])
+    reader.SetExtractSize([nx, ny, z1 - z0])
+    return reader.Execute()
+
+
+class SlabNiftiWriter:
+    """
+    Writes a 3D NIfTI file incrementally in z order.
+
+    The header is produced by SimpleITK from a one-slice image with the target
+    geometry (so orientation matches sitk.WriteImage exactly), then patched with
+    the full slice count. Slabs are appended as raw voxels; `.nii.gz` paths are
+    gzip-compressed on the fly.
+    """
+
+    def __init__(self, path: str, reference: sitk.ImageFileReader, dtype=np.uint8, compresslevel: int = 6):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.size = reference.GetSize()
+        self.written = 0
+
+        header = self._header(reference)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = gzip.open(path, "wb", compresslevel=compresslevel) if path.endswith(".gz") else open(path, "wb")
+        self._file.write(header)
+
+    def _header(self, reference) -> bytes:
+        nx, ny, nz = self.size
+        probe = sitk.GetImageFromArray(np.zeros((1, ny, nx), dtype=self.dtype))
+        probe.SetSpacing(reference.GetSpacing())
+        probe.SetOrigin(reference.GetOrigin())
+        probe.SetDirection(reference.GetDirection())
+
+        fd, tmp = tempfile.mkstemp(suffix=".nii")
+        os.close(fd)
+        try:
+            sitk.WriteImage(probe, tmp, useCompression=False)
+            with open(tmp, "rb") as f:
+                raw = f.read()
+        finally:
+            os.remove(tmp)
+
+        vox_offset = int(struct.unpack_from("<f", raw, NIFTI_VOX_OFFSET)[0])
+        header = bytearray(raw[:vox_offset])
+        struct.pack_into("<h", header, NIFTI_DIM_OFFSET + 2 * 3, nz)
+        return bytes(header)
+
+    def write(self, slab: np.ndarray):
+        """
+        Append a [Z, Y, X] slab directly below the previously written slices.
+        """
+        if slab.shape[1:] != (self.size[1], self.size[0]):
+            raise ValueError(f"Slab shape {slab.shape} does not match volume size {self.size}")
+        self._file.write(np.ascontiguousarray(slab, dtype=self.dtype).tobytes())
+        self.written += slab.shape[0]
+
+    def close(self):
+        self._file.close()
+        if self.written != self.size[2]:
+            raise RuntimeError(f"{self.path}: wrote {self.written} of {self.size[2]} slices")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+
+def write_box_nifti(path: str, reference, box, sub: np.ndarray, dtype=np.uint8, compresslevel: int = 6,
+                    slab_size: int = 16):
+    """
+    Write a volume that is zero outside `box` (z, y, x slices, see roi.py) and `sub`
+    inside it, slab by slab, so no full-size array is built.
+    """
+    nx, ny, nz = reference.GetSize()
+    with SlabNiftiWriter(path, reference, dtype=dtype, compresslevel=compresslevel) as writer:
+        for z0 in range(0, nz, slab_size):
+            z1 = min(z0 + slab_size, nz)
+            slab = np.zeros((z1 - z0, ny, nx), dtype=dtype)
+            a, b = max(z0, box[0].start), min(z1, box[0].stop)
+            if a < b:
+                slab[a - z0:b - z0, box[1], box[2]] = sub[a - box[0].start:b - box[0].start]
+            writer.write(slab)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+slice_io.py
+Read a single 2D plane (coronal, sagittal or axial) of a volume without decoding
+the rest of it. Uncompressed NIfTI files are memory-mapped, so only the touched
+rows are paged in; other files go through SimpleITK's region-extracting reader.
+In-memory images and Volumes are sliced through zero-copy array views.
+"""
+
+import struct
+
+import numpy as np
+
+from slab_io import read_info
+from volume import array_view
+
+# Plane name -> NumPy axis of a [Z, Y, X] array that is held fixed
+AXES = {"axial": 0, "coronal": 1, "sagittal": 2}
+
+NIFTI_DTYPES = {
+    2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 64: np.float64,
+    256: np.int8, 512: np.uint16, 768: np.uint32, 1024: np.int64, 1280: np.uint64,
+}
+
+
+def volume_shape(src):
+    """
+    [Z, Y, X] shape of a file (from its header), sitk.Image or Volume.
+    """
+    if isinstance(src, str):
+        return tuple(read_info(src).GetSize()[::-1])
+    return tuple(src.GetSize()[::-1])
+
+
+def _nifti_memmap(path: str):
+    """
+    Memory-map the voxels of an uncompressed little-endian NIfTI-1 file, or return
+    None if the file is not one.
+    """
+    with open(path, "rb") as f:
+        header = f.read(352)
+    if len(header) < 348 or struct.unpack_from("<i", header, 0)[0] != 348:
+        return None
+    dim = struct.unpack_from("<8h", header, 40)
+    datatype = struct.unpack_from("<h", header, 70)[0]
+    vox_offset = int(struct.unpack_from("<f", header, 108)[0])
+    slope, inter = struct.unpack_from("<2f", header, 112)
+    if dim[0] != 3 or datatype not in NIFTI_DTYPES:
+        return None
+    shape = (dim[3], dim[2], dim[1])
+    arr = np.memmap(path, dtype=np.dtype(NIFTI_DTYPES[datatype]).newbyteorder("<"), mode="r",
+                    offset=vox_offset, shape=shape)
+    return arr, slope, inter
+
+
+def _plane_index(axis: int, index: int):
+    return (slice(None),) * axis + (index,)
+
+
+def _extract_plane(path: str, axis: int, index: int) -> np.ndarray:
+    import SimpleITK as sitk
+
+    reader = read_info(path)
+    size = list(reader.GetSize())
+    start = [0, 0, 0]
+    itk_axis = 2 - axis
+    start[itk_axis] = index
+    size[itk_axis] = 1
+    reader.SetExtractIndex(start)
+    reader.SetExtractSize(size)
+    return sitk.GetArrayFromImage(reader.Execute())[_plane_index(axis, 0)]
+
+
+def read_plane(src, plane: str = "coronal", index: int = None) -> np.ndarray:
+    """
+    2D plane of a volume.
+
+    Args:
+        src: NIfTI/other image path, sitk.Image or Volume.
+        plane (str): "coronal" ([Z, X]), "sagittal" ([Z, Y]) or "axial" ([Y, X]).
+        index (int): Slice index along the fixed axis (default: middle slice).
+
+    Returns:
+        np.ndarray: The plane (a view for in-memory sources, a copy for files).
+    """
+    axis = AXES[plane]
+    if index is None:
+        index = volume_shape(src)[axis] // 2
+
+    if not isinstance(src, str):
+        return array_view(src)[_plane_index(axis, index)]
+
+    if src.endswith(".nii"):
+        mapped = _nifti_memmap(src)
+        if mapped is not None:
+            arr, slope, inter = mapped
+            plane_arr = np.array(arr[_plane_index(axis, index)])
+            if slope not in (0.0, 1.0) or inter != 0.0:
+                plane_arr = plane_arr * slope + inter
+            return plane_arr
+    return _extract_plane(src, axis, index)
+
+
+def read_coronal_slice(src, y: int = None) -> np.ndarray:
+    """
+    Coronal plane [Z, X] at row y (default: middle).
+    """
+    return read_plane(src, "coronal", y)
+
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+stage_cache.py
+Content-addressed on-disk cache for pipeline stages. Each stage output is keyed on
+the content hash of its inputs plus its parameters, so a rerun only recomputes the
+stages whose inputs or parameters changed. The cache is bounded in size and evicts
+least recently used entries.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import SimpleITK as sitk
+import numpy as np
+
+from instrumentation import stage
+from rng_streams import key_words
+from volume import as_image, mask_digest
+
+DEFAULT_CACHE_DIR = ".stage_cache"
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+_FILE_DIGESTS = {}
+
+
+def file_digest(path: str) -> str:
+    """
+    Content hash of a file, memoized on (path, size, mtime) within the process.
+    """
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if memo_key in _FILE_DIGESTS:
+        return _FILE_DIGESTS[memo_key]
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _FILE_DIGESTS[memo_key] = digest
+    return digest
+
+
+class StageCache:
+    """
+    Directory of cache entries named <key>-<name>.<ext>. Reads refresh an entry's
+    modification time; writes evict the oldest entries once max_bytes is exceeded.
+    Entries are written to a private temporary file and renamed into place, and
+    eviction tolerates entries that disappear under it, so several processes can
+    share one cache directory.
+    """
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(stage: str, params: dict, *input_digests: str) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(stage.encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        for digest in input_digests:
+            h.update(digest.encode())
+        return h.hexdigest()
+
+    def _path(self, key: str, name: str) -> str:
+        return os.path.join(self.root, f"{key}-{name}")
+
+    def _hit(self, key: str, name: str):
+        path = self._path(key, name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    @contextmanager
+    def _atomic(self, path: str, suffix: str = ""):
+        """
+        Yield a temporary path next to `path` (ending in ".tmp" + suffix) to write
+        the entry to; it replaces `path` once the block succeeds.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=os.path.basename(path) + ".", suffix=".tmp" + suffix)
+        os.close(fd)
+        try:
+            yield tmp
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._evict()
+
+    def get_file(self, key: str, name: str):
+        """
+        Path of a cached file, or None on a miss.
+        """
+        return self._hit(key, name)
+
+    def put_file(self, key: str, name: str, src_path: str) -> str:
+        path = self._path(key, name)
+        with self._atomic(path) as tmp:
+            shutil.copyfile(src_path, tmp)
+        return path
+
+    def get_image(self, key: str, name: str):
+        path = self._hit(key, name + ".nii.gz")
+        return sitk.ReadImage(path) if path else None
+
+    def put_image(self, key: str, name: str, img: sitk.Image):
+        # Fast gzip level: cached masks are mostly zeros and compress well anyway
+        path = self._path(key, name + ".nii.gz")
+        with self._atomic(path, ".nii.gz") as tmp:
+            sitk.WriteImage(as_image(img), tmp, True, 1)
+
+    def get_json(self, key: str, name: str):
+        path = self._hit(key, name + ".json")
+        if not path:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # Evicted by another process since the hit
+            return None
+
+    def put_json(self, key: str, name: str, obj):
+        path = self._path(key, name + ".json")
+        with self._atomic(path) as tmp, open(tmp, "w") as f:
+            json.dump(obj, f)
+
+    def get_arrays(self, key: str, name: str):
+        path = self._hit(key, name + ".npz")
+        if not path:
+            return None
+        try:
+            with np.load(path) as data:
+                return {k: data[k] for k in data.files}
+        except FileNotFoundError:
+            return None
+
+    def put_arrays(self, key: str, name: str, **arrays):
+        path = self._path(key, name + ".npz")
+        with self._atomic(path) as tmp, open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+
+    def _entries(self):
+        """
+        (mtime_ns, size, path) of every complete entry, from one stat per file.
+        Entries removed by another process meanwhile are skipped.
+        """
+        entries = []
+        for e in os.scandir(self.root):
+            if ".tmp" in e.name:
+                continue
+            try:
+                if not e.is_file():
+                    continue
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, e.path))
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+SEGMENT_OUTPUTS = ("bone_segmented.nii.gz", "mask_tibia.nii.gz", "mask_femur.nii.gz")
+
+
+def cached_segment_bones(image_path, output_dir="results", cache: StageCache = None,
+                         lower_threshold=260, upper_threshold=3000, bones=None, ct=None) -> sitk.Image:
+    """
+    segment_bones with caching. On a hit the cached masks are copied into
+    output_dir without re-reading the CT. The per-bone statistics are cached
+    with the masks and stored in `bones` (a dict), if given, on hits and misses.
+    `ct` is the already decoded image_path, if the caller has it; a miss then
+    segments it instead of reading the file again.
+
+    Returns:
+        sitk.Image: Labeled mask (1=tibia, 2=femur).
+    """
+    from bone_separation import SEPARATION_VERSION, bones_from_json, bones_to_json
+    from segmentation import segment_bones
+
+    cache = cache or StageCache()
+    params = {"lower_threshold": lower_threshold, "upper_threshold": upper_threshold,
+              "separation": SEPARATION_VERSION}
+    key = cache.key("segment_bones", params, file_digest(image_path))
+    os.makedirs(output_dir, exist_ok=True)
+
+    hits = [cache.get_file(key, name) for name in SEGMENT_OUTPUTS]
+    stored = cache.get_json(key, "bones") if all(hits) else None
+    if stored is not None:
+        with stage("segment_cache_hit") as s:
+            for name, path in zip(SEGMENT_OUTPUTS, hits):
+                shutil.copyfile(path, os.path.join(output_dir, name))
+            if bones is not None:
+                bones.update(bones_from_json(stored))
+            labeled = sitk.ReadImage(os.path.join(output_dir, SEGMENT_OUTPUTS[0]))
+            s["voxels"] = labeled.GetNumberOfPixels()
+        print(f"♻️ segment_bones cache hit for {image_path}")
+        return labeled
+
+    stats = {}
+    labeled_img, _ = segment_bones(image_path if ct is None else ct, output_dir, lower_threshold, upper_threshold,
+                                   bones=stats)
+    for name in SEGMENT_OUTPUTS:
+        cache.put_file(key, name, os.path.join(output_dir, name))
+    cache.put_json(key, "bones", bones_to_json(stats))
+    if bones is not None:
+        bones.update(stats)
+    return labeled_img
+
+
+def cached_distance_map(mask: sitk.Image, max_mm: float, cache: StageCache = None, box=None):
+    """
+    DistanceMap for `mask` covering `max_mm`, restored from the cache when a
+    transform with at least that margin was stored before by the same EDT backend
+    and distance dtype. `box` is passed on to DistanceMap.
+    """
+    from distance_map import DistanceMap
+
+    cache = cache or StageCache()
+    digest = mask_digest(mask)
+    dmap = DistanceMap(mask, box=box)
+    key = cache.key("distance_map", {"backend": dmap.backend, "dtype": dmap.dtype}, digest)
+
+    stored = cache.get_arrays(key, "distance")
+    if stored is not None and float(stored["max_mm"]) >= max_mm:
+        box = tuple(slice(int(a), int(b)) for a, b in stored["box"])
+        dmap.restore(box, stored["distance"], float(stored["max_mm"]))
+        return dmap
+
+    roi_box, distance, _ = dmap.ensure(max_mm)
+    if roi_box is not None:
+        box = np.array([[sl.start, sl.stop] for sl in roi_box])
+        cache.put_arrays(key, "distance", box=box, distance=distance, max_mm=np.array(max_mm))
+    return dmap
+
+
+def cached_expand_mask_by_mm(mask: sitk.Image, expansion_mm: float, cache: StageCache = None) -> sitk.Image:
+    """
+    expand_mask_by_mm with caching of both the result and the distance map.
+    """
+    cache = cache or StageCache()
+    key = cache.key("expand_mask_by_mm", {"mm": expansion_mm}, mask_digest(mask))
+    img = cache.get_image(key, "mask")
+    if img is None:
+        img = cached_distance_map(mask, expansion_mm, cache).expand(expansion_mm)
+        cache.put_image(key, "mask", img)
+    return img
+
+
+def cached_randomize_mask_distance_based(mask: sitk.Image, max_mm: float, seed=None,
+                                         cache: StageCache = None, key=None) -> sitk.Image:
+    """
+    randomize_mask_distance_based with caching. Unseeded calls are not reproducible
+    and therefore bypass the result cache (the distance map is still reused).
+    """
+    cache = cache or StageCache()
+    if seed is None:
+        return cached_distance_map(mask, max_mm, cache).randomize(max_mm, key=key)
+    params = {"max_mm": max_mm, "seed": seed}
+    if key is not None:
+        params["key"] = list(key_words(key))
+    entry = cache.key("randomize_mask_distance_based", params, mask_digest(mask))
+    img = cache.get_image(entry, "mask")
+    if img is None:
+        img = cached_distance_map(mask, max_mm, cache).randomize(max_mm, seed=seed, key=key)
+        cache.put_image(entry, "mask", img)
+    return img
+
+
+def cached_find_medial_lateral_lowest(mask: sitk.Image, cache: StageCache = None):
+    """
+    find_medial_lateral_lowest with caching.
+
+    Returns:
+        (medial, lateral): voxel index tuples (x, y, z).
+    """
+    from landmark_utils import find_medial_lateral_lowest
+
+    cache = cache or StageCache()
+    key = cache.key("find_medial_lateral_lowest", {}, mask_digest(mask))
+    stored = cache.get_json(key, "landmarks")
+    if stored is not None:
+        return tuple(stored["medial"]), tuple(stored["lateral"])
+    medial, lateral = find_medial_lateral_lowest(mask)
+    cache.put_json(key, "landmarks", {"medial": medial, "lateral": lateral})
+    return medial, lateral
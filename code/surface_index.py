@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+surface_index.py
+Boundary point set of a mask with a spatial index, for landmark queries. The mask
+surface (voxels with at least one 6-neighbor outside the mask) is extracted once
+inside the mask's bounding box and kept as sorted voxel indices plus physical
+coordinates. Landmarks are then answered from the point set (per-slice ranges by
+binary search, nearest/radius queries through a KD-tree) instead of scanning the
+volume again for every landmark type and mask variant.
+
+New landmark types are functions of a SurfaceIndex registered in LANDMARKS.
+"""
+
+import numpy as np
+
+from roi import bounding_box, bounding_box_within, pad_box
+from volume import array_view
+
+
+class SurfaceIndex:
+    """
+    Surface voxels of a mask. Points are stored in (z, y, x) voxel order sorted
+    like np.nonzero (z, then y, then x); `points_mm` and `tree` (physical (x, y, z)
+    in mm) are built on first use.
+
+    Args:
+        mask: sitk.Image or Volume.
+        box: Optional (z, y, x) slices known to contain the mask (see roi.py).
+    """
+
+    def __init__(self, mask, box=None):
+        self.mask = mask
+        arr = array_view(mask)
+        box = bounding_box(arr) if box is None else bounding_box_within(arr, box)
+        if box is None:
+            raise RuntimeError("Mask is empty.")
+        # One voxel of padding so the erosion sees background around the box
+        padded = pad_box(box, arr.shape, 1)
+        sub = arr[padded] > 0
+        surface = sub & ~_interior(sub)
+        offset = np.array([sl.start for sl in padded], dtype=np.int64)
+        self.zyx = np.argwhere(surface) + offset
+        self._points_mm = None
+        self._tree = None
+
+    def __len__(self):
+        return len(self.zyx)
+
+    @property
+    def points_mm(self) -> np.ndarray:
+        if self._points_mm is None:
+            from landmark_utils import voxel_to_phys_array
+
+            self._points_mm = voxel_to_phys_array(self.mask, self.zyx[:, ::-1])
+        return self._points_mm
+
+    @property
+    def tree(self):
+        """
+        scipy.spatial.cKDTree of points_mm.
+        """
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+
+            self._tree = cKDTree(self.points_mm)
+        return self._tree
+
+    def to_phys(self, idx):
+        """
+        Physical point of an (x, y, z) voxel index, as TransformIndexToPhysicalPoint.
+        """
+        return self.mask.TransformIndexToPhysicalPoint(tuple(int(i) for i in idx))
+
+    def slice_points(self, z: int) -> np.ndarray:
+        """
+        (y, x) surface voxels on slice z, in row-major order.
+        """
+        lo, hi = np.searchsorted(self.zyx[:, 0], [z, z + 1])
+        return self.zyx[lo:hi, 1:]
+
+    def z_range(self):
+        return int(self.zyx[0, 0]), int(self.zyx[-1, 0])
+
+    def extreme(self, axis: int, largest: bool = True):
+        """
+        (x, y, z) voxel index of the first surface point (in sorted order) with the
+        smallest or largest index along `axis` (0=z, 1=y, 2=x).
+        """
+        values = self.zyx[:, axis]
+        i = int(values.argmax() if largest else values.argmin())
+        return tuple(int(v) for v in self.zyx[i, ::-1])
+
+    def nearest(self, points_mm, k: int = 1):
+        """
+        Distances (mm) and (x, y, z) voxel indices of the k surface points nearest
+        to each physical point.
+        """
+        dist, idx = self.tree.query(np.asarray(points_mm, dtype=float), k=k)
+        return dist, self.zyx[idx][..., ::-1]
+
+    def within(self, point_mm, radius_mm: float) -> np.ndarray:
+        """
+        (x, y, z) voxel indices of the surface points within `radius_mm` of a point.
+        """
+        idx = np.sort(self.tree.query_ball_point(np.asarray(point_mm, dtype=float), radius_mm))
+        return self.zyx[idx.astype(np.int64)][:, ::-1]
+
+    def landmark(self, name: str, **kwargs) -> dict:
+        """
+        Evaluate a registered landmark: {point name: (x, y, z) voxel index}.
+        """
+        return LANDMARKS[name](self, **kwargs)
+
+
+def _interior(mask: np.ndarray) -> np.ndarray:
+    """
+    Voxels whose six face neighbors are all set (outside the array counts as unset).
+    """
+    inner = np.zeros_like(mask)
+    core = mask[1:-1, 1:-1, 1:-1].copy()
+    for axis in range(3):
+        for step in (slice(None, -2), slice(2, None)):
+            idx = [slice(1, -1)] * 3
+            idx[axis] = step
+            core &= mask[tuple(idx)]
+    inner[1:-1, 1:-1, 1:-1] = core
+    return inner
+
+
+def medial_lateral_lowest(index: SurfaceIndex) -> dict:
+    """
+    Largest- and smallest-x voxels on the lowest (largest z) slice; identical to
+    find_medial_lateral_lowest, since every voxel of that slice and the x extremes
+    of any slice lie on the surface.
+    """
+    z_low = index.z_range()[1]
+    yx = index.slice_points(z_low)
+    xs = yx[:, 1]
+    lat, med = int(xs.argmin()), int(xs.argmax())
+    return {
+        "medial": (int(yx[med, 1]), int(yx[med, 0]), z_low),
+        "lateral": (int(yx[lat, 1]), int(yx[lat, 0]), z_low),
+    }
+
+
+def axis_extremes(index: SurfaceIndex) -> dict:
+    """
+    Surface extremes along each voxel axis (e.g. condyle extremes along x).
+    """
+    points = {}
+    for axis, name in ((2, "x"), (1, "y"), (0, "z")):
+        points[f"{name}_min"] = index.extreme(axis, largest=False)
+        points[f"{name}_max"] = index.extreme(axis, largest=True)
+    return points
+
+
+def slice_centroid(index: SurfaceIndex, depth: int = 0) -> dict:
+    """
+    Centroid (voxel units) of the surface points in the `depth` + 1 lowest slices.
+    """
+    z_low = index.z_range()[1]
+    lo = np.searchsorted(index.zyx[:, 0], z_low - depth)
+    return {"centroid": tuple(float(v) for v in index.zyx[lo:].mean(axis=0)[::-1])}
+
+
+LANDMARKS = {
+    "medial_lateral_lowest": medial_lateral_lowest,
+    "axis_extremes": axis_extremes,
+    "slice_centroid": slice_centroid,
+}
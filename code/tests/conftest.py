@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Pipeline modules are imported flat from code/, as the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,10 @@
+import pytest
+
+from cli import main
+
+
+def test_segment_rejects_cache_with_streaming(tmp_path, capsys):
+    with pytest.raises(SystemExit) as exc:
+        main(["segment", str(tmp_path / "ct.nii.gz"), "-o", str(tmp_path), "--cache", "--streaming"])
+    assert exc.value.code == 2
+    assert "--streaming cannot be combined with --cache" in capsys.readouterr().err
@@ -0,0 +1,40 @@
+"""
+Compact mode (KNEE_COMPACT=1): derived binary masks are bool, but labeled masks
+must keep their label values.
+"""
+
+import os
+
+import SimpleITK as sitk
+import numpy as np
+import pytest
+
+import volume
+from benchmarks.phantom import knee_phantom
+from bone_separation import FEMUR_LABEL, TIBIA_LABEL, bone_mask
+from randomization import combine_and_save_masks, randomize_mask_distance_based
+from segmentation import segment_bones
+from volume import as_volume
+
+
+@pytest.fixture
+def compact(monkeypatch):
+    monkeypatch.setattr(volume, "COMPACT", True)
+
+
+def test_combine_and_save_masks_keeps_labels(compact, tmp_path):
+    ct = as_volume(knee_phantom(shape=(48, 48, 48)))
+    bones = {}
+    labeled, _ = segment_bones(ct, output_dir=str(tmp_path), bones=bones)
+    tibia = bone_mask(labeled, bones["tibia"])
+    femur = bone_mask(labeled, bones["femur"])
+    assert tibia.array.dtype == np.bool_
+
+    tibia_random = randomize_mask_distance_based(tibia, tibia, max_mm=2.0, seed=1)
+    path = os.path.join(str(tmp_path), "bone_segmented_randomized.nii.gz")
+    combined = combine_and_save_masks(ct, tibia_random, femur, path)
+
+    for arr in (combined.array, sitk.GetArrayFromImage(sitk.ReadImage(path))):
+        assert set(np.unique(arr)) == {0, TIBIA_LABEL, FEMUR_LABEL}
+        assert np.array_equal(arr == FEMUR_LABEL, femur.array)
+        assert np.array_equal(arr == TIBIA_LABEL, tibia_random.array & ~femur.array)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+
+from edt import BACKENDS, distance_transform
+
+SPACING = (2.5, 0.8, 0.6)
+
+
+@pytest.fixture
+def background():
+    rng = np.random.default_rng(0)
+    return rng.random((20, 24, 28)) > 0.02
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("dtype", (np.float32, np.float64))
+def test_matches_scipy(background, backend, dtype):
+    expected = ndi.distance_transform_edt(background, sampling=SPACING)
+    dist = distance_transform(background, SPACING, backend=backend, dtype=dtype)
+    assert dist.dtype == dtype
+    assert dist.shape == background.shape
+    assert np.allclose(dist, expected, rtol=1e-5, atol=1e-4)
+
+
+def test_unknown_backend(background):
+    with pytest.raises(ValueError):
+        distance_transform(background, SPACING, backend="parallel")
@@ -0,0 +1,72 @@
+import os
+import threading
+
+import SimpleITK as sitk
+import numpy as np
+
+import distance_map
+from stage_cache import StageCache, cached_distance_map
+
+
+def test_round_trip_leaves_no_temporary_files(tmp_path):
+    cache = StageCache(str(tmp_path))
+    cache.put_json("k", "obj", {"a": 1})
+    cache.put_arrays("k", "arr", x=np.arange(3))
+    assert cache.get_json("k", "obj") == {"a": 1}
+    assert np.array_equal(cache.get_arrays("k", "arr")["x"], np.arange(3))
+    assert cache.get_json("missing", "obj") is None
+    assert not [name for name in os.listdir(tmp_path) if ".tmp" in name]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = StageCache(str(tmp_path), max_bytes=10 ** 6)
+    for i in range(3):
+        cache.put_json(f"k{i}", "obj", {"i": i})
+        path = cache._path(f"k{i}", "obj.json")
+        os.utime(path, ns=(i * 10 ** 9, i * 10 ** 9))
+    cache.max_bytes = cache.size() - 1
+    cache.put_json("k3", "obj", {"i": 3})
+    assert cache.get_json("k0", "obj") is None
+    assert cache.get_json("k3", "obj") == {"i": 3}
+    assert cache.size() <= cache.max_bytes
+
+
+def test_concurrent_writers_and_eviction(tmp_path):
+    # A tiny limit makes every put evict entries other threads are writing or reading
+    caches = [StageCache(str(tmp_path), max_bytes=2000) for _ in range(4)]
+    errors = []
+
+    def work(cache, n):
+        try:
+            for i in range(50):
+                key = f"k{i % 7}"
+                cache.put_arrays(key, "arr", x=np.full(16, n))
+                cache.get_arrays(key, "arr")
+                cache.size()
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=work, args=(c, n)) for n, c in enumerate(caches)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+
+
+def test_distance_map_entries_are_per_backend(tmp_path, monkeypatch):
+    arr = np.zeros((12, 14, 16), dtype=np.uint8)
+    arr[4:8, 5:9, 6:10] = 1
+    mask = sitk.GetImageFromArray(arr)
+    mask.SetSpacing((0.7, 0.8, 2.0))
+    cache = StageCache(str(tmp_path))
+
+    def entries():
+        return sorted(name for name in os.listdir(tmp_path) if name.endswith("-distance.npz"))
+
+    cached_distance_map(mask, 2.0, cache)
+    first = entries()
+    monkeypatch.setattr(distance_map, "EDT_BACKEND", "sitk")
+    dmap = cached_distance_map(mask, 2.0, cache)
+    assert dmap.backend == "sitk"
+    assert len(entries()) == 2 and set(first) < set(entries())
@@ -0,0 +1,21 @@
+import pytest
+
+from worker_service import LandmarkWorker, _case_key
+
+
+@pytest.mark.parametrize("variants", [{"X": 2.0}, ["Expanded_2mm"], {"X": {"mm": "2"}}, {"X": {"max_mm": None}}])
+def test_malformed_variants_rejected(tmp_path, variants):
+    with pytest.raises(ValueError):
+        _case_key({"ct": str(tmp_path / "ct.nii.gz"), "variants": variants})
+
+
+def test_malformed_request_fails_its_future():
+    worker = LandmarkWorker(batch_wait=0)
+    try:
+        for request in ({"ct": "missing.nii.gz", "variants": {"X": 2.0}}, {"variants": {}}):
+            with pytest.raises(ValueError):
+                worker.submit(request).result(timeout=10)
+        assert worker._thread.is_alive()
+        assert worker.stats["failed"] == 2
+    finally:
+        worker.close()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+threshold_sweep.py
+Sweep segment_bones' lower HU threshold without re-running the whole chain per value.
+The CT is read once and its candidate bone voxels (between the lowest candidate
+threshold and the upper threshold) are sorted by intensity. Lowering the threshold
+only adds voxels, so each step takes the next run of the sorted index and re-closes
+just the neighborhood of the added voxels (closing at a voxel depends only on input
+within 2 × radius), reusing the previous closing everywhere else. Masks are
+identical to segment_bones at each threshold; femur and tibia are then separated
+by one connected-component pass over the closed mask (bone_separation.py).
+
+Usage:
+    python threshold_sweep.py <ct_or_dir_or_manifest> --lower 200 230 260 300 [--workers N]
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import SimpleITK as sitk
+import numpy as np
+
+from bone_separation import separate_bones
+from roi import bounding_box, pad_box
+from segmentation import CLOSING_RADIUS
+from slab_io import write_box_nifti
+from volume import array_view
+
+SWEEP_TABLE_NAME = "threshold_sweep.txt"
+STAT_COLUMNS = ("lower", "upper", "raw_voxels", "bone_voxels", "raw_mm3", "bone_mm3", "tibia_mm3", "femur_mm3")
+
+
+class IntensityIndex:
+    """
+    Candidate bone voxels of a CT sorted by HU, restricted to their bounding box
+    (padded for the closing kernel). Voxels at or above any lower threshold
+    t >= floor are a suffix of the index.
+    """
+
+    def __init__(self, ct, floor: float, upper_threshold: float = 3000):
+        self.ct = sitk.ReadImage(ct) if isinstance(ct, str) else ct
+        arr = array_view(self.ct)
+        self.shape = arr.shape
+        self.floor = floor
+        self.upper = upper_threshold
+        self.voxel_mm3 = float(np.prod(self.ct.GetSpacing()))
+
+        candidate = np.empty(self.shape, dtype=bool)
+        for z0 in range(0, self.shape[0], 16):
+            slab = arr[z0:z0 + 16]
+            np.logical_and(slab >= floor, slab <= upper_threshold, out=candidate[z0:z0 + 16])
+        box = bounding_box(candidate)
+        if box is None:
+            box = tuple(slice(0, n) for n in self.shape)
+        self.box = pad_box(box, self.shape, 2 * CLOSING_RADIUS + 1)
+        self.box_shape = tuple(sl.stop - sl.start for sl in self.box)
+
+        cand = candidate[self.box]
+        del candidate
+        flat = np.flatnonzero(cand)
+        values = arr[self.box][cand]
+        order = np.argsort(values, kind="stable")
+        index_dtype = np.int32 if cand.size < 2 ** 31 else np.int64
+        self.values = values[order]
+        self.flat = flat[order].astype(index_dtype)
+
+    def start(self, lower: float) -> int:
+        """
+        Position of the first voxel >= lower; voxels [start, len) are selected.
+        """
+        return int(np.searchsorted(self.values, lower, side="left"))
+
+    def count(self, lower: float) -> int:
+        return len(self.values) - self.start(lower)
+
+    def histogram(self):
+        """
+        (HU values, voxel counts) of the candidate voxels, ascending.
+        """
+        return np.unique(self.values, return_counts=True)
+
+
+class ThresholdSweep:
+    """
+    Incremental closed bone mask over decreasing lower thresholds.
+    """
+
+    def __init__(self, index: IntensityIndex, radius: int = CLOSING_RADIUS):
+        self.index = index
+        self.radius = radius
+        self.raw = np.zeros(index.box_shape, dtype=np.uint8)
+        self.closed = np.zeros(index.box_shape, dtype=np.uint8)
+        self._pos = len(index.values)
+        self.lower = None
+        self._bone_voxels = 0
+        self._separated = None  # (position, labeled, bones) of the last separation
+
+        self._filter = sitk.BinaryMorphologicalClosingImageFilter()
+        self._filter.SetKernelRadius(radius)
+        self._filter.SetForegroundValue(1)
+
+    def _close_region(self, region):
+        """
+        Recompute the closing inside `region` (box coordinates), reading input with
+        a 2 × radius halo so the result there matches a whole-box closing.
+        """
+        halo = 2 * self.radius
+        outer = pad_box(region, self.index.box_shape, halo)
+        result = sitk.GetArrayFromImage(self._filter.Execute(sitk.GetImageFromArray(self.raw[outer])))
+        inner = tuple(slice(r.start - o.start, r.stop - o.start) for r, o in zip(region, outer))
+
+        before = np.count_nonzero(self.closed[region])
+        self.closed[region] = result[inner]
+        self._bone_voxels += np.count_nonzero(self.closed[region]) - before
+
+    def _separate(self):
+        """
+        Tibia/femur labels and statistics of the current closed mask (as segment_bones).
+        """
+        if self._separated is None or self._separated[0] != self._pos:
+            index = self.index
+            labeled, bones = separate_bones(self.closed, offset=[sl.start for sl in index.box],
+                                            shape=index.shape, spacing=index.ct.GetSpacing())
+            self._separated = (self._pos, labeled, bones)
+        return self._separated[1:]
+
+    def step(self, lower: float) -> dict:
+        """
+        Lower the threshold to `lower` (must not exceed the previous one) and
+        return the bone statistics at that threshold.
+        """
+        if self.lower is not None and lower > self.lower:
+            raise ValueError("Thresholds must be visited in decreasing order")
+        if lower < self.index.floor:
+            raise ValueError(f"Threshold {lower} is below the index floor {self.index.floor}")
+        start = self.index.start(lower)
+        added = self.index.flat[start:self._pos]
+        if len(added):
+            zyx = np.unravel_index(added, self.index.box_shape)
+            self.raw.reshape(-1)[added] = 1
+            region = tuple(slice(int(c.min()), int(c.max()) + 1) for c in zyx)
+            self._close_region(pad_box(region, self.index.box_shape, 2 * self.radius))
+        self._pos = start
+        self.lower = lower
+        return self.stats()
+
+    def stats(self) -> dict:
+        vox = self.index.voxel_mm3
+        raw = len(self.index.values) - self._pos
+        bone = int(self._bone_voxels)
+        _, bones = self._separate()
+        return {
+            "lower": self.lower, "upper": self.index.upper,
+            "raw_voxels": raw, "bone_voxels": bone,
+            "raw_mm3": raw * vox, "bone_mm3": bone * vox,
+            "tibia_mm3": bones["tibia"]["volume_mm3"], "femur_mm3": bones["femur"]["volume_mm3"],
+        }
+
+    def labeled(self) -> np.ndarray:
+        """
+        Label array (1=tibia, 2=femur) of the current threshold inside index.box.
+        """
+        return self._separate()[0]
+
+
+def sweep_thresholds(ct, lower_thresholds, upper_threshold=3000, output_dir: str = None) -> list:
+    """
+    Bone statistics (and optionally labeled masks) for several lower thresholds
+    from one read of the CT.
+
+    Args:
+        ct: CT path, sitk.Image or Volume.
+        lower_thresholds: Candidate lower HU thresholds, any order.
+        upper_threshold (float): Upper HU threshold shared by all candidates.
+        output_dir (str): If given, writes bone_segmented_<lower>HU.nii.gz per threshold.
+
+    Returns:
+        list: One dict of STAT_COLUMNS per threshold, in the order given.
+    """
+    lowers = sorted(set(lower_thresholds), reverse=True)
+    sweep = ThresholdSweep(IntensityIndex(ct, floor=lowers[-1], upper_threshold=upper_threshold))
+    results = {}
+    for lower in lowers:
+        results[lower] = sweep.step(lower)
+        if output_dir is not None:
+            path = os.path.join(output_dir, f"bone_segmented_{lower:g}HU.nii.gz")
+            write_box_nifti(path, sweep.index.ct, sweep.index.box, sweep.labeled())
+    return [results[lower] for lower in lower_thresholds]
+
+
+def sweep_cohort(source: str, lower_thresholds, output_path: str = SWEEP_TABLE_NAME, upper_threshold=3000,
+                 workers: int = None) -> str:
+    """
+    Run sweep_thresholds over every CT of a directory or manifest (see batch.py)
+    in a process pool and write one table: Case plus STAT_COLUMNS per threshold.
+    """
+    from batch import list_cases
+
+    cases = list_cases(source) if not source.endswith((".nii", ".nii.gz")) else {
+        os.path.basename(source).split(".")[0]: source
+    }
+    rows = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(sweep_thresholds, path, lower_thresholds, upper_threshold): cid
+            for cid, path in cases.items()
+        }
+        for future in as_completed(futures):
+            case_id = futures[future]
+            try:
+                rows[case_id] = future.result()
+                print(f"✅ {case_id}: {len(rows[case_id])} thresholds")
+            except Exception as exc:
+                print(f"❌ Threshold sweep failed for {case_id}: {exc!r}")
+
+    with open(output_path, "w") as f:
+        f.write("\t".join(("Case",) + STAT_COLUMNS) + "\n")
+        for case_id in sorted(rows):
+            for s in rows[case_id]:
+                f.write("\t".join([case_id] + [
+                    f"{s[c]:.2f}" if c.endswith("_mm3") else f"{s[c]:g}" for c in STAT_COLUMNS
+                ]) + "\n")
+    print(f"✅ Threshold sweep table saved to: {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep segment_bones' lower threshold over CT scans.")
+    parser.add_argument("source", help="CT file, directory of CT files or text manifest of paths")
+    parser.add_argument("--lower", type=float, nargs="+", required=True, help="Candidate lower thresholds (HU)")
+    parser.add_argument("--upper", type=float, default=3000, help="Upper threshold (HU)")
+    parser.add_argument("--out", default=SWEEP_TABLE_NAME, help="Output table path")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    args = parser.parse_args()
+    sweep_cohort(args.source, args.lower, args.out, upper_threshold=args.upper, workers=args.workers)
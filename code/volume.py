@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+volume.py
+Volume: a NumPy [Z, Y, X] buffer together with origin, spacing and direction.
+
+Wrapping a SimpleITK image uses GetArrayViewFromImage, so no voxels are copied;
+converting back returns the original image when the buffer is still that view.
+Volume also answers the geometry calls used across the pipeline (GetSize,
+GetSpacing, GetOrigin, GetDirection, TransformIndexToPhysicalPoint), so most
+functions treat it and sitk.Image interchangeably.
+"""
+
+import hashlib
+import os
+
+import SimpleITK as sitk
+import numpy as np
+
+IDENTITY_DIRECTION = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+WRITE_SLAB = 16
+
+# Memory-lean mode: derived masks are boolean (bit-packed while cached) and distance
+# maps narrow (see distance_map.DISTANCE_DTYPE); uint8 only at the SimpleITK/NIfTI boundary
+COMPACT = os.environ.get("KNEE_COMPACT", "0") not in ("", "0")
+
+
+class Volume:
+    """
+    NumPy voxel buffer (indexed [z, y, x]) with physical geometry in SimpleITK
+    (x, y, z) conventions.
+    """
+
+    def __init__(self, array: np.ndarray, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0),
+                 direction=IDENTITY_DIRECTION, image: sitk.Image = None):
+        self.array = array
+        self.spacing = tuple(float(s) for s in spacing)
+        self.origin = tuple(float(o) for o in origin)
+        self.direction = tuple(float(d) for d in direction)
+        # Image whose buffer `array` views; kept alive and handed back by to_image()
+        self._image = image
+
+    @classmethod
+    def from_image(cls, img: sitk.Image) -> "Volume":
+        """
+        Zero-copy wrap of a SimpleITK image (the array is a read-only view).
+        """
+        return cls(sitk.GetArrayViewFromImage(img), img.GetSpacing(), img.GetOrigin(),
+                   img.GetDirection(), image=img)
+
+    @classmethod
+    def read(cls, path: str) -> "Volume":
+        return cls.from_image(sitk.ReadImage(path))
+
+    def like(self, array: np.ndarray) -> "Volume":
+        """
+        New Volume with this geometry and another buffer of the same shape.
+        """
+        if array.shape != self.shape:
+            raise ValueError(f"Array shape {array.shape} does not match volume shape {self.shape}")
+        return Volume(array, self.spacing, self.origin, self.direction)
+
+    def to_image(self) -> sitk.Image:
+        """
+        SimpleITK image for this volume. Free when the volume wraps an image;
+        otherwise the buffer is copied once.
+        """
+        if self._image is not None:
+            return self._image
+        arr = self.array.astype(np.uint8) if self.array.dtype == bool else self.array
+        img = sitk.GetImageFromArray(arr)
+        img.SetSpacing(self.spacing)
+        img.SetOrigin(self.origin)
+        img.SetDirection(self.direction)
+        return img
+
+    def write(self, path: str):
+        """
+        Save to NIfTI (or any SimpleITK format). NumPy-backed volumes are streamed
+        straight from the buffer to .nii/.nii.gz without building a SimpleITK copy.
+        """
+        if self._image is None and path.endswith((".nii", ".nii.gz")):
+            from slab_io import SlabNiftiWriter
+
+            dtype = np.uint8 if self.array.dtype == bool else self.array.dtype
+            with SlabNiftiWriter(path, self, dtype=dtype) as writer:
+                for z0 in range(0, self.shape[0], WRITE_SLAB):
+                    writer.write(self.array[z0:z0 + WRITE_SLAB])
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        sitk.WriteImage(self.to_image(), path)
+
+    def crop(self, box) -> "Volume":
+        """
+        View of a (z, y, x) slice box, with origin moved to the box corner.
+        """
+        corner = (box[2].start, box[1].start, box[0].start)
+        return Volume(self.array[box], self.spacing, self.TransformIndexToPhysicalPoint(corner),
+                      self.direction)
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    # SimpleITK-compatible geometry accessors
+    def GetSize(self):
+        return tuple(int(n) for n in self.array.shape[::-1])
+
+    def GetSpacing(self):
+        return self.spacing
+
+    def GetOrigin(self):
+        return self.origin
+
+    def GetDirection(self):
+        return self.direction
+
+    def TransformIndexToPhysicalPoint(self, idx):
+        direction = np.array(self.direction).reshape(3, 3)
+        point = np.array(self.origin) + direction @ (np.asarray(idx, dtype=float) * np.array(self.spacing))
+        return tuple(float(p) for p in point)
+
+
+def as_volume(x) -> Volume:
+    """
+    Volume for a Volume or SimpleITK image (zero-copy).
+    """
+    return x if isinstance(x, Volume) else Volume.from_image(x)
+
+
+def as_image(x) -> sitk.Image:
+    """
+    SimpleITK image for a Volume or SimpleITK image.
+    """
+    return x.to_image() if isinstance(x, Volume) else x
+
+
+def array_view(x) -> np.ndarray:
+    """
+    Voxel array of a Volume or SimpleITK image without copying.
+    """
+    return x.array if isinstance(x, Volume) else sitk.GetArrayViewFromImage(x)
+
+
+def mask_digest(mask) -> str:
+    """
+    Content hash of a mask (sitk.Image or Volume): voxel values plus origin,
+    spacing and direction.
+    """
+    arr = array_view(mask)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(arr.shape).encode())
+    h.update(str(arr.dtype).encode())
+    h.update(np.ascontiguousarray(arr).tobytes())
+    h.update(repr((mask.GetOrigin(), mask.GetSpacing(), mask.GetDirection())).encode())
+    return h.hexdigest()
+
+
+def mask_dtype():
+    """
+    Dtype of derived binary masks: bool in compact mode, else uint8.
+    """
+    return np.bool_ if COMPACT else np.uint8
+
+
+def match_input(template, vol: Volume):
+    """
+    Return `vol` as the same kind of object as `template` (Volume or sitk.Image).
+    """
+    return vol if isinstance(template, Volume) else vol.to_image()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+worker_service.py
+Long-running local landmark worker. Keeps SimpleITK/SciPy imported, the segmented
+tibia mask and its distance map cached per CT, and answers landmark requests as
+JSON over HTTP on localhost or over a Unix socket. Requests are queued and handled
+in batches by one worker thread: requests for the same CT and thresholds in a batch
+share one segmentation and one distance map, and repeat queries for a cached CT
+skip both. Nothing leaves the machine.
+
+Usage:
+    python worker_service.py [--port 8765 | --socket /tmp/knee.sock] [--batch-size 8]
+
+    POST /landmarks  {"ct": "<path>", "case_id": "...", "lower_threshold": 260,
+                      "upper_threshold": 3000, "variants": {"Expanded_2mm": {"mm": 2.0}, ...},
+                      "surface_landmarks": ["axis_extremes"], "output_dir": "..."}
+    GET  /health
+"""
+
+import argparse
+import http.client
+import json
+import os
+import queue
+import shutil
+import signal
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_BATCH_WAIT = 0.05
+DEFAULT_CACHED_CASES = 4
+DEFAULT_REQUEST_TIMEOUT = 600.0
+
+
+class LandmarkWorker:
+    """
+    Queue of landmark jobs processed in batches on a background thread.
+
+    Args:
+        batch_size (int): Most jobs taken from the queue per batch.
+        batch_wait (float): Seconds to wait for more jobs once one has arrived.
+        cached_cases (int): Segmented CTs (tibia mask + distance map) kept in memory.
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, batch_wait: float = DEFAULT_BATCH_WAIT,
+                 cached_cases: int = DEFAULT_CACHED_CASES):
+        # Heavy imports happen once, here, instead of per request
+        from distance_map import DistanceMap
+        from run_landmark_pipeline import VARIANT_PARAMS
+        from segmentation import segment_bones
+
+        self._segment_bones = segment_bones
+        self._distance_map = DistanceMap
+        self.default_variants = VARIANT_PARAMS
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.cached_cases = cached_cases
+        self._cases = OrderedDict()
+        self._queue = queue.Queue()
+        self._scratch = tempfile.mkdtemp(prefix="knee_worker_")
+        self.stats = {"jobs": 0, "batches": 0, "segmentations": 0, "failed": 0}
+        self._thread = threading.Thread(target=self._run, name="landmark-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, request: dict) -> Future:
+        future = Future()
+        self._queue.put((request, future))
+        return future
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        shutil.rmtree(self._scratch, ignore_errors=True)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            try:
+                self._process_batch(batch)
+            except Exception as exc:
+                # Never leave a client waiting on a future the dead batch dropped
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+
+    def _process_batch(self, batch):
+        self.stats["batches"] += 1
+        groups = OrderedDict()
+        for request, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                key = _case_key(request)
+            except (ValueError, OSError) as exc:
+                self.stats["failed"] += 1
+                future.set_exception(exc)
+                continue
+            groups.setdefault(key, []).append((request, future))
+        for key, jobs in groups.items():
+            try:
+                variants = [self._variants(request) for request, _ in jobs]
+                max_mm = max([_max_mm(v) for v in variants] + [0.0])
+                tibia, dmap = self._case(key, jobs[0][0], max_mm)
+            except Exception as exc:
+                for _, future in jobs:
+                    self.stats["failed"] += 1
+                    future.set_exception(exc)
+                continue
+            for (request, future), params in zip(jobs, variants):
+                self.stats["jobs"] += 1
+                try:
+                    future.set_result(self._landmarks(request, tibia, dmap, params))
+                except Exception as exc:
+                    self.stats["failed"] += 1
+                    future.set_exception(exc)
+
+    def _variants(self, request: dict) -> dict:
+        return request.get("variants") or self.default_variants
+
+    def _case(self, key, request: dict, max_mm: float):
+        """
+        Tibia mask and distance map of a CT at given thresholds, from the case
+        cache or by segmenting it.
+        """
+        if key in self._cases:
+            self._cases.move_to_end(key)
+            tibia, dmap = self._cases[key]
+        else:
+            from bone_separation import bone_mask
+            from volume import as_volume
+
+            bones = {}
+            labeled, _ = self._segment_bones(
+                request["ct"], output_dir=self._scratch,
+                lower_threshold=request.get("lower_threshold", 260),
+                upper_threshold=request.get("upper_threshold", 3000),
+                bones=bones,
+            )
+            self.stats["segmentations"] += 1
+            tibia = bone_mask(as_volume(labeled), bones["tibia"])
+            dmap = self._distance_map(tibia, box=bones["tibia"]["box"])
+            self._cases[key] = (tibia, dmap)
+            while len(self._cases) > self.cached_cases:
+                self._cases.popitem(last=False)
+        if max_mm > 0:
+            dmap.ensure(max_mm)
+        return tibia, dmap
+
+    def _landmarks(self, request: dict, tibia, dmap, variants: dict) -> dict:
+        from landmark_utils import measure_landmarks
+
+        case_id = request.get("case_id") or _case_id(request["ct"])
+        masks = {}
+        for name, p in variants.items():
+            if "mm" in p:
+                masks[name] = dmap.expand(p["mm"])
+            elif "max_mm" in p:
+                masks[name] = dmap.randomize(p["max_mm"], seed=p.get("seed"), key=(case_id, name))
+            else:
+                masks[name] = tibia
+        indices = {}
+        records = measure_landmarks(case_id, masks, box=dmap.box, params=variants, indices=indices)
+        for record in records:
+            record["params"] = json.loads(record["params"])
+            for extra in request.get("surface_landmarks", ()):
+                record[extra] = indices[record["variant"]].landmark(extra)
+
+        if request.get("output_dir"):
+            from landmark_store import LANDMARK_DB_NAME, LANDMARK_TSV_NAME, LandmarkStore, write_landmarks_tsv
+            from mask_io import MaskWriter, mask_filename
+
+            out = request["output_dir"]
+            os.makedirs(out, exist_ok=True)
+            with MaskWriter() as writer:
+                for name, img in masks.items():
+                    writer.submit(img, os.path.join(out, mask_filename(f"mask_tibia_{name.lower()}")))
+            stored = [dict(r, params=json.dumps(r["params"], sort_keys=True)) for r in records]
+            with LandmarkStore(os.path.join(out, LANDMARK_DB_NAME)) as store:
+                store.extend(stored)
+            write_landmarks_tsv(os.path.join(out, LANDMARK_TSV_NAME), stored)
+        return {"case_id": case_id, "landmarks": records}
+
+
+def _case_id(ct_path: str) -> str:
+    from batch import case_id_from_path
+
+    return case_id_from_path(ct_path)
+
+
+def _case_key(request: dict):
+    """
+    Cache key of a request's segmentation: CT content and thresholds. Raises
+    ValueError for a malformed request.
+    """
+    from stage_cache import file_digest
+
+    if not isinstance(request, dict) or "ct" not in request:
+        raise ValueError("Request needs a 'ct' path")
+    _check_variants(request.get("variants"))
+    return (file_digest(request["ct"]), request.get("lower_threshold", 260), request.get("upper_threshold", 3000))
+
+
+def _check_variants(variants):
+    """
+    Raise ValueError unless `variants` is empty or maps names to parameter dicts
+    whose "mm" / "max_mm" are numbers.
+    """
+    if not variants:
+        return
+    if not isinstance(variants, dict):
+        raise ValueError("'variants' must map variant names to parameter objects")
+    for name, p in variants.items():
+        if not isinstance(p, dict):
+            raise ValueError(f"Variant {name!r}: parameters must be an object, e.g. {{\"mm\": 2.0}}")
+        for field in ("mm", "max_mm"):
+            if field in p and (isinstance(p[field], bool) or not isinstance(p[field], (int, float))):
+                raise ValueError(f"Variant {name!r}: {field!r} must be a number")
+
+
+def _max_mm(variants: dict) -> float:
+    return max([p.get("mm", p.get("max_mm", 0.0)) for p in variants.values()] + [0.0])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    worker: LandmarkWorker = None
+    timeout_s: float = DEFAULT_REQUEST_TIMEOUT
+
+    def address_string(self):
+        # Unix-socket clients have no (host, port) address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        print(f"🌐 {self.address_string()} {format % args}")
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._reply(404, {"error": f"Unknown path {self.path}"})
+        self._reply(200, {"status": "ok", "queued": self.worker.pending(),
+                          "cached_cases": len(self.worker._cases), **self.worker.stats})
+
+    def do_POST(self):
+        if self.path != "/landmarks":
+            return self._reply(404, {"error": f"Unknown path {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            _case_key(request)
+        except (ValueError, OSError) as exc:
+            return self._reply(400, {"error": str(exc)})
+        future = self.worker.submit(request)
+        try:
+            self._reply(200, future.result(timeout=self.timeout_s))
+        except TimeoutError:
+            future.cancel()
+            self._reply(504, {"error": f"No result within {self.timeout_s:g} s"})
+        except Exception as exc:
+            self._reply(500, {"error": repr(exc)})
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, socket_path: str = None,
+          batch_size: int = DEFAULT_BATCH_SIZE, batch_wait: float = DEFAULT_BATCH_WAIT,
+          cached_cases: int = DEFAULT_CACHED_CASES, request_timeout: float = DEFAULT_REQUEST_TIMEOUT):
+    """
+    Run the worker until interrupted, on HTTP host:port or on a Unix socket.
+    Requests without a result after `request_timeout` seconds get HTTP 504.
+    """
+    handler = type("Handler", (_Handler,), {
+        "worker": LandmarkWorker(batch_size=batch_size, batch_wait=batch_wait, cached_cases=cached_cases),
+        "timeout_s": request_timeout,
+    })
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixHTTPServer(socket_path, handler)
+        where = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        where = f"http://{host}:{port}"
+    print(f"🚀 Landmark worker listening on {where}")
+    if threading.current_thread() is threading.main_thread():
+        # Service managers stop with SIGTERM; shut down as on Ctrl-C
+        signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        handler.worker.close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request_landmarks(request: dict, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                      socket_path: str = None, timeout: float = None) -> dict:
+    """
+    Client side: send one landmark request to a running worker and return its JSON
+    reply. Raises RuntimeError with the worker's message on failure.
+    """
+    conn = _UnixHTTPConnection(socket_path, timeout) if socket_path else \
+        http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request("POST", "/landmarks", body=json.dumps(request),
+                     headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        body = json.loads(response.read())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError(body.get("error", f"HTTP {response.status}"))
+    return body
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local landmark worker (HTTP on localhost or Unix socket).")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Bind address (default: localhost only)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="HTTP port")
+    parser.add_argument("--socket", default=None, help="Serve on this Unix socket path instead of TCP")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Jobs per batch")
+    parser.add_argument("--batch-wait", type=float, default=DEFAULT_BATCH_WAIT,
+                        help="Seconds to wait for more jobs before running a batch")
+    parser.add_argument("--cached-cases", type=int, default=DEFAULT_CACHED_CASES,
+                        help="Segmented CTs kept in memory")
+    parser.add_argument("--request-timeout", type=float, default=DEFAULT_REQUEST_TIMEOUT,
+                        help="Seconds a request may wait for its result before HTTP 504")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.socket, args.batch_size, args.batch_wait, args.cached_cases,
+          args.request_timeout)